@@ -1,50 +1,36 @@
 import os
-import json
 from datasets import load_dataset
+from utils.xlsum_store import LANGS, SPLITS, ROW_GROUP_SIZE, store_path
 
 
-def save_dataset_to_jsonl(dataset, file_path):
+def download_subset(lang, output_path, subset):
     """
-    Save a dataset to a JSONL file.
-    Args:
-        dataset (Dataset): The dataset to save.
-        file_path (str): The path to the output JSONL file.
-    """
-    with open(file_path, 'w', encoding='utf-8') as f:
-        for example in dataset:
-            f.write(json.dump(example, f, ensure_ascii=False) + "\n")
-
-
-def download_subset(lang, lang_path, subset):
-    """
-    Download a specific subset of the dataset for a given language.
+    Download a specific subset of the dataset for a given language,
+    and save its id/article/summary columns in the Parquet store.
     Args:
         lang (str): The language code.
-        lang_path (str): The path to save the dataset.
+        output_path (str): The directory of the store.
         subset (str): The subset to download (train, validation, test).
     """
     try:
         subdataset = load_dataset("csebuetnlp/xlsum", lang, split=subset)
-        subdataset.save_to_disk(os.path.join(lang_path, subset))
-        subdataset_path = os.path.join(lang_path, f"{subset}.jsonl")
-        save_dataset_to_jsonl(subdataset, subdataset_path)
+        subdataset = subdataset.select_columns(["id", "text", "summary"]).rename_column("text", "article")
+        subdataset.to_parquet(store_path(output_path, lang, subset), batch_size=ROW_GROUP_SIZE, compression="zstd")
         print(f"successfully downloaded and saved {lang} subset's {subset}.")
     except ValueError as e:
         print(f"{lang} does not have {subset}: {e}")
 
 
 if __name__ == "__main__":
-    langs = ["chinese_traditional", "english", "korean", "japanese"]
     output_path = "./xlsum_datasets"
     os.makedirs(output_path, exist_ok=True)
 
-    for lang in langs:
+    for lang in LANGS:
         try:
-            lang_path = os.path.join(output_path, lang)
-            os.makedirs(lang_path, exist_ok=True)
+            os.makedirs(os.path.join(output_path, lang), exist_ok=True)
 
-            for subset in ["train", "validation", "test"]:
-                download_subset(lang, lang_path, subset)
+            for subset in SPLITS:
+                download_subset(lang, output_path, subset)
 
         except Exception as e:
             print(f"Error downloading {lang} dataset: {e}")
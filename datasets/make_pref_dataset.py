@@ -1,8 +1,8 @@
 import json
 import os
-import concurrent.futures
-from tqdm import tqdm
-from utils.llm_judge_utils import get_llm_judge_with_retry
+from utils.judge_cache import journal_path
+from utils.judge_prompts import get_texts
+from utils.llm_judge_utils import judge_files
 
 
 SYSTEM_MSG = """You are an expert in summarization tasks. You are good at summarizing long texts into concise and accurate summarizations. The text you summarize needs to meet the following three requirements:
@@ -12,47 +12,58 @@ SYSTEM_MSG = """You are an expert in summarization tasks. You are good at summar
 USER_PROMPT_PREFIX = "Summarize the following text: \n"
 
 
-def transfer_to_pref_dataset(filename):
+def load_prompts(filename):
     """
-    Given a JSONL file with LLM judge prompts, process it to create a preference dataset by using the LLM judge.
+    Read the LLM judge prompts of a JSONL file.
     Args:
         filename (str): The path to the JSONL file.
     Returns:
-        int: The number of new lines generated.
+        list: The parsed lines.
     """
+    records = []
     with open(filename, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-        new_lines = []
-        for line in tqdm(lines, desc=f"Processing {filename}", unit="line"):
-            data = json.loads(line.strip())
+        for line in f:
+            try:
+                records.append(json.loads(line.strip()))
+            except json.JSONDecodeError:
+                print(f"JSONDecodeError: {line}")
+    return records
+
 
-            # Extract the original text and the two summaries from the prompt
-            prompt = data.get('prompt')
-            original_text = prompt.split("original text:\n")[-1].split("\ncandidate summaries:")[0].strip()
-            summary = prompt.split("candidate summaries:\n1. ")[-1].split("\n")[0].strip()
-            response0 = prompt.split("\n2. ")[-1].split("\n")[0].strip()
+def transfer_to_pref_dataset(filename, records, judge_results):
+    """
+    Given the LLM judge prompts of a JSONL file and their judge results, create a preference dataset.
+    Args:
+        filename (str): The path to the JSONL file.
+        records (list): The parsed lines of the file.
+        judge_results (list): The scores of each line, None if the judge failed.
+    Returns:
+        int: The number of new lines generated.
+    """
+    new_lines = []
+    for data, judge_result in zip(records, judge_results):
+        original_text, summary, response0 = get_texts(data)
 
-            # get the LLM judge to compare the two summaries, making the preference data
-            judge_result = get_llm_judge_with_retry(prompt)
-            if judge_result:
-                score1, score2 = judge_result
-                chsn, rej = response0, summary
-                if score1 > score2:
-                    chsn, rej = summary, response0 
-                new_data = {
-                    "id": data["id"],
-                    "chosen": [
-                        {"role": "system", "content": SYSTEM_MSG}, 
-                        {"role": "user", "content": USER_PROMPT_PREFIX + original_text}, 
-                        {"role": "assistant", "content": chsn}
-                    ],
-                    "rejected": [
-                        {"role": "system", "content": SYSTEM_MSG}, 
-                        {"role": "user", "content": USER_PROMPT_PREFIX + original_text}, 
-                        {"role": "assistant", "content": rej}
-                    ],
-                }
-                new_lines.append(json.dumps(new_data, ensure_ascii=False) + "\n")
+        # the LLM judge compared the two summaries, making the preference data
+        if judge_result and len(judge_result) == 2:
+            score1, score2 = judge_result
+            chsn, rej = response0, summary
+            if score1 > score2:
+                chsn, rej = summary, response0
+            new_data = {
+                "id": data["id"],
+                "chosen": [
+                    {"role": "system", "content": SYSTEM_MSG},
+                    {"role": "user", "content": USER_PROMPT_PREFIX + original_text},
+                    {"role": "assistant", "content": chsn}
+                ],
+                "rejected": [
+                    {"role": "system", "content": SYSTEM_MSG},
+                    {"role": "user", "content": USER_PROMPT_PREFIX + original_text},
+                    {"role": "assistant", "content": rej}
+                ],
+            }
+            new_lines.append(json.dumps(new_data, ensure_ascii=False) + "\n")
 
     if len(new_lines) > 0:
         with open(filename.replace(".jsonl", "_processed.jsonl"), 'w', encoding='utf-8') as f:
@@ -66,24 +77,31 @@ def transfer_to_pref_dataset(filename):
 def main(directory):
     """
     Main function to transfer all LLM judge prompts into preference datasets in the given directory.
+    The lines of all the files are sent together to the async judge client, so the judge calls
+    run concurrently up to the limits set in `utils/llm_judge_utils.py`.
+    The judge results are journaled as they arrive, so an interrupted run resumes where it stopped,
+    and the judge responses are cached, so the reruns do not call the judge again.
     """
-    file_paths = [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.jsonl')]
+    file_paths = [
+        os.path.join(directory, f) for f in os.listdir(directory)
+        if f.endswith('.jsonl') and not f.endswith('_processed.jsonl')
+    ]
     print(f"checking the files: {file_paths}")
 
-    # Multi-threading, one thread per file
-    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
-        future_to_file = {executor.submit(transfer_to_pref_dataset, file_path): file_path for file_path in file_paths}
+    records = {file_path: load_prompts(file_path) for file_path in file_paths}
+    judge_results = judge_files(records, desc="Overall Progress")
 
-        with tqdm(total=len(file_paths), desc="Overall Progress", unit="file") as pbar:
-            # wait for all threads to complete
-            for future in concurrent.futures.as_completed(future_to_file):
-                file_path = future_to_file[future]
-                try:
-                    len_newlines = future.result()
-                    print(f"File {file_path} processed successfully, generated {len_newlines} new JSON lines.")
-                except Exception as e:
-                    print(f"Error happened in {file_path} : {e}")
-                pbar.update(1)  # update progress bar
+    for file_path in file_paths:
+        try:
+            len_newlines = transfer_to_pref_dataset(file_path, records[file_path], judge_results[file_path])
+            print(f"File {file_path} processed successfully, generated {len_newlines} new JSON lines.")
+            num_failed = judge_results[file_path].count(None)
+            if num_failed == 0:
+                os.remove(journal_path(file_path))
+            else:
+                print(f"{num_failed} lines of {file_path} failed to be judged, rerun to judge them again.")
+        except Exception as e:
+            print(f"Error happened in {file_path} : {e}")
 
 
 if __name__ == "__main__":
@@ -1,62 +1,207 @@
 import json
 import os
-from utils.prompts import SYSTEM_MSG, USER_PROMPT_PREFIX
+import time
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor
+from utils.xlsum_store import LANGS, ROW_GROUP_SIZE, SCHEMA, SPLITS, open_writer, store_path
 
-def making_completion_format(input_file, output_file):
+# files larger than this are split into several chunks converted in parallel
+CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def to_compact_format(data):
     """
-    transform the input JSONL file into completion format for SFT training.
+    Keep the fields of an XLSum record used for training and eval.
+    Args:
+        data (dict): The XLSum record.
+    Returns:
+        dict: The id, article and summary of the record.
+    """
+    return {"id": data["id"], "article": data["text"], "summary": data["summary"]}
+
+
+def convert_lines(lines, writer, batch_size=ROW_GROUP_SIZE):
+    """
+    Convert the JSONL lines of XLSum records and write them to `writer` in record batches,
+    so only one batch of records is held in memory.
+    Args:
+        lines (iterable): The input lines.
+        writer (pq.ParquetWriter): The output file, each batch is written as one row group.
+        batch_size (int): The number of records per batch.
+    Returns:
+        tuple: The number of converted lines and the number of skipped ones.
+    """
+    block, num_lines, num_errors = [], 0, 0
+    for line in lines:
+        try:
+            block.append(to_compact_format(json.loads(line)))
+        except json.JSONDecodeError:
+            print(f"JSONDecodeError: {line.strip()}")
+            num_errors += 1
+            continue
+        except KeyError as e:
+            print(f"KeyError: {e} in line: {line.strip()}")
+            num_errors += 1
+            continue
+        if len(block) >= batch_size:
+            writer.write_batch(pa.RecordBatch.from_pylist(block, schema=SCHEMA))
+            num_lines += len(block)
+            block = []
+    if block:
+        writer.write_batch(pa.RecordBatch.from_pylist(block, schema=SCHEMA))
+        num_lines += len(block)
+    return num_lines, num_errors
+
+
+def making_compact_format(input_file, output_file):
+    """
+    transform the input JSONL file into the compact Parquet store.
     Args:
         input_file (str): The path to the input JSONL file.
-        output_file (str): The path to the output JSONL file.
+        output_file (str): The path to the output Parquet file.
     """
-    with open(input_file, 'r', encoding='utf-8') as infile, \
-            open(output_file, 'w', encoding='utf-8') as outfile:
+    with open(input_file, 'r', encoding='utf-8') as infile, open_writer(output_file) as writer:
+        convert_lines(infile, writer)
 
-        for line in infile:
-            try:
-                data = json.loads(line.strip())
 
-                # making completion format
-                new_data = {
-                    "id": data["id"],
-                    "url": data["url"],
-                    "title": data["title"],
-                    "article": data["text"],
-                    "summary": data["summary"],
-                    "messages": [
-                        {"role": "system", "content": SYSTEM_MSG},
-                        {"role": "user", "content": USER_PROMPT_PREFIX + data["text"]},
-                        {"role": "assistant", "content": data["summary"]}
-                    ]
-                }
+def split_byte_ranges(input_file, chunk_bytes=CHUNK_BYTES):
+    """
+    Split a JSONL file into byte ranges of about `chunk_bytes`, each starting at the beginning of a line.
+    Args:
+        input_file (str): The path to the JSONL file.
+        chunk_bytes (int): The target size of the ranges.
+    Returns:
+        list: The (start, end) byte offsets of the ranges, in file order.
+    """
+    size = os.path.getsize(input_file)
+    offsets = [0]
+    with open(input_file, 'rb') as f:
+        while offsets[-1] + chunk_bytes < size:
+            f.seek(offsets[-1] + chunk_bytes)
+            # move to the start of the next line
+            f.readline()
+            if f.tell() >= size:
+                break
+            offsets.append(f.tell())
+    return list(zip(offsets, offsets[1:] + [size]))
 
-                outfile.write(json.dumps(new_data, ensure_ascii=False) + "\n")
 
-            except json.JSONDecodeError:
-                print(f"JSONDecodeError: {line.strip()}")
-            except KeyError as e:
-                print(f"KeyError: {e} in line: {line.strip()}")
+def convert_chunk(input_file, start, end, part_file):
+    """
+    Convert the lines of a byte range of a JSONL file into a Parquet part file. Run in a worker process.
+    Args:
+        input_file (str): The path to the input JSONL file.
+        start (int): The offset of the first line of the range.
+        end (int): The offset after the last line of the range.
+        part_file (str): The path to the output part file.
+    Returns:
+        tuple: The number of converted lines and the number of skipped ones.
+    """
+    def read_range(f):
+        position = start
+        for line in f:
+            if position >= end:
+                break
+            position += len(line)
+            yield line.decode('utf-8')
+
+    with open(input_file, 'rb') as infile, open_writer(part_file) as writer:
+        infile.seek(start)
+        return convert_lines(read_range(infile), writer)
+
+
+def concat_parts(part_files, output_file):
+    """
+    Append the row groups of the part files in order to the output file, one at a time, and remove them.
+    """
+    with open_writer(output_file) as writer:
+        for part_file in part_files:
+            for batch in pq.ParquetFile(part_file).iter_batches(batch_size=ROW_GROUP_SIZE):
+                writer.write_batch(batch)
+            os.remove(part_file)
+
 
+def convert_files(file_pairs, num_workers=None, chunk_bytes=CHUNK_BYTES):
+    """
+    Convert several JSONL files in a process pool. The large files are split into byte ranges
+    converted in parallel into part files, which are concatenated in order, so the output has
+    the same rows as the one of `making_compact_format`.
+    Args:
+        file_pairs (list): The (input_file, output_file) paths.
+        num_workers (int): The number of worker processes, None for the number of CPUs.
+        chunk_bytes (int): The target size of the byte ranges.
+    Returns:
+        dict: The throughput report, overall and per file.
+    """
+    start_time = time.perf_counter()
+    report = {"files": []}
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        jobs = []
+        for input_file, output_file in file_pairs:
+            ranges = split_byte_ranges(input_file, chunk_bytes)
+            part_files = [f"{output_file}.part{i:05d}" for i in range(len(ranges))]
+            futures = [
+                executor.submit(convert_chunk, input_file, start, end, part_file)
+                for (start, end), part_file in zip(ranges, part_files)
+            ]
+            jobs.append((input_file, output_file, part_files, futures))
+
+        for input_file, output_file, part_files, futures in jobs:
+            results = [future.result() for future in futures]
+            concat_parts(part_files, output_file)
+            report["files"].append({
+                "input_file": input_file,
+                "output_file": output_file,
+                "chunks": len(part_files),
+                "lines": sum(num_lines for num_lines, _ in results),
+                "errors": sum(num_errors for _, num_errors in results),
+                "input_bytes": os.path.getsize(input_file),
+                "output_bytes": os.path.getsize(output_file),
+            })
 
-def process_directory(directory):
+    elapsed = time.perf_counter() - start_time
+    for key in ["lines", "errors", "input_bytes", "output_bytes"]:
+        report[key] = sum(f[key] for f in report["files"])
+    report["seconds"] = elapsed
+    report["lines_per_sec"] = report["lines"] / elapsed if elapsed > 0 else None
+    report["input_mb_per_sec"] = report["input_bytes"] / 1024 / 1024 / elapsed if elapsed > 0 else None
+    return report
+
+
+def process_directory(directory, num_workers=None, chunk_bytes=CHUNK_BYTES):
     """
-    Process all JSONL files in the given directory and transform them into a new format.
+    Convert the JSONL splits of the given directory, written by the older versions of `download_datasets.py`,
+    into the compact Parquet store.
     Args:
         directory (str): The path to the directory containing JSONL files.
+        num_workers (int): The number of worker processes, None for the number of CPUs.
+        chunk_bytes (int): Files larger than this are split into chunks converted in parallel.
+    Returns:
+        dict: The throughput report.
     """
-    for lang in ["chinese_traditional", "english", "japanese", "korean"]:
-        for subset in ["train.jsonl", "validation.jsonl", "test.jsonl"]:
-            input_file = os.path.join(directory, lang, subset)
+    file_pairs = []
+    for lang in LANGS:
+        for subset in SPLITS:
+            input_file = os.path.join(directory, lang, f"{subset}.jsonl")
             if os.path.exists(input_file):
-                output_file = os.path.join(directory, lang, f"transformed_{subset}")
+                output_file = store_path(directory, lang, subset)
                 print(f"transferring {input_file} -> {output_file}")
-                making_completion_format(input_file, output_file)
+                file_pairs.append((input_file, output_file))
             else:
                 print(f"File not found: {input_file}")
 
+    report = convert_files(file_pairs, num_workers=num_workers, chunk_bytes=chunk_bytes)
+    for f in report["files"]:
+        print(f"{f['output_file']}: {f['lines']} lines ({f['errors']} skipped) in {f['chunks']} chunks")
+    print(
+        f"Converted {report['lines']} lines ({report['input_bytes'] / 1024 / 1024:.1f} MB) in {report['seconds']:.1f} s: "
+        f"{report['lines_per_sec'] or 0:.0f} lines/s, {report['input_mb_per_sec'] or 0:.1f} MB/s"
+    )
+    return report
+
 
 if __name__ == "__main__":
     directory_to_process = "./xlsum_datasets/"
     process_directory(directory_to_process)
     print("All files have been processed.")
-
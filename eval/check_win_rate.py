@@ -1,74 +1,198 @@
 import json
+import math
 import os
-import concurrent.futures
-from tqdm import tqdm
-from utils.llm_judge_utils import get_llm_judge_with_retry
+import random
+from statistics import NormalDist
+from utils.judge_cache import journal_path
+from utils.llm_judge_utils import judge_files
 
+# judge the lines in a random order, and stop a file once its win rate is settled
+ADAPTIVE = True
+CONFIDENCE = 0.95  # of the Wilson interval
+TARGET_WIDTH = 0.1  # stop when the interval is narrower than this
+DECISION_THRESHOLD = 0.5  # or when the interval is fully above or below this win rate
+MIN_SAMPLES = 30  # valid judgements before a file can stop
+ROUND_SIZE = 32  # lines judged per file between two checks
+SEED = 42
 
-def checking_win_rate(filename):
+
+def load_prompts(filename):
     """
-    Process a JSONL file to compute the win rate of the summaries.
+    Read the LLM judge prompts of a JSONL file.
     Args:
         filename (str): The path to the JSONL file.
     Returns:
-        tuple: A tuple containing the filename and the win rate.
+        list: The parsed lines.
     """
-    win_count, valid_score_count = 0, 0
+    records = []
     with open(filename, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-        for line in tqdm(lines, desc=f"Processing {filename}", unit="line"):
+        for line in f:
             try:
-                data = json.loads(line.strip())
-                prompt = data.get('prompt')
-                judge_result = get_llm_judge_with_retry(prompt)
-                if judge_result:
-                    score1, score2 = judge_result
-                    valid_score_count += 1
-                    if score1 > score2:
-                        win_count += 1
+                records.append(json.loads(line.strip()))
             except json.JSONDecodeError:
                 print(f"JSONDecodeError: {line}")
-            except Exception as e:
-                print(f"Error happened: {e}")
+    return records
+
+
+def wilson_interval(wins, n, confidence=CONFIDENCE):
+    """
+    Wilson score interval of a win rate.
+    Args:
+        wins (int): The number of wins.
+        n (int): The number of valid judgements.
+        confidence (float): The confidence level.
+    Returns:
+        tuple: The lower and upper bounds, (0, 1) without judgement.
+    """
+    if n == 0:
+        return 0.0, 1.0
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    p = wins / n
+    center = (p + z * z / (2 * n)) / (1 + z * z / n)
+    margin = z / (1 + z * z / n) * (p * (1 - p) / n + z * z / (4 * n * n)) ** 0.5
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+def count_wins(judge_results):
+    """
+    Returns:
+        tuple: The number of wins and of valid judge results.
+    """
+    win_count, valid_score_count = 0, 0
+    for judge_result in judge_results:
+        if judge_result and len(judge_result) == 2:
+            score1, score2 = judge_result
+            valid_score_count += 1
+            if score1 > score2:
+                win_count += 1
+    return win_count, valid_score_count
+
+
+def is_settled(wins, n, confidence=CONFIDENCE):
+    """
+    Whether the win rate is known well enough to stop judging: its Wilson interval is narrower than
+    `TARGET_WIDTH`, or it clears `DECISION_THRESHOLD`.
+    """
+    if n < MIN_SAMPLES:
+        return False
+    low, high = wilson_interval(wins, n, confidence)
+    return high - low <= TARGET_WIDTH or low > DECISION_THRESHOLD or high < DECISION_THRESHOLD
+
 
+def checking_win_rate(filename, judge_results):
+    """
+    Compute the win rate of the summaries of a JSONL file from their judge results.
+    Args:
+        filename (str): The path to the JSONL file.
+        judge_results (list): The scores of each line, None if the judge failed or the line was not judged.
+    Returns:
+        tuple: A tuple containing the filename and the win rate.
+    """
+    win_count, valid_score_count = count_wins(judge_results)
     if valid_score_count > 0:
         win_rate = win_count / valid_score_count
-        print(f"The win rate of {filename} is: {win_rate:.2f} ({win_count}/{valid_score_count})")
+        low, high = wilson_interval(win_count, valid_score_count)
+        print(
+            f"The win rate of {filename} is: {win_rate:.2f} ({win_count}/{valid_score_count}), "
+            f"{CONFIDENCE:.0%} interval [{low:.2f}, {high:.2f}], {valid_score_count}/{len(judge_results)} lines judged"
+        )
         return filename, win_rate
     else:
         print(f"There is no valid prompt in {filename}")
         return filename, None
 
 
+def judge_adaptively(records):
+    """
+    Judge the lines of every file in a random order, `ROUND_SIZE` lines per file at a time,
+    until the win rate of the file is settled (see `is_settled`) or all its lines are judged.
+    The rounds of all the unsettled files are sent together to the judge.
+    The interval is checked after every round, so the stopping rule splits the error rate of `CONFIDENCE`
+    between the rounds of the file (Bonferroni), otherwise the repeated checks would stop too early.
+    Args:
+        records (dict): The parsed lines of each file.
+    Returns:
+        tuple: The judge results of each file (None for the lines not judged), and the lines selected in each file.
+    """
+    rng = random.Random(SEED)
+    orders = {}
+    for file_path, file_records in records.items():
+        orders[file_path] = list(range(len(file_records)))
+        rng.shuffle(orders[file_path])
+    num_selected = {file_path: 0 for file_path in records}
+    judge_results = {file_path: [None] * len(file_records) for file_path, file_records in records.items()}
+    active = [file_path for file_path in records if orders[file_path]]
+    stopping_confidence = {
+        file_path: 1 - (1 - CONFIDENCE) / max(1, math.ceil(len(file_records) / ROUND_SIZE))
+        for file_path, file_records in records.items()
+    }
+
+    while active:
+        for file_path in active:
+            num_selected[file_path] = min(num_selected[file_path] + ROUND_SIZE, len(orders[file_path]))
+        lines_by_file = {file_path: orders[file_path][:num_selected[file_path]] for file_path in active}
+        judge_results.update(judge_files(
+            {file_path: records[file_path] for file_path in active},
+            desc="Overall Progress",
+            lines_by_file=lines_by_file,
+        ))
+        active = [
+            file_path for file_path in active
+            if num_selected[file_path] < len(orders[file_path])
+            and not is_settled(*count_wins(judge_results[file_path]), stopping_confidence[file_path])
+        ]
+
+    selected = {file_path: orders[file_path][:num_selected[file_path]] for file_path in records}
+    return judge_results, selected
+
+
 def main(directory):
     """
     Main function to process all JSONL files in the given directory.
+    The lines of all the files are sent together to the async judge client, so the judge calls
+    run concurrently up to the limits set in `utils/llm_judge_utils.py`.
+    With `ADAPTIVE`, the files stop being judged once their win rate is settled.
+    The judge results are journaled as they arrive, so an interrupted run resumes where it stopped,
+    and the judge responses are cached, so the reruns do not call the judge again.
     Args:
         directory (str): The path to the directory containing JSONL files.
     """
-    file_paths = [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.jsonl')]
+    file_paths = [
+        os.path.join(directory, f) for f in os.listdir(directory)
+        if f.endswith('.jsonl') and not f.endswith('_result.jsonl')
+    ]
     print(f"checking the files: {file_paths}")
 
-    # Multi-threading, one thread per file
-    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
-        future_to_file = {executor.submit(checking_win_rate, file_path): file_path for file_path in file_paths}
-        
-        with tqdm(total=len(file_paths), desc="Overall Progress", unit="file") as pbar:
-            # wait for all threads to complete
-            for future in concurrent.futures.as_completed(future_to_file):
-                file_path = future_to_file[future]
-                try:
-                    filename, win_rate = future.result()
-                    if win_rate is not None:
-                        result_filename = filename.replace('.jsonl', '_result.jsonl')
-                        with open(result_filename, 'w', encoding='utf-8') as result_file:
-                            result_file.write(json.dumps({
-                                "filename": filename,
-                                "win_rate": win_rate,
-                            }, ensure_ascii=False))
-                except Exception as e:
-                    print(f"Error happened in {file_path} : {e}")
-                pbar.update(1)  # update progress bar
+    records = {file_path: load_prompts(file_path) for file_path in file_paths}
+    if ADAPTIVE:
+        judge_results, selected = judge_adaptively(records)
+    else:
+        judge_results = judge_files(records, desc="Overall Progress")
+        selected = {file_path: range(len(records[file_path])) for file_path in file_paths}
+
+    for file_path in file_paths:
+        try:
+            filename, win_rate = checking_win_rate(file_path, judge_results[file_path])
+            if win_rate is not None:
+                win_count, valid_score_count = count_wins(judge_results[file_path])
+                low, high = wilson_interval(win_count, valid_score_count)
+                result_filename = filename.replace('.jsonl', '_result.jsonl')
+                with open(result_filename, 'w', encoding='utf-8') as result_file:
+                    result_file.write(json.dumps({
+                        "filename": filename,
+                        "win_rate": win_rate,
+                        "confidence": CONFIDENCE,
+                        "interval": [low, high],
+                        "num_judged": valid_score_count,
+                        "num_lines": len(records[file_path]),
+                    }, ensure_ascii=False))
+            num_failed = sum(judge_results[file_path][i] is None for i in selected[file_path])
+            if num_failed == 0:
+                os.remove(journal_path(file_path))
+            else:
+                print(f"{num_failed} lines of {file_path} failed to be judged, rerun to judge them again.")
+        except Exception as e:
+            print(f"Error happened in {file_path} : {e}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,325 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+import yaml
+from utils.xlsum_store import read_records, store_path
+
+BASE_MODEL = "Qwen/Qwen2.5-3B-Instruct"
+TASKS = ["en_xlsum", "cht_xlsum", "ja_xlsum", "kr_xlsum"]
+TASKS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tasks")
+DATASET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "datasets", "xlsum_datasets")
+# the generations of every (adapter, prompt, generation kwargs) are kept here, so a rerun or an extended sweep
+# only generates the new checkpoints and docs
+GENERATION_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "summary_adapter", "sweep_generations.sqlite")
+BATCH_SIZE = 16
+# the default `max_gen_toks` of lm_eval, the task yamls do not set it
+MAX_GEN_TOKS = 256
+
+
+def load_task(task, tasks_dir=TASKS_DIR):
+    """
+    Read the prompt and generation settings of an XLSum task from its lm_eval yaml.
+    Returns:
+        dict: The task name, its language, system message, user prompt template and generation kwargs.
+    """
+    class TaskLoader(yaml.SafeLoader):
+        pass
+
+    # `!function` tags are only resolved by lm_eval, keep them as strings
+    TaskLoader.add_constructor("!function", lambda loader, node: loader.construct_scalar(node))
+    with open(os.path.join(tasks_dir, task, f"{task}.yaml"), "r", encoding="utf-8") as f:
+        config = yaml.load(f, Loader=TaskLoader)
+    generation_kwargs = dict(config.get("generation_kwargs", {}))
+    generation_kwargs.setdefault("max_gen_toks", MAX_GEN_TOKS)
+    return {
+        "name": task,
+        "lang": config["dataset_name"],
+        "description": config.get("description", ""),
+        "doc_to_text": config["doc_to_text"],
+        "generation_kwargs": generation_kwargs,
+    }
+
+
+def build_prompt(tokenizer, task, article):
+    """
+    Build the chat prompt of a doc like `lm_eval --apply_chat_template`: the task description is the system message.
+    """
+    user_content = re.sub(r"\{\{\s*text\s*\}\}", lambda _: article, task["doc_to_text"])
+    messages = [{"role": "user", "content": user_content}]
+    if task["description"]:
+        messages.insert(0, {"role": "system", "content": task["description"]})
+    return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+
+def find_checkpoints(paths):
+    """
+    Args:
+        paths (list): Adapter directories, or training output directories holding `checkpoint-<step>` adapters.
+    Returns:
+        list: The adapter directories, the checkpoints of each output directory sorted by step.
+    """
+    def step(path):
+        match = re.search(r"checkpoint-(\d+)$", path.rstrip("/"))
+        return int(match.group(1)) if match else -1
+
+    checkpoints = []
+    for path in paths:
+        if os.path.exists(os.path.join(path, "adapter_config.json")):
+            checkpoints.append(path)
+            continue
+        found = [d for d in glob.glob(os.path.join(path, "checkpoint-*")) if os.path.exists(os.path.join(d, "adapter_config.json"))]
+        if not found:
+            print(f"No adapter found in {path}")
+        checkpoints.extend(sorted(found, key=step))
+    return checkpoints
+
+
+class GenerationCache:
+    """
+    SQLite cache of the generated summaries, keyed by the adapter revision, the base model revision, the task,
+    the doc id, the hash of the rendered prompt and the generation kwargs. The prompt covers the task description,
+    `doc_to_text` and the chat template, so editing any of them generates again. The generations are committed
+    after every batch, so an interrupted sweep keeps them.
+    Args:
+        path (str): The path of the database file, created with its parent directory if missing.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS generations (key TEXT PRIMARY KEY, summary TEXT NOT NULL)")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def make_key(adapter, base_model, task, doc_id, prompt, generation_kwargs):
+        content = json.dumps(
+            {
+                "adapter": adapter,
+                "base_model": base_model,
+                "task": task,
+                "doc_id": doc_id,
+                "prompt": hashlib.sha256(prompt.encode("utf-8")).hexdigest(),
+                "generation_kwargs": generation_kwargs,
+            },
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        """
+        Returns:
+            dict: The cached summary of the keys found.
+        """
+        found = {}
+        keys = list(keys)
+        # stay under the limit of the number of SQL variables
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self.conn.execute(
+                f"SELECT key, summary FROM generations WHERE key IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall()
+            found.update(rows)
+        return found
+
+    def put_many(self, items):
+        self.conn.executemany("INSERT OR REPLACE INTO generations (key, summary) VALUES (?, ?)", items)
+        self.conn.commit()
+
+
+def generate_batch(model, tokenizer, prompts, generation_kwargs):
+    """
+    Greedy or sampled generation of a batch of prompts, post-processed like the lm_eval tasks:
+    cut at the first `until` string, then the leading whitespaces are removed.
+    """
+    import torch
+
+    until = generation_kwargs.get("until", [])
+    kwargs = {"max_new_tokens": generation_kwargs["max_gen_toks"], "do_sample": generation_kwargs.get("do_sample", False)}
+    for name in ["temperature", "top_p", "top_k"]:
+        if kwargs["do_sample"] and name in generation_kwargs:
+            kwargs[name] = generation_kwargs[name]
+    inputs = tokenizer(prompts, return_tensors="pt", padding=True, add_special_tokens=False).to(model.device)
+    with torch.inference_mode():
+        outputs = model.generate(
+            input_ids=inputs["input_ids"],
+            attention_mask=inputs["attention_mask"],
+            **kwargs,
+            stop_strings=until or None,
+            tokenizer=tokenizer,
+            pad_token_id=tokenizer.pad_token_id,
+        )
+    completions = tokenizer.batch_decode(outputs[:, inputs["input_ids"].shape[1]:], skip_special_tokens=True)
+    summaries = []
+    for completion in completions:
+        for stop in until:
+            completion = completion.split(stop)[0]
+        summaries.append(completion.lstrip())
+    return summaries
+
+
+def load_docs(task, dataset_dir=DATASET_DIR, max_docs=None):
+    """
+    Returns:
+        list: The id, article and reference summary of the test docs of the task, from the Parquet store.
+    """
+    return list(read_records(store_path(dataset_dir, task["lang"], "test"), max_rows=max_docs))
+
+
+def score_task(task, docs, summaries):
+    """
+    Score the summaries with the metrics of the lm_eval task, ROUGE-2 and the average length.
+    """
+    from eval.tasks import eval_utils
+
+    items = [(doc["summary"], summary) for doc, summary in zip(docs, summaries)]
+    rouge2_agg = getattr(eval_utils, f"{task['name'].split('_')[0]}_rouge2_agg")
+    return {"rouge2": rouge2_agg(items), "avg_by_len": eval_utils.avg_by_len(items)}
+
+
+class CheckpointSweep:
+    """
+    Evaluate a series of adapters on the XLSum tasks with a single copy of the base model.
+    The base model is loaded once, on the first checkpoint with docs left to generate, and every adapter
+    is hot-swapped onto it: the next adapter is loaded and activated, then the previous one is deleted.
+    Args:
+        base_model (str): The base model path or id.
+        tasks (list): The lm_eval task names.
+        dataset_dir (str): The directory of the XLSum Parquet store.
+        max_docs (int): The number of test docs per task, None for all of them.
+        batch_size (int): The generation batch size.
+        cache_path (str): The path of the generation cache.
+    """
+
+    def __init__(self, base_model=BASE_MODEL, tasks=TASKS, dataset_dir=DATASET_DIR, max_docs=None, batch_size=BATCH_SIZE, cache_path=GENERATION_CACHE_PATH):
+        from transformers import AutoTokenizer
+        from inference.merge_adapter import resolve_revision
+
+        self.base_model = base_model
+        self.base_revision = f"{base_model}@{resolve_revision(base_model)}"
+        self.tasks = [load_task(task) for task in tasks]
+        self.docs = {task["name"]: load_docs(task, dataset_dir, max_docs) for task in self.tasks}
+        self.batch_size = batch_size
+        self.cache = GenerationCache(cache_path)
+        # the tokenizer is loaded first, the prompts rendered with its chat template are part of the cache keys
+        self.tokenizer = AutoTokenizer.from_pretrained(base_model)
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.tokenizer.padding_side = "left"
+        self.prompts = {
+            task["name"]: [build_prompt(self.tokenizer, task, doc["article"]) for doc in self.docs[task["name"]]]
+            for task in self.tasks
+        }
+        self.model = None
+        self.active_adapter = None
+
+    def load_base(self):
+        import torch
+        from transformers import AutoModelForCausalLM
+
+        self.model = AutoModelForCausalLM.from_pretrained(
+            self.base_model, torch_dtype=torch.bfloat16, low_cpu_mem_usage=True, use_safetensors=True, device_map="auto"
+        )
+        self.model.eval()
+
+    def activate(self, adapter_dir, adapter_name):
+        """
+        Load an adapter onto the base model and make it the active one, deleting the previous adapter.
+        """
+        from peft import PeftModel
+
+        if self.model is None:
+            self.load_base()
+        if self.active_adapter is None:
+            self.model = PeftModel.from_pretrained(self.model, adapter_dir, adapter_name=adapter_name)
+        else:
+            self.model.load_adapter(adapter_dir, adapter_name=adapter_name)
+            self.model.set_adapter(adapter_name)
+            self.model.delete_adapter(self.active_adapter)
+        self.model.eval()
+        self.active_adapter = adapter_name
+
+    def doc_keys(self, adapter, task):
+        return [
+            GenerationCache.make_key(adapter, self.base_revision, task["name"], doc["id"], prompt, task["generation_kwargs"])
+            for doc, prompt in zip(self.docs[task["name"]], self.prompts[task["name"]])
+        ]
+
+    def evaluate(self, adapter_dir):
+        """
+        Evaluate one adapter on every task, generating only the docs missing from the cache.
+        Returns:
+            dict: The adapter hash, the metrics of each task and the number of new generations.
+        """
+        from inference.merge_adapter import adapter_revision
+
+        adapter = adapter_revision(adapter_dir)
+        keys = {task["name"]: self.doc_keys(adapter, task) for task in self.tasks}
+        cached = {task["name"]: self.cache.get_many(keys[task["name"]]) for task in self.tasks}
+        num_missing = sum(len(keys[name]) - len(cached[name]) for name in keys)
+        start_time = time.perf_counter()
+        if num_missing > 0:
+            self.activate(adapter_dir, f"ckpt_{adapter[:12]}")
+
+        results = {"checkpoint": adapter_dir, "adapter_hash": adapter, "generated": num_missing, "tasks": {}}
+        for task in self.tasks:
+            docs, task_keys, summaries = self.docs[task["name"]], keys[task["name"]], cached[task["name"]]
+            prompts = self.prompts[task["name"]]
+            missing = [i for i, key in enumerate(task_keys) if key not in summaries]
+            # the longest prompts first, so the batches hold prompts of similar lengths
+            missing.sort(key=lambda i: len(prompts[i]), reverse=True)
+            for start in range(0, len(missing), self.batch_size):
+                batch = missing[start:start + self.batch_size]
+                batch_summaries = generate_batch(self.model, self.tokenizer, [prompts[i] for i in batch], task["generation_kwargs"])
+                new_items = [(task_keys[i], summary) for i, summary in zip(batch, batch_summaries)]
+                self.cache.put_many(new_items)
+                summaries.update(new_items)
+            results["tasks"][task["name"]] = score_task(task, docs, [summaries[key] for key in task_keys])
+
+        results["mean_rouge2"] = sum(r["rouge2"] for r in results["tasks"].values()) / len(results["tasks"])
+        results["seconds"] = time.perf_counter() - start_time
+        return results
+
+    def run(self, checkpoints, output_path=None):
+        """
+        Evaluate every checkpoint, appending the results to `output_path` as they are computed.
+        Returns:
+            list: The results of every checkpoint.
+        """
+        all_results = []
+        for checkpoint in checkpoints:
+            results = self.evaluate(checkpoint)
+            all_results.append(results)
+            scores = ", ".join(f"{name}: {r['rouge2']:.4f}" for name, r in results["tasks"].items())
+            print(f"{checkpoint}: mean ROUGE-2 {results['mean_rouge2']:.4f} ({scores}), {results['generated']} new generations in {results['seconds']:.1f}s")
+            if output_path is not None:
+                with open(output_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(results, ensure_ascii=False) + "\n")
+        if all_results:
+            best = max(all_results, key=lambda r: r["mean_rouge2"])
+            print(f"Best checkpoint: {best['checkpoint']} (mean ROUGE-2 {best['mean_rouge2']:.4f})")
+        return all_results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate the checkpoints of a training run on the XLSum tasks, loading the base model once.")
+    parser.add_argument("paths", nargs="+", help="Adapter directories, or training output directories with checkpoint-<step> adapters.")
+    parser.add_argument("--base-model", default=BASE_MODEL)
+    parser.add_argument("--tasks", nargs="+", default=TASKS)
+    parser.add_argument("--dataset-dir", default=DATASET_DIR, help="The XLSum Parquet store written by datasets/download_datasets.py.")
+    parser.add_argument("--max-docs", type=int, default=None, help="Test docs per task, all of them by default.")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--cache-path", default=GENERATION_CACHE_PATH)
+    parser.add_argument("--output", default="./sweep_results.jsonl")
+    args = parser.parse_args()
+
+    sweep = CheckpointSweep(args.base_model, args.tasks, args.dataset_dir, args.max_docs, args.batch_size, args.cache_path)
+    sweep.run(find_checkpoints(args.paths), args.output)
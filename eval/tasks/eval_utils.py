@@ -1,51 +1,139 @@
-import re
-
-
-def _missing_module_message(name):
-    return f"`{name}` is required for `japanese_leaderboard`, please install `{name}` via pip install lm_eval[japanese_leaderboard] or pip install -e .[japanese_leaderboard]"
-
-
-try:
-    import emoji
-    import neologdn
-    from fugashi import Tagger
-    from rouge_score import rouge_scorer, scoring
-except ModuleNotFoundError as err:
-    raise ModuleNotFoundError(_missing_module_message(err.name)) from err
-
-
-class MecabTokenizer:
-    def __init__(self) -> None:
-        self.tagger = Tagger("-Owakati")
-
-    def normalize_answer(self, text):
-        """Lower case text, remove punctuation and extra whitespace, etc."""
-
-        def white_space_fix(text):
-            return " ".join(text.split())
-
-        def remove_emoji(text):
-            text = "".join(["" if emoji.is_emoji(c) else c for c in text])
-            emoji_pattern = re.compile(
-                "["
-                "\U0001f600-\U0001f64f"  # emoticons
-                "\U0001f300-\U0001f5ff"  # symbols & pictographs
-                "\U0001f680-\U0001f6ff"  # transport & map symbols
-                "\U0001f1e0-\U0001f1ff"  # flags (iOS)
-                "\U00002702-\U000027b0"
-                "]+",
-                flags=re.UNICODE,
-            )
-            return emoji_pattern.sub(r"", text)
-
-        text = remove_emoji(text)
-        # see neologdn docs for details, but handles things like full/half width variation
-        text = neologdn.normalize(text)
-        text = white_space_fix(text)
-        return text
-
-    def tokenize(self, text):
-        return self.tagger.parse(self.normalize_answer(text)).split()
+import hashlib
+import os
+import sys
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+# lm_eval loads this file without registering it in `sys.modules`, so the functions run in the process pool
+# live in `rouge_worker`, imported by its absolute name from this directory
+TASKS_DIR = os.path.dirname(os.path.abspath(__file__))
+if TASKS_DIR not in sys.path:
+    sys.path.insert(0, TASKS_DIR)
+
+from rouge_worker import score_pairs, tokenizer_version  # noqa: E402
+
+
+# below this number of pairs, the texts are tokenized in the calling process
+MIN_PARALLEL_PAIRS = 2000
+NUM_WORKERS = min(8, os.cpu_count() or 1)
+# the bootstrap of the confidence interval, the same defaults as `rouge_score.scoring.BootstrapAggregator`
+BOOTSTRAP_SAMPLES = 1000
+BOOTSTRAP_SEED = 42
+# the tokenized references of the XLSum test sets, reused by the later eval runs
+XLSUM_DATASET = "csebuetnlp/xlsum"
+REFERENCE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "summary_adapter", "eval_references")
+
+
+class ReferenceTokenCache:
+    """
+    On-disk cache of the tokenized references of a dataset and language, read with memory maps.
+    Each reference is keyed by the hash of its text (lm_eval gives the aggregations the reference, not the doc).
+    The entries are stored in immutable segments, each with the sorted 16-byte keys, the offsets of
+    the entries and the UTF-8 blob of their space-joined tokens; a run adds one segment with its new references.
+    Args:
+        cache_dir (str): The root directory of the cache.
+        dataset (str): The dataset of the references.
+        lang (str): The language, i.e. the dataset config.
+        version (str): The tokenizer version, the entries of the other versions are ignored.
+    """
+
+    def __init__(self, cache_dir, dataset, lang, version):
+        namespace = hashlib.sha256(f"{dataset}\0{lang}\0{version}".encode("utf-8")).hexdigest()[:16]
+        self.path = os.path.join(cache_dir, f"{dataset.replace('/', '--')}-{lang}-{namespace}")
+        self.segments = []
+        if os.path.isdir(self.path):
+            for name in sorted(os.listdir(self.path)):
+                segment_dir = os.path.join(self.path, name)
+                if name.startswith("seg-") and os.path.exists(os.path.join(segment_dir, "keys.npy")):
+                    self.segments.append((
+                        np.load(os.path.join(segment_dir, "keys.npy"), mmap_mode="r"),
+                        np.load(os.path.join(segment_dir, "offsets.npy"), mmap_mode="r"),
+                        self._open_blob(os.path.join(segment_dir, "tokens.bin")),
+                    ))
+
+    @staticmethod
+    def _open_blob(path):
+        # an empty file can not be memory mapped, e.g. a segment of empty references
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=np.uint8)
+        return np.memmap(path, dtype=np.uint8, mode="r")
+
+    @staticmethod
+    def make_key(text):
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def get(self, text):
+        """
+        Returns:
+            list: The tokens of the reference, None if it is not cached.
+        """
+        key = np.array(self.make_key(text), dtype="S16")
+        for keys, offsets, blob in self.segments:
+            i = int(np.searchsorted(keys, key))
+            if i < len(keys) and keys[i] == key:
+                joined = bytes(blob[offsets[i]:offsets[i + 1]]).decode("utf-8")
+                return joined.split(" ") if joined else []
+        return None
+
+    def add(self, texts, tokens):
+        """
+        Write the tokens of new references as a new segment. The segment is written in a temporary
+        directory and renamed, so a crashed run never leaves a partial segment.
+        """
+        entries = {self.make_key(text): " ".join(t).encode("utf-8") for text, t in zip(texts, tokens)}
+        if not entries:
+            return
+        keys = np.array(list(entries), dtype="S16")
+        order = np.argsort(keys, kind="stable")
+        encoded = list(entries.values())
+        encoded = [encoded[i] for i in order]
+        offsets = np.zeros(len(entries) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        os.makedirs(self.path, exist_ok=True)
+        name = f"seg-{uuid.uuid4().hex}"
+        tmp_dir = os.path.join(self.path, f"tmp-{name}")
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, "keys.npy"), keys[order])
+        np.save(os.path.join(tmp_dir, "offsets.npy"), offsets)
+        with open(os.path.join(tmp_dir, "tokens.bin"), "wb") as f:
+            f.write(b"".join(encoded))
+        os.replace(tmp_dir, os.path.join(self.path, name))
+
+
+def parallel_scores(pairs, n=2, num_workers=NUM_WORKERS):
+    """
+    Score the pairs in a process pool, in contiguous chunks, one per worker.
+    Returns:
+        tuple: The ROUGE-N F-measure of every pair as a np.ndarray, and the tokens of the references given as text.
+    """
+    if len(pairs) < MIN_PARALLEL_PAIRS or num_workers <= 1:
+        scores, ref_tokens = score_pairs(pairs, n)
+        return np.array(scores, dtype=np.float64), ref_tokens
+    chunk_size = -(-len(pairs) // num_workers)
+    chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+    scores, ref_tokens = [], []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        for chunk_scores, chunk_ref_tokens in executor.map(score_pairs, chunks, [n] * len(chunks)):
+            scores.extend(chunk_scores)
+            ref_tokens.extend(chunk_ref_tokens)
+    return np.array(scores, dtype=np.float64), ref_tokens
+
+
+def bootstrap_mid(scores, n_samples=BOOTSTRAP_SAMPLES, seed=BOOTSTRAP_SEED, block_size=100):
+    """
+    The median of the bootstrap resampled means of the scores, i.e. the `mid` of `BootstrapAggregator`.
+    The resamples are drawn `block_size` at a time, to bound the memory of the index matrix.
+    """
+    rng = np.random.default_rng(seed)
+    means = np.empty(n_samples, dtype=np.float64)
+    for start in range(0, n_samples, block_size):
+        size = min(block_size, n_samples - start)
+        indices = rng.integers(0, len(scores), size=(size, len(scores)))
+        means[start:start + size] = scores[indices].mean(axis=1)
+    return float(np.percentile(means, 50))
 
 
 def resp_avg_len(items):
@@ -63,24 +151,39 @@ def rouge2(items):
     return items
 
 
-def rouge2_agg(items):
-    tokenizer = MecabTokenizer()
+def rouge2_agg(items, lang=None, dataset=XLSUM_DATASET, cache_dir=REFERENCE_CACHE_DIR):
+    """
+    The mecab-based ROUGE-2 of the predictions. With `lang`, the tokenized references are read from
+    and added to the reference cache, so only the predictions are tokenized on the later runs.
+    """
+    cache = ReferenceTokenCache(cache_dir, dataset, lang, tokenizer_version()) if lang is not None else None
+    pairs, new_refs = [], []
+    for ref, pred in items:
+        tokens = cache.get(ref) if cache is not None else None
+        if tokens is None:
+            new_refs.append(ref)
+        pairs.append((ref if tokens is None else tokens, pred))
 
-    refs = list(zip(*items))[0]
-    preds = list(zip(*items))[1]
+    scores, new_ref_tokens = parallel_scores(pairs, n=2)
+    if cache is not None:
+        cache.add(new_refs, new_ref_tokens)
+    if len(scores) == 0:
+        return 0.0
+    # the mid of the bootstrap confidence interval
+    return bootstrap_mid(scores)
+
+
+def en_rouge2_agg(items):
+    return rouge2_agg(items, lang="english")
+
+
+def cht_rouge2_agg(items):
+    return rouge2_agg(items, lang="chinese_traditional")
 
-    rouge_type = "rouge2"
 
-    # mecab-based rouge
-    scorer = rouge_scorer.RougeScorer(
-        rouge_types=[rouge_type],
-        tokenizer=tokenizer,
-    )
+def ja_rouge2_agg(items):
+    return rouge2_agg(items, lang="japanese")
 
-    # Acumulate confidence intervals.
-    aggregator = scoring.BootstrapAggregator()
-    for ref, pred in zip(refs, preds):
-        aggregator.add_scores(scorer.score(ref, pred))
-    result = aggregator.aggregate()
 
-    return result[rouge_type].mid.fmeasure
+def kr_rouge2_agg(items):
+    return rouge2_agg(items, lang="korean")
@@ -1,27 +1,68 @@
+import atexit
 import os
 import json
+import yaml
+from utils.judge_prompts import LLM_JUDGE_PROMPT_TEMPLATE
 
+# the records are written in batches of this size, and at exit
+FLUSH_EVERY = 64
+OUTPUT_PREFIX = "./llm_judge_prompts"
 
-LLM_JUDGE_PROMPT_TEMPLATE = """You are an expert in summarization. I will give you the original text and two candidate summaries. Please help me score these summaries.
-The scoring criteria are:
-1. Whether the summarization concisely and accurately expresses the meaning of the original text
-2. Whether the language of the summarization is consistent with the original text.
-3. The score needs to be between 0-10
 
-Output format:
-1. summary1: [[4]], summary2: [[5]]
-2. do not output any explanation and other text
+def load_task_config(config_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "resp_gen.yaml")):
+    """
+    Read the dataset language of the task from its yaml file, `process_results` does not receive it from lm_eval.
+    The generation parameters are not read: `--gen_kwargs` overrides them without changing the yaml,
+    and lm_eval does not pass the ones used to `process_results`.
+    Returns:
+        dict: The `lang` of the task.
+    """
+    class TaskLoader(yaml.SafeLoader):
+        pass
 
-original text:
-{original_text}
+    # `!function` tags are only resolved by lm_eval, keep them as strings
+    TaskLoader.add_constructor("!function", lambda loader, node: loader.construct_scalar(node))
+    with open(config_path, "r", encoding="utf-8") as f:
+        config = yaml.load(f, Loader=TaskLoader)
+    return {"lang": config.get("dataset_name")}
+
+
+class JudgePromptWriter:
+    """
+    Buffered JSONL sink of the judge prompts, one per process.
+    Under `accelerate launch` every rank writes its own `<prefix>_rank<rank>.jsonl` shard,
+    so the appends of the processes never interleave; a single process writes `<prefix>.jsonl`.
+    Args:
+        prefix (str): The path of the output without the extension.
+        flush_every (int): The number of records buffered before they are appended to the file.
+    """
+
+    def __init__(self, prefix=OUTPUT_PREFIX, flush_every=FLUSH_EVERY):
+        rank = int(os.environ.get("RANK", 0))
+        world_size = int(os.environ.get("WORLD_SIZE", 1))
+        self.path = f"{prefix}_rank{rank}.jsonl" if world_size > 1 else f"{prefix}.jsonl"
+        self.flush_every = flush_every
+        self.buffer = []
+        atexit.register(self.flush)
+
+    def write(self, record):
+        self.buffer.append(json.dumps(record, ensure_ascii=False) + "\n")
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        with open(self.path, "a", encoding="utf-8") as json_file:
+            json_file.writelines(self.buffer)
+        self.buffer = []
+
+
+TASK_CONFIG = load_task_config()
+writer = JudgePromptWriter()
 
-candidate summaries:
-1. {summary}
-2. {response0}
-"""
 
 def process_results(doc, results):
-    p_id = doc["id"]
     original_text = doc["text"]
     summary = doc["summary"]
     prompt = LLM_JUDGE_PROMPT_TEMPLATE.format(
@@ -29,9 +70,16 @@ def process_results(doc, results):
         summary=summary,
         response0=results[0],
     )
-    with open("./llm_judge_prompts.jsonl", "a", encoding="utf-8") as json_file:
-        json_file.write(json.dumps({"id": p_id, "prompt": prompt}, ensure_ascii=False) + "\n")
+    # the fields are kept next to the prompt, so the preference dataset is built without parsing the prompt
+    writer.write({
+        "id": doc["id"],
+        "prompt": prompt,
+        "text": original_text,
+        "reference": summary,
+        "candidate": results[0],
+        "lang": TASK_CONFIG["lang"],
+    })
 
     return {
         "acc": 1
-    }
\ No newline at end of file
+    }
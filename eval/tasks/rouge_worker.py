@@ -0,0 +1,119 @@
+"""
+The tokenizer and the ROUGE scoring run in the worker processes of `eval_utils.parallel_scores`.
+lm_eval loads `eval_utils` from its file without registering it in `sys.modules`, so its functions
+can not be pickled; this module is imported by its absolute name and its functions can.
+"""
+import importlib.metadata
+import re
+from collections import Counter
+
+
+def _missing_module_message(name):
+    return f"`{name}` is required for `japanese_leaderboard`, please install `{name}` via pip install lm_eval[japanese_leaderboard] or pip install -e .[japanese_leaderboard]"
+
+
+try:
+    import emoji
+    import neologdn
+    from fugashi import Tagger
+except ModuleNotFoundError as err:
+    raise ModuleNotFoundError(_missing_module_message(err.name)) from err
+
+
+# the single code point emojis removed one by one before, and the emoji ranges, compiled once
+EMOJI_PATTERN = re.compile(
+    "["
+    + "".join(re.escape(c) for c in emoji.EMOJI_DATA if len(c) == 1)
+    + "\U0001f600-\U0001f64f"  # emoticons
+    "\U0001f300-\U0001f5ff"  # symbols & pictographs
+    "\U0001f680-\U0001f6ff"  # transport & map symbols
+    "\U0001f1e0-\U0001f1ff"  # flags (iOS)
+    "\U00002702-\U000027b0"
+    "]+",
+    flags=re.UNICODE,
+)
+
+# bump when `MecabTokenizer.normalize_answer` or `tokenize` change
+NORMALIZER_VERSION = 1
+
+
+class MecabTokenizer:
+    def __init__(self) -> None:
+        self.tagger = Tagger("-Owakati")
+
+    def normalize_answer(self, text):
+        """Lower case text, remove punctuation and extra whitespace, etc."""
+
+        def white_space_fix(text):
+            return " ".join(text.split())
+
+        def remove_emoji(text):
+            return EMOJI_PATTERN.sub(r"", text)
+
+        text = remove_emoji(text)
+        # see neologdn docs for details, but handles things like full/half width variation
+        text = neologdn.normalize(text)
+        text = white_space_fix(text)
+        return text
+
+    def tokenize(self, text):
+        return self.tagger.parse(self.normalize_answer(text)).split()
+
+
+_tokenizer = None
+
+
+def _get_tokenizer():
+    # one tokenizer per process, shared by all the aggregations
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = MecabTokenizer()
+    return _tokenizer
+
+
+def tokenizer_version():
+    """
+    Returns:
+        str: The versions of the normalizers, MeCab and its dictionary, identifying the tokens of a text.
+    """
+    packages = [f"{name}={importlib.metadata.version(name)}" for name in ["emoji", "neologdn", "fugashi"]]
+    dictionaries = [f"{d.get('filename')}:{d.get('version')}" for d in _get_tokenizer().tagger.dictionary_info]
+    return f"normalizer={NORMALIZER_VERSION}," + ",".join(packages) + ",dictionaries=" + ";".join(dictionaries)
+
+
+def ngram_counts(tokens, n):
+    return Counter(zip(*(tokens[i:] for i in range(n))))
+
+
+def rouge_n_fmeasure(ref_tokens, pred_tokens, n=2):
+    """
+    The ROUGE-N F-measure of a prediction, computed like `rouge_score.rouge_scorer`.
+    """
+    ref_ngrams = ngram_counts(ref_tokens, n)
+    pred_ngrams = ngram_counts(pred_tokens, n)
+    ref_total = sum(ref_ngrams.values())
+    pred_total = sum(pred_ngrams.values())
+    if ref_total == 0 or pred_total == 0:
+        return 0.0
+    overlap = sum((ref_ngrams & pred_ngrams).values())
+    precision = overlap / pred_total
+    recall = overlap / ref_total
+    return 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+
+
+def score_pairs(pairs, n=2):
+    """
+    Tokenize every reference and prediction once and score them, run in a worker process for the large inputs.
+    Args:
+        pairs (list): The (reference, prediction) pairs, the reference is a text or its cached tokens.
+    Returns:
+        tuple: The ROUGE-N F-measure of every pair, and the tokens of the references given as text, in order.
+    """
+    tokenizer = _get_tokenizer()
+    scores, ref_tokens = [], []
+    for ref, pred in pairs:
+        if isinstance(ref, str):
+            ref = tokenizer.tokenize(ref)
+            ref_tokens.append(ref)
+        scores.append(rouge_n_fmeasure(ref, tokenizer.tokenize(pred), n))
+    return scores, ref_tokens
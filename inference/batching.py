@@ -0,0 +1,119 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class BatchingEngine:
+    """
+    Groups concurrent summarization requests into micro-batches.
+    Callers submit texts and get a future back, a background thread collects
+    the queued requests into batches of at most `max_batch_size`, waiting at most
+    `max_wait_ms` after the first request arrives, and runs them with `batch_fn`.
+    Args:
+        batch_fn (callable): Function taking a list of texts and a list of adapter names, returning a list of summaries.
+        max_batch_size (int): The maximum number of requests in one batch.
+        max_wait_ms (float): How long to wait for more requests before running a partial batch.
+        validate_fn (callable): Function taking the adapter name of a request and raising ValueError if it can not
+            be served, called at submission so an invalid request fails alone instead of failing its batch.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=8, max_wait_ms=10, validate_fn=None):
+        self.batch_fn = batch_fn
+        self.validate_fn = validate_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._queue = queue.Queue()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, text, adapter=None):
+        """
+        Put a text into the request queue.
+        Requests using different adapters can be grouped into the same batch.
+        Args:
+            text (str): The input text to be summarized.
+            adapter (str): The name of the adapter to use, None for the default adapter.
+        Returns:
+            Future: A future resolving to the generated summary, failed at once if `validate_fn` rejects the request.
+        """
+        if self._closed:
+            raise RuntimeError("BatchingEngine is closed.")
+        future = Future()
+        if self.validate_fn is not None:
+            try:
+                self.validate_fn(adapter)
+            except ValueError as e:
+                future.set_running_or_notify_cancel()
+                future.set_exception(e)
+                return future
+        self._queue.put((text, adapter, future))
+        return future
+
+    def close(self):
+        """
+        Stop the background thread after the queued requests are finished.
+        """
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._worker.join()
+
+    def _collect_batch(self):
+        """
+        Block until one request is available, then gather more requests until
+        the batch is full or the waiting time is over.
+        Returns:
+            list: (text, adapter, future) tuples, or None if the engine is closed.
+        """
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                # put the sentinel back so the loop stops after this batch
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            if batch is None:
+                break
+            # skip the requests cancelled by the callers while waiting
+            batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        """
+        Run a batch and resolve its futures. When the batch fails, its requests are run again one by one,
+        so only the failing requests get the exception.
+        """
+        texts, adapters, futures = zip(*batch)
+        try:
+            results = self.batch_fn(list(texts), list(adapters))
+            if len(results) != len(futures):
+                raise RuntimeError(f"batch_fn returned {len(results)} results for {len(futures)} requests.")
+        except Exception as e:
+            if len(batch) > 1:
+                for item in batch:
+                    self._run_batch([item])
+            else:
+                futures[0].set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            future.set_result(result)
@@ -0,0 +1,280 @@
+import argparse
+import itertools
+import json
+import logging
+import math
+import os
+import threading
+import time
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast, Qwen2Config, Qwen2ForCausalLM
+import inference.summerization_assistant as assistant
+from inference.batching import BatchingEngine
+from inference.budget import LengthBudget
+from inference.samples import load_sample_articles
+from utils.xlsum_store import read_records
+
+
+# the chat format of Qwen2.5, without the tool calls
+TINY_CHAT_TEMPLATE = (
+    "{% for message in messages %}"
+    "{{ '<|im_start|>' + message['role'] + '\n' + message['content'] + '<|im_end|>' + '\n' }}"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}{{ '<|im_start|>assistant\n' }}{% endif %}"
+)
+TINY_MAX_NEW_TOKENS = 64
+
+
+def build_tiny_tokenizer():
+    """
+    Build a byte-level tokenizer with the special tokens and chat template of Qwen2.5, without any download.
+    Every byte is one token, so the prompts are longer than with the real tokenizer.
+    Returns:
+        PreTrainedTokenizerFast: The tokenizer, padding on the left.
+    """
+    vocab = {c: i for i, c in enumerate(sorted(pre_tokenizers.ByteLevel.alphabet()))}
+    backend = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = decoders.ByteLevel()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        eos_token="<|im_end|>",
+        pad_token="<|endoftext|>",
+        additional_special_tokens=["<|im_start|>"],
+    )
+    tokenizer.chat_template = TINY_CHAT_TEMPLATE
+    tokenizer.padding_side = "left"
+    return tokenizer
+
+
+def build_tiny_model(tokenizer, seed=0):
+    """
+    Build a randomly initialised Qwen2 model small enough to run the benchmark on CPU.
+    The summaries are meaningless, but every stage of the serving code runs as with the real model.
+    Args:
+        tokenizer (PreTrainedTokenizer): The tokenizer from `build_tiny_tokenizer`.
+        seed (int): The seed of the weights.
+    Returns:
+        PreTrainedModel: The model.
+    """
+    config = Qwen2Config(
+        vocab_size=len(tokenizer),
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=32768,
+        tie_word_embeddings=True,
+        bos_token_id=None,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    torch.manual_seed(seed)
+    model = Qwen2ForCausalLM(config)
+    model.eval()
+    return model
+
+
+def load_xlsum_articles(file_path, max_samples=None):
+    """
+    Load the articles of an XLSum split of the store written by `datasets/download_datasets.py`.
+    Args:
+        file_path (str): The path of the split, e.g. `xlsum_datasets/english/test.parquet`.
+        max_samples (int): The number of articles to read, None to read all of them.
+    Returns:
+        list: Dicts with the language (the directory name), id, text and reference summary of each article.
+    """
+    lang = os.path.basename(os.path.dirname(os.path.abspath(file_path)))
+    return [
+        {"lang": lang, "id": record["id"], "text": record["article"], "reference": record["summary"]}
+        for record in read_records(file_path, max_rows=max_samples)
+    ]
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile, None for an empty list.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+def summarize_records(records, elapsed):
+    """
+    Aggregate the measurements of the requests of one run.
+    Args:
+        records (list): Dicts with the language, latency, time-to-first-token and number of tokens of each request.
+        elapsed (float): The wall time of the run in seconds.
+    Returns:
+        dict: The overall throughput, and the latency percentiles of every language in milliseconds.
+    """
+    def latency_stats(group):
+        latencies = [r["latency"] * 1000 for r in group]
+        ttfts = [r["ttft"] * 1000 for r in group if r["ttft"] is not None]
+        stats = {"num_requests": len(group), "generated_tokens": sum(r["num_tokens"] for r in group)}
+        for q in (50, 95, 99):
+            stats[f"p{q}_latency_ms"] = percentile(latencies, q / 100)
+        for q in (50, 95, 99):
+            stats[f"p{q}_ttft_ms"] = percentile(ttfts, q / 100)
+        # the decode speed seen by a single client
+        stats["mean_request_tokens_per_sec"] = sum(r["num_tokens"] / r["latency"] for r in group) / len(group)
+        return stats
+
+    summary = {
+        "elapsed_sec": elapsed,
+        "requests_per_sec": len(records) / elapsed,
+        "tokens_per_sec": sum(r["num_tokens"] for r in records) / elapsed,
+        **latency_stats(records),
+        "languages": {},
+    }
+    for lang in sorted({r["lang"] for r in records}):
+        summary["languages"][lang] = latency_stats([r for r in records if r["lang"] == lang])
+    return summary
+
+
+def replay(samples, concurrency, request_fn):
+    """
+    Send the samples from `concurrency` client threads, each one sending its next request
+    as soon as the previous one is answered.
+    Args:
+        samples (list): The articles to summarize.
+        concurrency (int): The number of clients.
+        request_fn (callable): Function summarizing one text, returning the number of generated tokens
+            and the time-to-first-token (None if it is not measured).
+    Returns:
+        tuple: The measurements of every request, and the wall time of the run in seconds.
+    """
+    records = [None] * len(samples)
+    next_index = itertools.count()
+
+    def client():
+        while True:
+            i = next(next_index)
+            if i >= len(samples):
+                return
+            start = time.perf_counter()
+            num_tokens, ttft = request_fn(samples[i]["text"])
+            latency = time.perf_counter() - start
+            records[i] = {"lang": samples[i]["lang"], "latency": latency, "ttft": ttft, "num_tokens": num_tokens}
+
+    start = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return records, time.perf_counter() - start
+
+
+def run_batched(samples, concurrency, batch_size):
+    """
+    Replay the samples through a `BatchingEngine`, the way `sub_thread_chatbot` serves them.
+    The summary cache is bypassed, so the repeated articles are generated every time.
+    """
+    engine = BatchingEngine(assistant.generate_summaries_uncached, max_batch_size=batch_size, max_wait_ms=assistant.MAX_WAIT_MS)
+
+    def request_fn(text):
+        summary = engine.submit(text).result()
+        return len(assistant.tokenizer(summary, add_special_tokens=False)["input_ids"]), None
+
+    try:
+        return replay(samples, concurrency, request_fn)
+    finally:
+        engine.close()
+
+
+def run_streaming(samples, concurrency):
+    """
+    Replay the samples through `generate_summary_stream`, one `generate` call per request,
+    measuring the time-to-first-token.
+    """
+    def request_fn(text):
+        stream = assistant.generate_summary_stream(text)
+        for _ in stream:
+            pass
+        return stream.stats.num_tokens, stream.stats.time_to_first_token
+
+    return replay(samples, concurrency, request_fn)
+
+
+def run_benchmark(samples, concurrency_levels=(1, 4, 8), batch_sizes=(1, 4, 8), streaming=True):
+    """
+    Sweep the concurrency and the batch size of the batched serving, and the concurrency of the streaming one.
+    The assistant must be initialised with `init_assistant`.
+    Args:
+        samples (list): The articles to summarize, with their language.
+        concurrency_levels (list): The numbers of concurrent clients.
+        batch_sizes (list): The maximum batch sizes of the batching engine.
+        streaming (bool): Also measure the time-to-first-token with the streaming generation.
+    Returns:
+        dict: The report of every run.
+    """
+    report = {
+        "model": type(assistant.model).__name__,
+        "device": str(assistant.model.device),
+        "generation_params": assistant.GENERATION_PARAMS,
+        "num_requests": len(samples),
+        "runs": [],
+    }
+    for concurrency, batch_size in itertools.product(concurrency_levels, batch_sizes):
+        print(f"batched: concurrency={concurrency} batch_size={batch_size}")
+        records, elapsed = run_batched(samples, concurrency, batch_size)
+        report["runs"].append({"mode": "batched", "concurrency": concurrency, "batch_size": batch_size, **summarize_records(records, elapsed)})
+    if streaming:
+        for concurrency in concurrency_levels:
+            print(f"streaming: concurrency={concurrency}")
+            records, elapsed = run_streaming(samples, concurrency)
+            report["runs"].append({"mode": "streaming", "concurrency": concurrency, "batch_size": 1, **summarize_records(records, elapsed)})
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the throughput and latency of the summarization assistant.")
+    parser.add_argument("--xlsum", nargs="*", default=None, help="XLSum splits to replay instead of the eval sample articles.")
+    parser.add_argument("--max-samples", type=int, default=None, help="The number of articles read from each XLSum split.")
+    parser.add_argument("--repeat", type=int, default=1, help="Replay the articles this many times.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--no-streaming", action="store_true", help="Skip the time-to-first-token runs.")
+    parser.add_argument("--tiny", action="store_true", help="Run offline with a tiny randomly initialised Qwen2 model.")
+    parser.add_argument("--max-new-tokens", type=int, default=None, help="Fixed length budget, the default one of the tiny model is 64.")
+    parser.add_argument("--greedy", action="store_true", help="Use greedy decoding instead of GENERATION_PARAMS.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Write the JSON report to this file instead of stdout.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.xlsum:
+        samples = [sample for file_path in args.xlsum for sample in load_xlsum_articles(file_path, args.max_samples)]
+    else:
+        samples = load_sample_articles()
+    samples = samples * args.repeat
+    if args.greedy:
+        assistant.GENERATION_PARAMS = {"do_sample": False}
+    torch.manual_seed(args.seed)
+
+    if args.tiny:
+        # the random model never stops on its own, every request hits the length budget
+        logging.getLogger().setLevel(logging.ERROR)
+        tokenizer = build_tiny_tokenizer()
+        assistant.init_assistant(tokenizer_override=tokenizer, model_override=build_tiny_model(tokenizer, args.seed))
+    else:
+        assistant.init_assistant()
+    max_new_tokens = args.max_new_tokens or (TINY_MAX_NEW_TOKENS if args.tiny else None)
+    if max_new_tokens is not None:
+        # without statistics every language gets the default budget
+        assistant.length_budget = LengthBudget(default_max_new_tokens=max_new_tokens)
+
+    report = run_benchmark(samples, args.concurrency, args.batch_sizes, streaming=not args.no_streaming)
+    assistant.batching_engine.close()
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
@@ -0,0 +1,224 @@
+import json
+import logging
+import math
+import os
+import threading
+import torch
+from transformers import StoppingCriteria
+from utils.xlsum_store import read_records, store_path
+
+
+LANGS = ["chinese_traditional", "english", "japanese", "korean"]
+
+
+def detect_language(text):
+    """
+    Guess the XLSum language of a text from the scripts of its characters.
+    Args:
+        text (str): The input text.
+    Returns:
+        str: One of `LANGS`.
+    """
+    hangul, kana, han = 0, 0, 0
+    for c in text:
+        code = ord(c)
+        if 0xAC00 <= code <= 0xD7AF or 0x1100 <= code <= 0x11FF:
+            hangul += 1
+        elif 0x3040 <= code <= 0x30FF:
+            kana += 1
+        elif 0x4E00 <= code <= 0x9FFF:
+            han += 1
+    if hangul > 0 and hangul >= han:
+        return "korean"
+    if kana > 0:
+        return "japanese"
+    if han > 0:
+        return "chinese_traditional"
+    return "english"
+
+
+def completion_length(tokens, stop_token_ids):
+    """
+    Args:
+        tokens (list): The generated token ids of one request.
+        stop_token_ids (list): The eos and pad token ids.
+    Returns:
+        int: The number of generated tokens before the first stop token.
+    """
+    return next((i for i, token in enumerate(tokens) if token in stop_token_ids), len(tokens))
+
+
+def _quantile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def compute_length_stats(tokenizer, dataset_dir, max_samples=2000, quantile=0.99):
+    """
+    Measure the reference summary lengths of the downloaded XLSum train splits.
+    Args:
+        tokenizer (PreTrainedTokenizer): The tokenizer of the model.
+        dataset_dir (str): The directory written by `datasets/download_datasets.py`.
+        max_samples (int): The number of samples read per language.
+        quantile (float): The quantile of the lengths kept as the budget.
+    Returns:
+        dict: For each language, the quantile of the summary length in tokens and of the summary/text length ratio.
+    """
+    stats = {}
+    for lang in LANGS:
+        input_file = store_path(dataset_dir, lang, "train")
+        if not os.path.exists(input_file):
+            print(f"File not found: {input_file}")
+            continue
+        records = list(read_records(input_file, columns=["article", "summary"], max_rows=max_samples))
+        texts = [record["article"] for record in records]
+        summaries = [record["summary"] for record in records]
+        text_lengths = [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+        summary_lengths = [len(ids) for ids in tokenizer(summaries, add_special_tokens=False)["input_ids"]]
+        stats[lang] = {
+            "summary_tokens": _quantile(summary_lengths, quantile),
+            "summary_ratio": _quantile([s / max(t, 1) for s, t in zip(summary_lengths, text_lengths)], quantile),
+        }
+    return stats
+
+
+class LengthBudget:
+    """
+    Sets the maximum number of new tokens of a request from its input length and language.
+    The budget follows the summary/text ratio of the reference summaries, bounded by the longest
+    reference summaries of the language, both with some headroom.
+    Args:
+        stats (dict): The output of `compute_length_stats`.
+        headroom (float): The factor applied on the reference lengths.
+        min_new_tokens (int): The smallest budget, for very short inputs.
+        default_max_new_tokens (int): The budget of languages without statistics.
+    """
+
+    def __init__(self, stats=None, headroom=1.5, min_new_tokens=32, default_max_new_tokens=512):
+        self.stats = stats or {}
+        self.headroom = headroom
+        self.min_new_tokens = min_new_tokens
+        self.default_max_new_tokens = default_max_new_tokens
+        self._lock = threading.Lock()
+        self.num_requests = 0
+        self.num_hit_budget = 0
+        self.num_stopped_repetition = 0
+
+    @classmethod
+    def load_or_compute(cls, tokenizer, dataset_dir, stats_path, **kwargs):
+        """
+        Load the length statistics from `stats_path`, computing and saving them on the first call.
+        Without the downloaded datasets, the default budget is used for every language.
+        """
+        if os.path.exists(stats_path):
+            with open(stats_path, 'r', encoding='utf-8') as f:
+                stats = json.load(f)
+        else:
+            stats = compute_length_stats(tokenizer, dataset_dir)
+            if stats:
+                with open(stats_path, 'w', encoding='utf-8') as f:
+                    json.dump(stats, f, indent=2)
+            else:
+                print(f"No XLSum datasets in {dataset_dir}, using the default length budget.")
+        return cls(stats, **kwargs)
+
+    def as_dict(self):
+        """
+        Returns:
+            dict: The settings deciding the budgets, e.g. to key the cached summaries.
+        """
+        return {
+            "stats": self.stats,
+            "headroom": self.headroom,
+            "min_new_tokens": self.min_new_tokens,
+            "default_max_new_tokens": self.default_max_new_tokens,
+        }
+
+    def __call__(self, input_length, lang):
+        """
+        Args:
+            input_length (int): The number of tokens of the article.
+            lang (str): The language of the article.
+        Returns:
+            int: The maximum number of new tokens.
+        """
+        if lang not in self.stats:
+            return self.default_max_new_tokens
+        lang_stats = self.stats[lang]
+        max_new_tokens = math.ceil(lang_stats["summary_tokens"] * self.headroom)
+        by_ratio = math.ceil(lang_stats["summary_ratio"] * input_length * self.headroom)
+        return max(self.min_new_tokens, min(max_new_tokens, by_ratio))
+
+    def record(self, completions, budgets, stop_token_ids, stopped_repetition=0):
+        """
+        Count the requests which used their whole budget without emitting a stop token.
+        Args:
+            completions (torch.Tensor): The generated tokens, without the prompt.
+            budgets (list): The budget of each request.
+            stop_token_ids (list): The eos and pad token ids.
+            stopped_repetition (int): The number of requests stopped by the repetition check.
+        """
+        hit = 0
+        for tokens, budget in zip(completions.tolist(), budgets):
+            if completion_length(tokens, stop_token_ids) >= budget:
+                hit += 1
+        with self._lock:
+            self.num_requests += len(budgets)
+            self.num_hit_budget += hit
+            self.num_stopped_repetition += stopped_repetition
+            if hit or stopped_repetition:
+                logging.warning(
+                    f"{self.num_hit_budget}/{self.num_requests} requests hit the length budget, "
+                    f"{self.num_stopped_repetition}/{self.num_requests} stopped by repetition."
+                )
+
+
+class BudgetStoppingCriteria(StoppingCriteria):
+    """
+    Stops each sequence of a batch at its own budget, and stops sequences looping on the same
+    n-gram, e.g. a phrase repeated `max_repeats` times in a row.
+    Args:
+        prompt_length (int): The length of the (padded) prompt.
+        budgets (list): The maximum number of new tokens of each sequence.
+        stop_token_ids (list): The eos and pad token ids, sequences containing them are finished.
+        max_period (int): The longest repeated n-gram checked.
+        max_repeats (int): The number of consecutive repeats treated as a runaway output.
+        min_window (int): The minimum number of repeating tokens, so the short periods need more repeats:
+            Qwen2 tokenizes the digits one by one, "1000000" or "...." are not runaway outputs.
+    """
+
+    def __init__(self, prompt_length, budgets, stop_token_ids, max_period=16, max_repeats=4, min_window=24):
+        self.prompt_length = prompt_length
+        self.budgets = budgets
+        self.stop_token_ids = stop_token_ids
+        self.max_period = max_period
+        self.max_repeats = max_repeats
+        self.min_window = min_window
+        self.repetition_stopped = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids[:, self.prompt_length:]
+        num_generated = generated.shape[1]
+        budgets = torch.tensor(self.budgets, device=input_ids.device)
+        is_done = num_generated >= budgets
+
+        repeating = torch.zeros_like(is_done)
+        for period in range(1, self.max_period + 1):
+            window = max(period * self.max_repeats, self.min_window)
+            if window > num_generated:
+                break
+            tail = generated[:, -window:]
+            repeating |= (tail[:, period:] == tail[:, :-period]).all(dim=1)
+        # the finished sequences are filled with padding, which is not a runaway output
+        finished = torch.isin(generated, torch.tensor(self.stop_token_ids, device=input_ids.device)).any(dim=1)
+        repeating &= ~finished
+        if self.repetition_stopped is None:
+            self.repetition_stopped = torch.zeros_like(is_done)
+        self.repetition_stopped |= repeating & ~is_done
+        return is_done | repeating
+
+    @property
+    def num_stopped_repetition(self):
+        if self.repetition_stopped is None:
+            return 0
+        return int(self.repetition_stopped.sum())
@@ -0,0 +1,136 @@
+import gc
+import json
+import os
+import time
+import torch
+from collections import Counter
+from transformers import AutoTokenizer
+from utils.prompts import SYSTEM_MSG, USER_PROMPT_PREFIX
+from inference.merge_adapter import load_merged_model
+from inference.samples import load_sample_articles
+
+
+BASE_MODEL = "Qwen/Qwen2.5-3B-Instruct"
+PEFT_MODEL_PATH = "chenguang-wang/Qwen2.5-3B-Instruct-summary-sft-adapter"
+MAX_NEW_TOKENS = 128
+
+
+def setup_cpu_threads(num_threads=None):
+    """
+    Use one intra-op thread per physical core, hyper-threads do not speed up the matmuls.
+    Args:
+        num_threads (int): The number of threads, None to use half of the logical cores.
+    Returns:
+        int: The number of threads used.
+    """
+    if num_threads is None:
+        num_threads = max(1, (os.cpu_count() or 2) // 2)
+    torch.set_num_threads(num_threads)
+    try:
+        # a single request is decoded at a time, inter-op parallelism only adds contention
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # can only be set before any parallel work has started
+        pass
+    return num_threads
+
+
+def load_cpu_model(base_model, adapter_path, quantize=True, compile_decode=False, num_threads=None):
+    """
+    Load the model for CPU inference: the adapter is merged into the base weights,
+    then the linear layers are quantized to int8 with dynamic activation quantization.
+    Args:
+        base_model (str): The base model path or id.
+        adapter_path (str): The adapter path or id.
+        quantize (bool): Quantize the linear layers, otherwise keep the bf16 weights.
+        compile_decode (bool): Compile the forward pass used by every decoding step with `torch.compile`.
+        num_threads (int): The number of threads, None to use half of the logical cores.
+    Returns:
+        PreTrainedModel: The model ready for inference on CPU.
+    """
+    setup_cpu_threads(num_threads)
+    # dynamic quantization works on float32 linear layers
+    torch_dtype = torch.float32 if quantize else torch.bfloat16
+    model = load_merged_model(base_model, adapter_path, torch_dtype=torch_dtype, device_map="cpu")
+    model.eval()
+    if quantize:
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if compile_decode:
+        model.forward = torch.compile(model.forward, dynamic=True)
+    return model
+
+
+def char_bigram_f1(prediction, reference):
+    """
+    F1 of the character bigrams of two texts, a language-agnostic similarity for the quality checks.
+    """
+    pred_bigrams = Counter(prediction[i:i + 2] for i in range(len(prediction) - 1))
+    ref_bigrams = Counter(reference[i:i + 2] for i in range(len(reference) - 1))
+    overlap = sum((pred_bigrams & ref_bigrams).values())
+    if overlap == 0:
+        return 0.0
+    precision = overlap / sum(pred_bigrams.values())
+    recall = overlap / sum(ref_bigrams.values())
+    return 2 * precision * recall / (precision + recall)
+
+
+def summarize_samples(model, tokenizer, samples, max_new_tokens=MAX_NEW_TOKENS):
+    """
+    Summarize the samples one by one with greedy decoding.
+    Returns:
+        tuple: The summaries and the decoding speed in generated tokens/sec.
+    """
+    summaries, num_tokens, elapsed = [], 0, 0.0
+    for sample in samples:
+        conversation = [
+            {"role": "system", "content": SYSTEM_MSG},
+            {"role": "user", "content": USER_PROMPT_PREFIX + sample["text"]},
+        ]
+        inputs = tokenizer.apply_chat_template(conversation, return_tensors="pt", return_dict=True, add_generation_prompt=True)
+        start = time.perf_counter()
+        with torch.no_grad():
+            outputs = model.generate(**inputs, do_sample=False, max_new_tokens=max_new_tokens, pad_token_id=tokenizer.pad_token_id)
+        elapsed += time.perf_counter() - start
+        completion = outputs[0][inputs["input_ids"].shape[1]:]
+        num_tokens += completion.shape[0]
+        summaries.append(tokenizer.decode(completion, skip_special_tokens=True))
+    return summaries, num_tokens / elapsed
+
+
+def compare_profiles(base_model=BASE_MODEL, adapter_path=PEFT_MODEL_PATH, compile_decode=False, num_threads=None):
+    """
+    Compare the int8 CPU profile with the bf16 path on the sample articles.
+    Reports the speed of both, and the similarity of the int8 summaries to the bf16 ones and to the references.
+    Returns:
+        dict: The report.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(base_model)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    samples = load_sample_articles()
+
+    # load the profiles one after the other, both would not fit in memory on small nodes
+    model = load_cpu_model(base_model, adapter_path, quantize=False, num_threads=num_threads)
+    bf16_summaries, bf16_speed = summarize_samples(model, tokenizer, samples)
+    del model
+    gc.collect()
+    model = load_cpu_model(base_model, adapter_path, quantize=True, compile_decode=compile_decode, num_threads=num_threads)
+    int8_summaries, int8_speed = summarize_samples(model, tokenizer, samples)
+
+    report = {"bf16_tokens_per_sec": bf16_speed, "int8_tokens_per_sec": int8_speed, "speedup": int8_speed / bf16_speed, "samples": []}
+    for sample, bf16_summary, int8_summary in zip(samples, bf16_summaries, int8_summaries):
+        report["samples"].append({
+            "lang": sample["lang"],
+            "id": sample["id"],
+            "int8_vs_bf16": char_bigram_f1(int8_summary, bf16_summary),
+            "bf16_vs_reference": char_bigram_f1(bf16_summary, sample["reference"]),
+            "int8_vs_reference": char_bigram_f1(int8_summary, sample["reference"]),
+        })
+    for key in ["int8_vs_bf16", "bf16_vs_reference", "int8_vs_reference"]:
+        report[f"mean_{key}"] = sum(s[key] for s in report["samples"]) / len(report["samples"])
+    return report
+
+
+if __name__ == "__main__":
+    report = compare_profiles()
+    print(json.dumps(report, ensure_ascii=False, indent=2))
@@ -1,5 +1,7 @@
+import torch
 from peft import PeftModel
 from transformers import AutoModelForCausalLM, AutoTokenizer
+from inference.merge_adapter import load_merged_model
 
 BASE_MODEL = "Qwen/Qwen2.5-3B-Instruct"
 PEFT_MODEL_PATH = "chenguang-wang/Qwen2.5-3B-Instruct-summary-sft-adapter"
@@ -11,16 +13,27 @@ SYSTEM_MSG = """You are an expert in summarization tasks. You are good at summar
 
 USER_PROMPT_PREFIX = "Summarize the following text: \n"
 
-model = AutoModelForCausalLM.from_pretrained(
-    BASE_MODEL, 
-    torch_dtype="auto", 
-    device_map="auto"
-)
-model = PeftModel.from_pretrained(
-    model, 
-    PEFT_MODEL_PATH, 
-    device_map="auto"
-)
+# merge the adapter into the base weights, the merged checkpoint is cached for the later runs
+MERGE_ADAPTER = False
+
+if MERGE_ADAPTER:
+    model = load_merged_model(
+        BASE_MODEL,
+        PEFT_MODEL_PATH,
+        torch_dtype=torch.bfloat16,
+        device_map="auto"
+    )
+else:
+    model = AutoModelForCausalLM.from_pretrained(
+        BASE_MODEL, 
+        torch_dtype="auto", 
+        device_map="auto"
+    )
+    model = PeftModel.from_pretrained(
+        model, 
+        PEFT_MODEL_PATH, 
+        device_map="auto"
+    )
 model.eval()
 
 tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL)
@@ -45,7 +58,7 @@ with torch.no_grad():
         inputs,
         attention_mask=attention_mask,
         do_sample=True,
-        max_length=32768, #32k
+        max_new_tokens=512, # bound the summary, a sample without eos would decode up to the context size
         temperature=0.7,
         top_p=0.9,
     )
@@ -0,0 +1,122 @@
+import re
+
+
+# split after the sentence-ending punctuation of the XLSum languages. The latin ones only end a sentence
+# before a whitespace, so decimals and abbreviations like "3.5" or "U.S." are kept whole
+SENTENCE_END_PATTERN = re.compile(r"(?<=[。！？])\s*|(?<=[!?.])(?=\s|$)\s*|\n+")
+
+
+class ChunkingPolicy:
+    """
+    Settings of the long-document (map-reduce) mode.
+    Args:
+        max_input_tokens (int): Texts longer than this are summarized chunk by chunk.
+        max_chunk_tokens (int): The maximum number of tokens of a chunk.
+        overlap_sentences (int): The number of sentences repeated at the start of the next chunk.
+        batch_size (int): The number of chunks summarized in one batch.
+    """
+
+    def __init__(self, max_input_tokens=8192, max_chunk_tokens=2048, overlap_sentences=1, batch_size=8):
+        if overlap_sentences < 0:
+            raise ValueError("overlap_sentences must not be negative.")
+        self.max_input_tokens = max_input_tokens
+        self.max_chunk_tokens = max_chunk_tokens
+        self.overlap_sentences = overlap_sentences
+        self.batch_size = batch_size
+
+    def as_dict(self):
+        return {
+            "max_input_tokens": self.max_input_tokens,
+            "max_chunk_tokens": self.max_chunk_tokens,
+            "overlap_sentences": self.overlap_sentences,
+        }
+
+
+def split_sentences(text):
+    """
+    Split a text into sentences, keeping the punctuation with its sentence.
+    Args:
+        text (str): The input text.
+    Returns:
+        list: The non-empty sentences.
+    """
+    return [sentence.strip() for sentence in SENTENCE_END_PATTERN.split(text) if sentence.strip()]
+
+
+def chunk_text(text, tokenizer, policy):
+    """
+    Group the sentences of a text into chunks of at most `policy.max_chunk_tokens` tokens.
+    A sentence longer than a chunk is cut on token boundaries.
+    Args:
+        text (str): The input text.
+        tokenizer (PreTrainedTokenizer): The tokenizer of the model.
+        policy (ChunkingPolicy): The chunking settings.
+    Returns:
+        list: The chunks of the text.
+    """
+    sentences = split_sentences(text)
+    if not sentences:
+        return []
+    sentence_ids = tokenizer(sentences, add_special_tokens=False)["input_ids"]
+
+    # cut the too long sentences first
+    pieces = []
+    for sentence, ids in zip(sentences, sentence_ids):
+        if len(ids) <= policy.max_chunk_tokens:
+            pieces.append((sentence, len(ids)))
+            continue
+        for start in range(0, len(ids), policy.max_chunk_tokens):
+            part = ids[start:start + policy.max_chunk_tokens]
+            pieces.append((tokenizer.decode(part), len(part)))
+
+    chunks, current, current_length = [], [], 0
+    for sentence, length in pieces:
+        if current and current_length + length > policy.max_chunk_tokens:
+            chunks.append(" ".join(s for s, _ in current))
+            # start the next chunk with the last sentences of this one, as long as they fit
+            current = current[len(current) - policy.overlap_sentences:] if policy.overlap_sentences else []
+            current_length = sum(n for _, n in current)
+            while current and current_length + length > policy.max_chunk_tokens:
+                current_length -= current.pop(0)[1]
+        current.append((sentence, length))
+        current_length += length
+    if current:
+        chunks.append(" ".join(s for s, _ in current))
+    return chunks
+
+
+def reduce_long(text, summarize_fn, tokenizer, policy):
+    """
+    The map stages of the map-reduce summarization of a text longer than `policy.max_input_tokens`.
+    The chunks are summarized in batches, then the partial summaries are chunked and summarized again
+    while they are still too long.
+    Args:
+        text (str): The input text.
+        summarize_fn (callable): Function taking a list of texts and returning their summaries.
+        tokenizer (PreTrainedTokenizer): The tokenizer of the model.
+        policy (ChunkingPolicy): The chunking settings.
+    Returns:
+        str: The text summarized by the final pass, the input text itself if it is short enough.
+    """
+    num_tokens = len(tokenizer(text, add_special_tokens=False)["input_ids"])
+    if num_tokens <= policy.max_input_tokens:
+        return text
+
+    chunks = chunk_text(text, tokenizer, policy)
+    partial_summaries = []
+    for start in range(0, len(chunks), policy.batch_size):
+        partial_summaries.extend(summarize_fn(chunks[start:start + policy.batch_size]))
+    combined = "\n".join(summary.strip() for summary in partial_summaries)
+    if len(tokenizer(combined, add_special_tokens=False)["input_ids"]) >= num_tokens:
+        # the partial summaries are not getting shorter, they are summarized in one (truncated) pass
+        return combined
+    return reduce_long(combined, summarize_fn, tokenizer, policy)
+
+
+def summarize_long(text, summarize_fn, tokenizer, policy):
+    """
+    Map-reduce summarization of a text longer than `policy.max_input_tokens`, see `reduce_long`.
+    Returns:
+        str: The summary of the whole text.
+    """
+    return summarize_fn([reduce_long(text, summarize_fn, tokenizer, policy)])[0]
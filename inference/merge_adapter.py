@@ -0,0 +1,148 @@
+import hashlib
+import os
+import shutil
+import uuid
+import torch
+from huggingface_hub import snapshot_download
+from peft import PeftModel
+from transformers import AutoModelForCausalLM
+
+
+MERGED_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "summary_adapter", "merged")
+
+
+def is_hub_snapshot(model_path):
+    """
+    Returns:
+        bool: True if the path is a snapshot directory of the hub cache, `models--<org>--<name>/snapshots/<commit>`.
+    """
+    return os.path.basename(os.path.dirname(os.path.normpath(model_path))) == "snapshots"
+
+
+def checkpoint_name(model_path):
+    """
+    Returns:
+        str: The name of a model, without its organization.
+    """
+    if is_hub_snapshot(model_path):
+        return os.path.basename(os.path.dirname(os.path.dirname(os.path.normpath(model_path)))).split("--")[-1]
+    return os.path.basename(os.path.normpath(model_path))
+
+
+def resolve_revision(model_path):
+    """
+    Get an identifier of the current revision of a model or adapter.
+    Args:
+        model_path (str): A local checkpoint directory or a model id on the hub.
+    Returns:
+        str: The commit hash for hub models, a hash of the checkpoint files for local ones.
+    """
+    if is_hub_snapshot(model_path):
+        # the snapshot directory is named after the commit hash
+        return os.path.basename(os.path.normpath(model_path))
+    if os.path.isdir(model_path):
+        digest = hashlib.sha256()
+        for name in sorted(os.listdir(model_path)):
+            file_path = os.path.join(model_path, name)
+            if name.endswith(".json"):
+                with open(file_path, "rb") as f:
+                    digest.update(f.read())
+            elif name.endswith((".safetensors", ".bin")):
+                # the weights are too large to be hashed on every start
+                stat = os.stat(file_path)
+                digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return digest.hexdigest()[:16]
+    # the snapshot folder of the hub cache is named after the commit hash
+    snapshot_path = snapshot_download(model_path, allow_patterns=["*.json"])
+    return os.path.basename(os.path.normpath(snapshot_path))
+
+
+def adapter_revision(adapter_path):
+    """
+    Get an identifier of the content of an adapter.
+    Args:
+        adapter_path (str): A local adapter directory or an adapter id on the hub.
+    Returns:
+        str: The commit hash for hub adapters, a hash of the config and weights for local ones.
+    """
+    if is_hub_snapshot(adapter_path) or not os.path.isdir(adapter_path):
+        return resolve_revision(adapter_path)
+    # unlike the base weights, the LoRA weights are small enough to be hashed, so a retrained
+    # adapter saved at the same path gets a new revision
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(adapter_path)):
+        if name.endswith((".json", ".safetensors", ".bin")):
+            digest.update(name.encode("utf-8"))
+            with open(os.path.join(adapter_path, name), "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def merged_checkpoint_path(base_model, adapter_path, cache_dir=MERGED_CACHE_DIR, torch_dtype=torch.bfloat16):
+    """
+    Get the path of the merged checkpoint for the given base model and adapter revisions and dtype.
+    Args:
+        base_model (str): The base model path or id.
+        adapter_path (str): The adapter path or id.
+        cache_dir (str): The directory of the merged checkpoints.
+        torch_dtype (torch.dtype): The dtype of the merged weights.
+    Returns:
+        str: The path of the merged checkpoint.
+    """
+    name = checkpoint_name(base_model) + "--" + checkpoint_name(adapter_path)
+    dtype = str(torch_dtype).replace("torch.", "")
+    revision = resolve_revision(base_model) + "-" + adapter_revision(adapter_path) + "-" + dtype
+    return os.path.join(cache_dir, name, revision)
+
+
+def save_merged_model(base_model, adapter_path, output_path, torch_dtype=torch.bfloat16):
+    """
+    Merge the LoRA adapter into the base weights and save the result as safetensors.
+    Args:
+        base_model (str): The base model path or id.
+        adapter_path (str): The adapter path or id.
+        output_path (str): The directory to save the merged model.
+        torch_dtype (torch.dtype): The dtype of the merged weights.
+    """
+    model = AutoModelForCausalLM.from_pretrained(base_model, torch_dtype=torch_dtype, low_cpu_mem_usage=True)
+    model = PeftModel.from_pretrained(model, adapter_path)
+    model = model.merge_and_unload()
+
+    # write to a temporary directory first, so an interrupted save is never loaded,
+    # one per call so concurrent merges do not write into the same directory
+    tmp_path = f"{output_path}.tmp-{uuid.uuid4().hex}"
+    try:
+        model.save_pretrained(tmp_path, safe_serialization=True)
+        try:
+            os.replace(tmp_path, output_path)
+        except OSError:
+            # a directory can not replace a non-empty one: another process saved the same merge first
+            if not os.path.exists(os.path.join(output_path, "config.json")):
+                raise
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_merged_model(base_model, adapter_path, cache_dir=MERGED_CACHE_DIR, torch_dtype=torch.bfloat16, device_map="auto"):
+    """
+    Load the base model with the adapter merged into its weights.
+    The merged checkpoint is created on the first call and loaded directly on the later ones.
+    Args:
+        base_model (str): The base model path or id.
+        adapter_path (str): The adapter path or id.
+        cache_dir (str): The directory of the merged checkpoints.
+        torch_dtype (torch.dtype): The dtype of the model.
+        device_map (str): The device map used to load the model.
+    Returns:
+        PreTrainedModel: The merged model.
+    """
+    merged_path = merged_checkpoint_path(base_model, adapter_path, cache_dir, torch_dtype=torch_dtype)
+    if not os.path.exists(os.path.join(merged_path, "config.json")):
+        print(f"Merging {adapter_path} into {base_model}, saving to {merged_path}")
+        os.makedirs(os.path.dirname(merged_path), exist_ok=True)
+        save_merged_model(base_model, adapter_path, merged_path, torch_dtype=torch_dtype)
+    # the safetensors files are memory mapped and each tensor is copied straight to its device
+    return AutoModelForCausalLM.from_pretrained(
+        merged_path, torch_dtype=torch_dtype, low_cpu_mem_usage=True, use_safetensors=True, device_map=device_map
+    )
@@ -0,0 +1,190 @@
+import itertools
+import json
+import logging
+import threading
+import time
+import torch
+from contextlib import contextmanager
+from transformers import StoppingCriteria
+
+
+# the bounds of the latency histograms, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+class RequestTrace:
+    """
+    The stage durations (tokenize, h2d, prefill, decode, detokenize) and token counts of one generation call, which may run a batch of requests.
+    Every request of the batch shares the stage durations and has its own token counts.
+    Args:
+        texts (list): The input texts of the batch.
+        adapters (list): The adapter name of each text.
+        mode (str): "batched" or "streaming".
+    """
+
+    _ids = itertools.count()
+
+    def __init__(self, texts, adapters, mode="batched"):
+        self.trace_id = next(self._ids)
+        self.mode = mode
+        self.batch_size = len(texts)
+        self.adapters = list(adapters)
+        self.langs = [None] * len(texts)
+        self.stages = {}
+        self.prompt_tokens = [0] * len(texts)
+        self.truncated_tokens = [0] * len(texts)
+        self.generated_tokens = [0] * len(texts)
+        self.first_token_time = None
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def add_stage(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def requests(self):
+        """
+        Returns:
+            list: One dict per request of the batch, with the stage durations in milliseconds and the token counts.
+        """
+        stages_ms = {name: round(seconds * 1000, 3) for name, seconds in self.stages.items()}
+        return [
+            {
+                "trace_id": self.trace_id,
+                "index": i,
+                "mode": self.mode,
+                "batch_size": self.batch_size,
+                "adapter": self.adapters[i],
+                "lang": self.langs[i],
+                "stages_ms": stages_ms,
+                "prompt_tokens": self.prompt_tokens[i],
+                "truncated_tokens": self.truncated_tokens[i],
+                "generated_tokens": self.generated_tokens[i],
+            }
+            for i in range(self.batch_size)
+        ]
+
+
+class FirstTokenTimer(StoppingCriteria):
+    """
+    Never stops the generation, only records when the first token is produced, i.e. the end of the prefill.
+    `generate` checks the stopping criteria after every step, so the first call follows the prefill forward pass.
+    """
+
+    def __init__(self, trace):
+        self.trace = trace
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.trace.first_token_time is None:
+            self.trace.first_token_time = time.perf_counter()
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+
+def log_trace(trace):
+    """
+    Trace hook writing one structured log line per request.
+    """
+    for request in trace.requests():
+        logging.info("request_trace " + json.dumps(request, ensure_ascii=False))
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    In-process counters and histograms, exported in the Prometheus text format.
+    `record_trace` is a trace hook feeding the registry with the stages and token counts of the requests.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self.describe("summary_requests_total", "counter", "Summarization requests.")
+        self.describe("summary_prompt_tokens_total", "counter", "Prompt tokens, after truncation.")
+        self.describe("summary_truncated_tokens_total", "counter", "Article tokens cut to fit the context.")
+        self.describe("summary_generated_tokens_total", "counter", "Generated tokens, without the stop tokens.")
+        self.describe("summary_stage_seconds", "histogram", "Duration of every stage of a generation call.")
+        self.describe("summary_batch_size", "histogram", "Number of requests per generation call.", BATCH_SIZE_BUCKETS)
+
+    def describe(self, name, kind, help_text, buckets=DEFAULT_BUCKETS):
+        """
+        Declare a metric.
+        Args:
+            name (str): The metric name.
+            kind (str): "counter" or "histogram".
+            help_text (str): The description of the metric.
+            buckets (tuple): The upper bounds of the buckets of a histogram.
+        """
+        with self._lock:
+            self._metrics.setdefault(name, {"kind": kind, "help": help_text, "buckets": buckets, "values": {}})
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._metrics[name]["values"]
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            metric = self._metrics[name]
+            values = metric["values"]
+            if key not in values:
+                values[key] = Histogram(metric["buckets"])
+            values[key].observe(value)
+
+    def record_trace(self, trace):
+        """
+        Trace hook adding the requests of a trace to the metrics.
+        """
+        self.inc("summary_requests_total", trace.batch_size, mode=trace.mode)
+        self.inc("summary_prompt_tokens_total", sum(trace.prompt_tokens))
+        self.inc("summary_truncated_tokens_total", sum(trace.truncated_tokens))
+        self.inc("summary_generated_tokens_total", sum(trace.generated_tokens))
+        for name, seconds in trace.stages.items():
+            self.observe("summary_stage_seconds", seconds, stage=name)
+        self.observe("summary_batch_size", trace.batch_size)
+
+    def to_prometheus(self):
+        """
+        Returns:
+            str: The metrics in the Prometheus text exposition format.
+        """
+        def format_labels(labels, extra=()):
+            pairs = [f'{k}="{v}"' for k, v in (*labels, *extra)]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        lines = []
+        with self._lock:
+            for name, metric in sorted(self._metrics.items()):
+                lines.append(f"# HELP {name} {metric['help']}")
+                lines.append(f"# TYPE {name} {metric['kind']}")
+                for labels, value in sorted(metric["values"].items()):
+                    if metric["kind"] == "counter":
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+                        continue
+                    for bound, count in zip(value.buckets, value.counts):
+                        lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {count}")
+                    lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {value.count}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {value.sum}")
+                    lines.append(f"{name}_count{format_labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
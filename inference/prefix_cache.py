@@ -0,0 +1,100 @@
+import copy
+import torch
+from transformers import BatchEncoding
+
+
+class PromptTemplate:
+    """
+    The chat template rendered once and split into pre-tokenized pieces around the article.
+    Encoding a request only tokenizes the article and concatenates it with the cached pieces,
+    instead of rendering the Jinja chat template for every call.
+    Args:
+        tokenizer (PreTrainedTokenizer): The tokenizer of the model.
+        conversation (list): The conversation of a request, with `PLACEHOLDER` as the article.
+        max_length (int): The maximum number of tokens of the whole prompt.
+    """
+
+    PLACEHOLDER = "<|article|>"
+
+    def __init__(self, tokenizer, conversation, max_length=32768):
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        rendered = tokenizer.apply_chat_template(conversation, tokenize=False, add_generation_prompt=True)
+        prefix, suffix = rendered.split(self.PLACEHOLDER)
+        self.prefix_ids = tokenizer(prefix, add_special_tokens=False)["input_ids"]
+        self.suffix_ids = tokenizer(suffix, add_special_tokens=False)["input_ids"]
+
+    @property
+    def max_text_length(self):
+        return self.max_length - len(self.prefix_ids) - len(self.suffix_ids)
+
+    def encode(self, texts, return_truncated=False):
+        """
+        Tokenize the articles and wrap them with the template pieces.
+        Too long articles are truncated, the template pieces are always kept.
+        Args:
+            texts (list): The input texts to be summarized.
+            return_truncated (bool): Also return the number of tokens cut from each article.
+        Returns:
+            list: The token ids of each prompt, and the truncated token counts if `return_truncated` is set.
+        """
+        text_ids = self.tokenizer(texts, add_special_tokens=False)["input_ids"]
+        prompts = [self.prefix_ids + ids[:self.max_text_length] + self.suffix_ids for ids in text_ids]
+        if return_truncated:
+            return prompts, [max(0, len(ids) - self.max_text_length) for ids in text_ids]
+        return prompts
+
+    def pad_after_prefix(self, input_ids, pad_token_id):
+        """
+        Pad a batch of prompts between the template prefix and the rest of each prompt, instead of on the left,
+        so the prefix is at the same positions in every row and its cached KV can be shared by the batch.
+        The positions are computed from the attention mask by `generate`, so the pads shift no position.
+        Args:
+            input_ids (list): The token ids of each prompt, from `encode`.
+            pad_token_id (int): The id of the padding token.
+        Returns:
+            BatchEncoding: The padded `input_ids` and `attention_mask` tensors.
+        """
+        prefix_length = len(self.prefix_ids)
+        rests = [ids[prefix_length:] for ids in input_ids]
+        width = max(len(rest) for rest in rests)
+        padded = [self.prefix_ids + [pad_token_id] * (width - len(rest)) + rest for rest in rests]
+        attention_mask = [[1] * prefix_length + [0] * (width - len(rest)) + [1] * len(rest) for rest in rests]
+        return BatchEncoding({"input_ids": torch.tensor(padded), "attention_mask": torch.tensor(attention_mask)})
+
+
+class PrefixCache:
+    """
+    Keeps the `past_key_values` of the constant prompt prefix (system message + user prompt prefix),
+    computed once for every loaded model and adapter.
+    Args:
+        template (PromptTemplate): The template providing the prefix tokens.
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self._caches = {}
+
+    def get(self, model, key, batch_size=1, **model_kwargs):
+        """
+        Get a copy of the prefix cache for the model, prefilling it on the first call.
+        The copy can be extended by `generate` without touching the shared one.
+        Args:
+            model (PreTrainedModel): The model used for generation.
+            key (str): The name of the model and adapter the cache belongs to.
+            batch_size (int): The number of rows of the batch, the copy repeats the prefix for each of them.
+            model_kwargs: Extra arguments of the forward pass of the prefix alone, e.g. `adapter_names`.
+        Returns:
+            Cache: The `past_key_values` of the prompt prefix.
+        """
+        if key not in self._caches:
+            prefix_ids = torch.tensor([self.template.prefix_ids], device=model.device)
+            with torch.no_grad():
+                self._caches[key] = model(input_ids=prefix_ids, use_cache=True, **model_kwargs).past_key_values
+        cache = copy.deepcopy(self._caches[key])
+        if batch_size > 1:
+            cache.batch_repeat_interleave(batch_size)
+        return cache
+
+    def clear(self):
+        self._caches.clear()
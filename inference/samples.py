@@ -0,0 +1,39 @@
+import glob
+import json
+import os
+
+
+SAMPLE_FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "eval", "llm_judge_prompts_*_dpo_sample.jsonl")
+
+
+def parse_judge_prompt(prompt):
+    """
+    Recover the original text and the two candidate summaries from a rendered LLM judge prompt.
+    Args:
+        prompt (str): The prompt rendered with `resp_gen.LLM_JUDGE_PROMPT_TEMPLATE`.
+    Returns:
+        tuple: The original text, the reference summary and the generated summary.
+    """
+    original_text = prompt.split("original text:\n")[-1].split("\ncandidate summaries:")[0].strip()
+    summary = prompt.split("candidate summaries:\n1. ")[-1].split("\n")[0].strip()
+    response0 = prompt.split("\n2. ")[-1].split("\n")[0].strip()
+    return original_text, summary, response0
+
+
+def load_sample_articles(pattern=SAMPLE_FILES):
+    """
+    Load the sample articles of the `eval/llm_judge_prompts_*_dpo_sample.jsonl` files.
+    Args:
+        pattern (str): The glob pattern of the files, the language is taken from the file name.
+    Returns:
+        list: Dicts with the language, id, original text and reference summary of each article.
+    """
+    samples = []
+    for file_path in sorted(glob.glob(pattern)):
+        lang = os.path.basename(file_path).split("_")[3]
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                data = json.loads(line)
+                text, reference, _ = parse_judge_prompt(data["prompt"])
+                samples.append({"lang": lang, "id": data["id"], "text": text, "reference": reference})
+    return samples
@@ -0,0 +1,95 @@
+import logging
+import torch
+from transformers import AutoModelForCausalLM
+
+
+def load_draft_model(draft_model, device, torch_dtype=torch.bfloat16):
+    """
+    Load the small model drafting the tokens of assisted decoding.
+    It must share the tokenizer of the base model, e.g. Qwen/Qwen2.5-0.5B-Instruct for the Qwen2.5 family.
+    Args:
+        draft_model (str): The draft model path or id.
+        device (torch.device): The device of the target model.
+        torch_dtype (torch.dtype): The dtype of the draft model.
+    Returns:
+        PreTrainedModel: The draft model.
+    """
+    model = AutoModelForCausalLM.from_pretrained(draft_model, torch_dtype=torch_dtype, low_cpu_mem_usage=True).to(device)
+    model.eval()
+    return model
+
+
+def speculative_kwargs(mode, draft_model=None, prompt_lookup_num_tokens=10):
+    """
+    Get the `generate` arguments of an assisted decoding mode.
+    Args:
+        mode (str): "draft" to draft with a small model, "prompt_lookup" to draft by copying n-grams of the prompt.
+        draft_model (PreTrainedModel): The draft model of the "draft" mode.
+        prompt_lookup_num_tokens (int): The number of tokens drafted per step in "prompt_lookup" mode.
+    Returns:
+        dict: The arguments to pass to `generate`.
+    """
+    if mode == "draft":
+        if draft_model is None:
+            raise ValueError("The draft mode needs a draft model.")
+        return {"assistant_model": draft_model}
+    if mode == "prompt_lookup":
+        return {"prompt_lookup_num_tokens": prompt_lookup_num_tokens}
+    raise ValueError(f"Unknown speculative mode: {mode}")
+
+
+class AcceptanceTracker:
+    """
+    Counts the drafted and accepted tokens of one assisted `generate` call.
+    Every verification step runs one forward pass of the target model on the last accepted token
+    and the drafted ones, and produces one token of its own after the accepted drafts,
+    so both numbers can be read from the `cache_position` of the forward calls.
+    Args:
+        model (PreTrainedModel): The target model, the hook is put on the transformers model under a PeftModel.
+        prompt_length (int): The length of the prompt.
+    """
+
+    def __init__(self, model, prompt_length):
+        self.target = model.get_base_model() if hasattr(model, "get_base_model") else model
+        self.prompt_length = prompt_length
+        self.num_steps = 0
+        self.num_drafted = 0
+        self.num_accepted = 0
+        self._handle = None
+
+    def _hook(self, module, args, kwargs):
+        cache_position = kwargs.get("cache_position")
+        if cache_position is None:
+            return
+        if self.num_steps == 0:
+            # the first step also prefills the prompt
+            self.num_drafted += int(cache_position[-1]) + 1 - self.prompt_length
+        else:
+            self.num_drafted += cache_position.shape[0] - 1
+        self.num_steps += 1
+
+    def __enter__(self):
+        self._handle = self.target.register_forward_pre_hook(self._hook, with_kwargs=True)
+        return self
+
+    def __exit__(self, *exc):
+        self._handle.remove()
+
+    def finish(self, num_generated):
+        """
+        Args:
+            num_generated (int): The number of tokens generated by the call.
+        Returns:
+            dict: The drafted and accepted tokens, and the acceptance rate.
+        """
+        self.num_accepted = max(0, num_generated - self.num_steps)
+        acceptance_rate = self.num_accepted / self.num_drafted if self.num_drafted else None
+        stats = {
+            "steps": self.num_steps,
+            "drafted": self.num_drafted,
+            "accepted": self.num_accepted,
+            "acceptance_rate": acceptance_rate,
+            "tokens_per_step": num_generated / self.num_steps if self.num_steps else None,
+        }
+        logging.info(f"assisted decoding: {stats}")
+        return stats
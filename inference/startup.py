@@ -0,0 +1,106 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+class StartupTimer:
+    """
+    Measures the phases of the startup and prints their breakdown.
+    """
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def add(self, name, seconds):
+        """
+        Add a phase measured somewhere else, e.g. in a background thread.
+        """
+        self.phases.append((name, seconds))
+
+    def report(self):
+        """
+        Print the duration of every phase and the total time since the timer was created.
+        Returns:
+            dict: The duration of every phase in seconds, and the total.
+        """
+        total = time.perf_counter() - self.start_time
+        print("Startup time breakdown:")
+        for name, seconds in self.phases:
+            print(f"  {name:<32} {seconds:8.2f} s ({100 * seconds / total:5.1f}%)")
+        print(f"  {'total':<32} {total:8.2f} s")
+        return {**dict(self.phases), "total": total}
+
+
+class CheckpointPrefetcher:
+    """
+    Resolve the hub ids of the models and adapters to local snapshot directories in background threads,
+    downloading the missing files, while the main thread imports the heavy libraries.
+    Loading from the local directories afterwards makes no request to the hub.
+    Args:
+        model_paths (list): Local checkpoint directories or model ids on the hub.
+    """
+
+    IGNORE_PATTERNS = ["*.pth", "*.pt", "*.gguf", "*.msgpack", "*.h5", "original/*"]
+
+    def __init__(self, model_paths):
+        self.start_time = time.perf_counter()
+        self._finish_times = []
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(model_paths)))
+        self._futures = {path: self._executor.submit(self._resolve, path) for path in dict.fromkeys(model_paths)}
+
+    def _resolve(self, model_path):
+        try:
+            if os.path.isdir(model_path):
+                return model_path
+            # huggingface_hub is light to import, unlike torch and transformers
+            from huggingface_hub import snapshot_download
+            return snapshot_download(model_path, ignore_patterns=self.ignore_patterns(model_path))
+        finally:
+            self._finish_times.append(time.perf_counter())
+
+    def ignore_patterns(self, model_path):
+        """
+        Returns:
+            list: The files not downloaded. The pickled `*.bin` weights are skipped only when the checkpoint
+                also has safetensors weights, e.g. adapters published as `adapter_model.bin` alone need them.
+        """
+        from huggingface_hub import HfApi
+
+        try:
+            files = HfApi().list_repo_files(model_path)
+        except Exception as e:
+            # offline or unreachable hub: the cached snapshot is used as it is
+            print(f"Could not list the files of {model_path}: {e}")
+            return self.IGNORE_PATTERNS
+        if any(name.endswith(".safetensors") for name in files):
+            return self.IGNORE_PATTERNS + ["*.bin"]
+        return self.IGNORE_PATTERNS
+
+    @property
+    def elapsed(self):
+        """
+        The seconds from the start until the last checkpoint was resolved.
+        """
+        if not self._finish_times:
+            return None
+        return max(self._finish_times) - self.start_time
+
+    def result(self):
+        """
+        Wait for all the checkpoints.
+        Returns:
+            dict: The local directory of every model path.
+        """
+        paths = {path: future.result() for path, future in self._futures.items()}
+        self._executor.shutdown()
+        return paths
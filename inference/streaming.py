@@ -0,0 +1,104 @@
+import threading
+import time
+from transformers import TextIteratorStreamer
+
+
+class StreamStats:
+    """
+    Latency numbers of one streamed generation.
+    The time-to-first-token is measured from the start of the stream, so it includes the
+    tokenization and the prefill. The inter-token latencies are the gaps between the following tokens.
+    """
+
+    def __init__(self):
+        self.start_time = None
+        self.token_times = []
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.token_times = []
+
+    def add_token(self):
+        self.token_times.append(time.perf_counter())
+
+    @property
+    def num_tokens(self):
+        return len(self.token_times)
+
+    @property
+    def time_to_first_token(self):
+        if not self.token_times:
+            return None
+        return self.token_times[0] - self.start_time
+
+    @property
+    def inter_token_latencies(self):
+        return [later - earlier for earlier, later in zip(self.token_times, self.token_times[1:])]
+
+    def as_dict(self):
+        """
+        Returns:
+            dict: The latency summary in milliseconds, and the decode speed in tokens/sec.
+        """
+        latencies = sorted(self.inter_token_latencies)
+        ttft = self.time_to_first_token
+        decode_time = sum(latencies)
+        return {
+            "num_tokens": self.num_tokens,
+            "ttft_ms": None if ttft is None else ttft * 1000,
+            "mean_itl_ms": decode_time / len(latencies) * 1000 if latencies else None,
+            "p95_itl_ms": latencies[int(0.95 * (len(latencies) - 1))] * 1000 if latencies else None,
+            "decode_tokens_per_sec": len(latencies) / decode_time if decode_time > 0 else None,
+        }
+
+
+class TimedTextStreamer(TextIteratorStreamer):
+    """
+    TextIteratorStreamer recording the arrival time of every generated token.
+    """
+
+    def __init__(self, tokenizer, stats, **kwargs):
+        super().__init__(tokenizer, **kwargs)
+        self.stats = stats
+
+    def put(self, value):
+        # the first call carries the prompt tokens when skip_prompt is set
+        if not (self.skip_prompt and self.next_tokens_are_prompt):
+            for _ in range(value.numel()):
+                self.stats.add_token()
+        super().put(value)
+
+
+class SummaryStream:
+    """
+    Iterate over the decoded text of a generation while it is running in a background thread.
+    The latency numbers are available in `stats` once the iteration is finished.
+    Args:
+        tokenizer (PreTrainedTokenizer): The tokenizer used to decode the tokens.
+        generate_fn (callable): Function running `generate` with the given streamer.
+        timeout (float): The maximum seconds to wait for the next piece of text, None to wait forever.
+    """
+
+    def __init__(self, tokenizer, generate_fn, timeout=None):
+        self.stats = StreamStats()
+        self.streamer = TimedTextStreamer(tokenizer, self.stats, skip_prompt=True, skip_special_tokens=True, timeout=timeout)
+        self._generate_fn = generate_fn
+        self._error = None
+
+    def _generate(self):
+        try:
+            self._generate_fn(self.streamer)
+        except Exception as e:
+            self._error = e
+            # unblock the consumer
+            self.streamer.end()
+
+    def __iter__(self):
+        self.stats.start()
+        thread = threading.Thread(target=self._generate, daemon=True)
+        thread.start()
+        for text in self.streamer:
+            yield text
+        thread.join()
+        if self._error is not None:
+            raise self._error
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    """
+    Normalize the unicode form and the whitespaces, so the resent copies of an article share the same key.
+    """
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+
+class SummaryCache:
+    """
+    Content-addressed cache of the generated summaries.
+    The key is a hash of the normalized text, the serving namespace and the generation parameters.
+    Entries are kept in a bounded in-memory LRU, and optionally written to `cache_dir`
+    so they survive restarts. The on-disk tier keeps at most `max_disk_entries` entries,
+    the least recently used ones are removed first.
+    Args:
+        max_entries (int): The maximum number of summaries kept in memory.
+        cache_dir (str): The directory of the on-disk tier, None to keep the cache in memory only.
+        max_disk_entries (int): The maximum number of summaries kept on disk.
+    """
+
+    def __init__(self, max_entries=4096, cache_dir=None, max_disk_entries=100000):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        self._disk_entries = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.prune_disk()
+
+    @staticmethod
+    def make_key(text, namespace, generation_params):
+        """
+        Args:
+            text (str): The input text.
+            namespace (dict): Everything else changing the summary of a text: the model and adapter revisions,
+                the serving mode and the length settings.
+            generation_params (dict): The parameters changing the output of the generation.
+        Returns:
+            str: The hex digest identifying the request.
+        """
+        content = json.dumps(
+            {"text": normalize_text(text), "namespace": namespace, "params": generation_params},
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def _disk_files(self):
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if os.path.isdir(prefix_dir):
+                for name in os.listdir(prefix_dir):
+                    if name.endswith(".json"):
+                        yield os.path.join(prefix_dir, name)
+
+    def prune_disk(self):
+        """
+        Remove the least recently used entries of the on-disk tier beyond `max_disk_entries`,
+        down to 90% of it so the directory is not listed again at every write.
+        """
+        entries = []
+        for path in self._disk_files():
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except FileNotFoundError:
+                # removed by another process sharing the directory
+                continue
+        excess = len(entries) - self.max_disk_entries
+        if excess > 0:
+            excess += self.max_disk_entries // 10
+            entries.sort()
+            for _, path in entries[:excess]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self.disk_evictions += excess
+        self._disk_entries = len(entries) - max(excess, 0)
+
+    def _remember(self, key, summary):
+        self._entries[key] = summary
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key):
+        """
+        Returns:
+            str: The cached summary, None if the key is not cached.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return self._entries[key]
+        if self.cache_dir is not None and os.path.exists(self._disk_path(key)):
+            try:
+                with open(self._disk_path(key), 'r', encoding='utf-8') as f:
+                    summary = json.load(f)["summary"]
+            except (OSError, json.JSONDecodeError, KeyError) as e:
+                print(f"Broken summary cache entry {key}: {e}")
+            else:
+                try:
+                    # the modification time orders the entries for `prune_disk`
+                    os.utime(self._disk_path(key))
+                except OSError:
+                    pass
+                with self._lock:
+                    self.disk_hits += 1
+                    self._remember(key, summary)
+                return summary
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, summary):
+        with self._lock:
+            self._remember(key, summary)
+        if self.cache_dir is not None:
+            path = self._disk_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write to a temporary file first, so a crash never leaves a truncated entry
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"summary": summary}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            with self._lock:
+                self._disk_entries += 1
+                if self._disk_entries > self.max_disk_entries:
+                    self.prune_disk()
+
+    def stats(self):
+        """
+        Returns:
+            dict: The hit, miss and eviction counters.
+        """
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            total = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "disk_evictions": self.disk_evictions,
+                "hit_rate": hits / total if total else None,
+                "memory_entries": len(self._entries),
+            }
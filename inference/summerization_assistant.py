@@ -1,12 +1,165 @@
-import torch
+import os
+import sys
+import logging
 import threading
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from peft import PeftModel
+import time
 from utils.prompts import SYSTEM_MSG, USER_PROMPT_PREFIX
+from inference.batching import BatchingEngine
+from inference.long_doc import ChunkingPolicy, reduce_long
+from inference.summary_cache import SummaryCache
+from inference.startup import CheckpointPrefetcher, StartupTimer
+# torch, transformers, peft and the modules depending on them are imported lazily,
+# so the checkpoints can be resolved while they are imported (see `init_assistant`)
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    level=logging.INFO,
+)
 
 
 BASE_MODEL = "Qwen/Qwen2.5-3B-Instruct"
 PEFT_MODEL_PATH = "../dpo-rola/dpo_lr1e6_bz8_beta03_fsdp_3ep/checkpoint-300"
+# named adapters loaded onto the same base model, selected per request
+ADAPTERS = {
+    "dpo": PEFT_MODEL_PATH,
+    "sft": "chenguang-wang/Qwen2.5-3B-Instruct-summary-sft-adapter",
+}
+DEFAULT_ADAPTER = "dpo"
+# micro-batching policy of the request queue
+MAX_BATCH_SIZE = 8
+MAX_WAIT_MS = 10
+# serve the requests with worker processes forked after loading the model, sharing its weights copy-on-write.
+# 0 serves them in this process. Only for CPU models, e.g. with CPU_INT8
+NUM_WORKERS = 0
+# reuse the KV cache of the constant system message and prompt prefix
+USE_PREFIX_CACHE = True
+# merge the default adapter into the base weights, the merged checkpoint is cached for the later starts.
+# the other adapters can not be served in this mode
+MERGE_ADAPTER = False
+# CPU profile for nodes without GPU: the default adapter is merged and the linear layers are quantized to int8.
+# the decoding step can also be compiled with torch.compile
+CPU_INT8 = False
+COMPILE_DECODE = False
+# print the summary in the chatbot while it is generated
+STREAM_OUTPUT = True
+# the maximum summary length is set from the reference summaries of these datasets
+XLSUM_DATASET_DIR = "../datasets/xlsum_datasets"
+LENGTH_STATS_PATH = "../datasets/xlsum_datasets/length_stats.json"
+# texts longer than max_input_tokens are split into sentence-aligned chunks, summarized in batches,
+# then the partial summaries are summarized again (map-reduce)
+LONG_DOC_POLICY = ChunkingPolicy(max_input_tokens=8192, max_chunk_tokens=2048, overlap_sentences=1, batch_size=8)
+GENERATION_PARAMS = {
+    "do_sample": True,
+    "temperature": 0.7,
+    "top_p": 0.9,
+}
+# cache the summaries in memory and on disk, only used for greedy decoding
+# unless CACHE_SAMPLED_SUMMARIES is set. The keys hold the adapter revisions, the serving mode and the length
+# settings; the least recently used entries beyond SUMMARY_CACHE_DISK_ENTRIES are removed from the disk
+SUMMARY_CACHE_SIZE = 4096
+SUMMARY_CACHE_DISK_ENTRIES = 100000
+SUMMARY_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "summary_adapter", "summaries")
+CACHE_SAMPLED_SUMMARIES = False
+# assisted decoding of single requests: None, "prompt_lookup" (drafts by copying n-grams of the article)
+# or "draft" (drafts with DRAFT_MODEL, needs MERGE_ADAPTER or CPU_INT8)
+SPECULATIVE_MODE = None
+DRAFT_MODEL = "Qwen/Qwen2.5-0.5B-Instruct"
+PROMPT_LOOKUP_NUM_TOKENS = 10
+# run one tiny generation at startup, so the first request does not pay for the lazy initializations
+WARMUP = True
+WARMUP_TEXT = "This is a short text used to warm up the model."
+# write one structured log line with the stage timings and token counts of every request
+LOG_REQUEST_TRACES = True
+
+
+def load_tokenizer(base_model_path=BASE_MODEL):
+    """
+    Load the tokenizer, padding on the left for the batched generation.
+    Args:
+        base_model_path (str): The base model path or id.
+    Returns:
+        PreTrainedTokenizer: The tokenizer.
+    """
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(base_model_path)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    return tokenizer
+
+
+def load_model(paths=None):
+    """
+    Load the base model once with all the adapters in `ADAPTERS` on top of it.
+    Args:
+        paths (dict): The local directory of the base model and adapters, the hub ids are used if missing.
+    Returns:
+        PreTrainedModel: The model ready for inference.
+    """
+    import torch
+
+    paths = paths or {}
+    base_model_path = paths.get(BASE_MODEL, BASE_MODEL)
+    adapter_paths = {name: paths.get(path, path) for name, path in ADAPTERS.items()}
+    if CPU_INT8:
+        from inference.cpu_profile import load_cpu_model
+        model = load_cpu_model(base_model_path, adapter_paths[DEFAULT_ADAPTER], compile_decode=COMPILE_DECODE)
+    elif MERGE_ADAPTER:
+        from inference.merge_adapter import load_merged_model
+        model = load_merged_model(base_model_path, adapter_paths[DEFAULT_ADAPTER], torch_dtype=torch.bfloat16, device_map="auto")
+    else:
+        from transformers import AutoModelForCausalLM
+        from peft import PeftModel
+        # the safetensors files are memory mapped and each tensor is copied straight to its device
+        model = AutoModelForCausalLM.from_pretrained(
+            base_model_path, torch_dtype=torch.bfloat16, low_cpu_mem_usage=True, use_safetensors=True, device_map="auto"
+        )
+        model = PeftModel.from_pretrained(model, adapter_paths[DEFAULT_ADAPTER], adapter_name=DEFAULT_ADAPTER, device_map="auto")
+        for adapter_name, adapter_path in adapter_paths.items():
+            if adapter_name != DEFAULT_ADAPTER:
+                model.load_adapter(adapter_path, adapter_name=adapter_name)
+    model.eval()
+    return model
+
+
+def adapters_merged():
+    """
+    Returns:
+        bool: True if the default adapter is merged into the model weights, so no other adapter can be selected.
+    """
+    # peft is only imported when the adapters are not merged
+    peft = sys.modules.get("peft")
+    return peft is None or not isinstance(model, peft.PeftModel)
+
+
+def resolve_adapters(adapters, batch_size):
+    """
+    Fill in the default adapter and check the requested adapters are loaded.
+    Args:
+        adapters (list): The adapter name of each request, None for the default adapter.
+        batch_size (int): The number of requests.
+    Returns:
+        list: The adapter name of each request.
+    """
+    if adapters is None:
+        adapters = [None] * batch_size
+    adapters = [adapter or DEFAULT_ADAPTER for adapter in adapters]
+    for adapter in adapters:
+        if adapter not in ADAPTERS:
+            raise ValueError(f"Unknown adapter: {adapter}, available adapters: {list(ADAPTERS)}")
+        if adapters_merged() and adapter != DEFAULT_ADAPTER:
+            raise ValueError(f"Only the merged adapter {DEFAULT_ADAPTER} can be used when MERGE_ADAPTER or CPU_INT8 is enabled.")
+    return adapters
+
+
+def validate_adapter(adapter):
+    """
+    Check the adapter of a request when it is submitted, so an unknown adapter fails this request alone
+    instead of the batch it would be grouped into.
+    """
+    resolve_adapters([adapter], 1)
 
 
 def preprocess_prompt(text):
@@ -24,7 +177,254 @@ def preprocess_prompt(text):
     return conversation
 
 
-def generate_summary(text):
+def prepare_generation(texts, adapters, trace):
+    """
+    Tokenize the texts and collect the arguments of `model.generate`.
+    Args:
+        texts (list): The input texts to be summarized.
+        adapters (list): The adapter name of each text, None for the default adapter.
+        trace (RequestTrace): Receives the tokenization and copy times, and the prompt token counts.
+    Returns:
+        tuple: The model inputs, the generation arguments and the length budget of each text.
+    """
+    from transformers import StoppingCriteriaList
+    from inference.budget import BudgetStoppingCriteria, detect_language
+    from inference.metrics import FirstTokenTimer
+    from inference.speculative import speculative_kwargs
+
+    adapters = resolve_adapters(adapters, len(texts))
+    # assisted decoding only supports a single sequence
+    speculative = SPECULATIVE_MODE is not None and len(texts) == 1
+    # the rows of a batch share the prefix KV cache when they use the same adapter
+    use_prefix_cache = USE_PREFIX_CACHE and not speculative and len(set(adapters)) == 1
+    with trace.stage("tokenize"):
+        # Wrap the texts with the pre-tokenized chat template pieces
+        input_ids, trace.truncated_tokens = prompt_template.encode(texts, return_truncated=True)
+        if use_prefix_cache:
+            # the prefix stays at the start of every row, aligned with the cached one
+            inputs = prompt_template.pad_after_prefix(input_ids, tokenizer.pad_token_id)
+        else:
+            inputs = tokenizer.pad({"input_ids": input_ids}, return_tensors="pt")
+    with trace.stage("h2d"):
+        inputs = inputs.to(model.device)
+    trace.prompt_tokens = [len(ids) for ids in input_ids]
+    trace.langs = [detect_language(text) for text in texts]
+    # bound the summary length of each text by its length and language
+    template_length = len(prompt_template.prefix_ids) + len(prompt_template.suffix_ids)
+    budgets = [length_budget(len(ids) - template_length, lang) for ids, lang in zip(input_ids, trace.langs)]
+    stopping_criteria = BudgetStoppingCriteria(inputs["input_ids"].shape[1], budgets, get_stop_token_ids())
+    generation_kwargs = {
+        **GENERATION_PARAMS,
+        "max_new_tokens": max(budgets),
+        "pad_token_id": tokenizer.pad_token_id,
+        # the first call of the stopping criteria marks the end of the prefill
+        "stopping_criteria": StoppingCriteriaList([stopping_criteria, FirstTokenTimer(trace)]),
+    }
+    if not adapters_merged():
+        generation_kwargs["adapter_names"] = adapters
+    if speculative:
+        generation_kwargs.update(speculative_kwargs(SPECULATIVE_MODE, draft_model, PROMPT_LOOKUP_NUM_TOKENS))
+    elif use_prefix_cache:
+        # only the article tokens are prefilled, the prompt prefix is taken from the cache
+        prefix_kwargs = {} if adapters_merged() else {"adapter_names": adapters[:1]}
+        generation_kwargs["past_key_values"] = prefix_cache.get(model, adapters[0], batch_size=len(texts), **prefix_kwargs)
+    return inputs, generation_kwargs, budgets
+
+
+def get_stop_token_ids():
+    """
+    Returns:
+        list: The token ids ending a summary, the eos tokens of the generation config and the pad token.
+    """
+    eos_token_id = model.generation_config.eos_token_id
+    eos_token_ids = eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+    return list(set(eos_token_ids + [tokenizer.eos_token_id, tokenizer.pad_token_id]))
+
+
+def record_budget(completions, budgets, generation_kwargs):
+    """
+    Count the requests which hit their length budget or were stopped as runaway outputs.
+    """
+    stopping_criteria = generation_kwargs["stopping_criteria"][0]
+    length_budget.record(completions, budgets, get_stop_token_ids(), stopping_criteria.num_stopped_repetition)
+
+
+def run_generate(inputs, generation_kwargs, streamer=None, trace=None):
+    """
+    Run `model.generate`, reporting the acceptance rate of assisted decoding.
+    Args:
+        inputs (BatchEncoding): The model inputs.
+        generation_kwargs (dict): The generation arguments.
+        streamer (BaseStreamer): The streamer receiving the generated tokens.
+        trace (RequestTrace): Receives the prefill and decode times.
+    Returns:
+        torch.Tensor: The prompts followed by the generated tokens.
+    """
+    import contextlib
+    import torch
+    from inference.speculative import AcceptanceTracker
+
+    assisted = "assistant_model" in generation_kwargs or "prompt_lookup_num_tokens" in generation_kwargs
+    input_length = inputs["input_ids"].shape[1]
+    tracker = AcceptanceTracker(model, input_length) if assisted else contextlib.nullcontext()
+    start = time.perf_counter()
+    with torch.no_grad(), tracker:
+        outputs = model.generate(**inputs, **generation_kwargs, streamer=streamer)
+    end = time.perf_counter()
+    if assisted:
+        tracker.finish(outputs.shape[1] - input_length)
+    if trace is not None:
+        first_token_time = trace.first_token_time or end
+        trace.add_stage("prefill", first_token_time - start)
+        trace.add_stage("decode", end - first_token_time)
+    return outputs
+
+
+def finish_trace(trace, completions):
+    """
+    Count the generated tokens of a finished request and pass its trace to every hook in `trace_hooks`.
+    A failing hook does not fail the request.
+    """
+    from inference.budget import completion_length
+
+    stop_token_ids = get_stop_token_ids()
+    trace.generated_tokens = [completion_length(tokens, stop_token_ids) for tokens in completions.tolist()]
+    for hook in trace_hooks:
+        try:
+            hook(trace)
+        except Exception as e:
+            logging.warning(f"Trace hook {hook} failed: {e}")
+
+
+def make_summary_cache_namespaces(paths):
+    """
+    Identify how each adapter is served, so the cached summaries are never reused across retrained
+    adapters, serving modes or length settings.
+    Args:
+        paths (dict): The local directory of the base model and adapters.
+    Returns:
+        dict: The summary cache namespace of each adapter name.
+    """
+    from inference.merge_adapter import adapter_revision, resolve_revision
+
+    mode = "cpu_int8" if CPU_INT8 else "merged" if MERGE_ADAPTER else "peft"
+    common = {
+        "base_model": BASE_MODEL,
+        "base_revision": resolve_revision(paths.get(BASE_MODEL, BASE_MODEL)),
+        "mode": mode,
+        "prompt": [SYSTEM_MSG, USER_PROMPT_PREFIX],
+        "length_budget": length_budget.as_dict(),
+        "long_doc": LONG_DOC_POLICY.as_dict(),
+    }
+    return {
+        name: {**common, "adapter": name, "adapter_revision": adapter_revision(paths.get(path, path))}
+        for name, path in ADAPTERS.items()
+    }
+
+
+def export_metrics(path=None):
+    """
+    Export the metrics of the served requests in the Prometheus text format.
+    Args:
+        path (str): Also write them to this file, e.g. for the textfile collector of the node exporter.
+    Returns:
+        str: The metrics.
+    """
+    text = metrics_registry.to_prometheus()
+    if path is not None:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    return text
+
+
+def generate_summaries_uncached(texts, adapters=None):
+    """
+    Run the generation for a batch of texts, without looking up the summary cache.
+    Args:
+        texts (list): The input texts to be summarized.
+        adapters (list): The adapter name of each text, None for the default adapter.
+    Returns:
+        list: The generated summaries, in the same order as the input texts.
+    """
+    from inference.metrics import RequestTrace
+
+    adapters = resolve_adapters(adapters, len(texts))
+    trace = RequestTrace(texts, adapters)
+    inputs, generation_kwargs, budgets = prepare_generation(texts, adapters, trace)
+    outputs = run_generate(inputs, generation_kwargs, trace=trace)
+    # Extract the generated text from the model output
+    input_length = inputs["input_ids"].shape[1]
+    completions = outputs[:, input_length:]
+    record_budget(completions, budgets, generation_kwargs)
+    # Decode the generated text
+    with trace.stage("detokenize"):
+        summaries = tokenizer.batch_decode(completions, skip_special_tokens=True)
+    finish_trace(trace, completions)
+    return summaries
+
+
+def generate_summaries_cached(texts, adapters=None):
+    """
+    Run the generation for a batch of texts, the cached summaries are not generated again
+    with greedy decoding (or CACHE_SAMPLED_SUMMARIES). The long texts are truncated, see `generate_summaries`.
+    Args:
+        texts (list): The input texts to be summarized.
+        adapters (list): The adapter name of each text, None for the default adapter.
+    Returns:
+        list: The generated summaries, in the same order as the input texts.
+    """
+    adapters = resolve_adapters(adapters, len(texts))
+    if GENERATION_PARAMS["do_sample"] and not CACHE_SAMPLED_SUMMARIES:
+        return generate_summaries_uncached(texts, adapters)
+
+    # only the texts missing from the cache are generated
+    keys = [
+        summary_cache.make_key(text, summary_cache_namespaces[adapter], GENERATION_PARAMS)
+        for text, adapter in zip(texts, adapters)
+    ]
+    summaries = [summary_cache.get(key) for key in keys]
+    missing = [i for i, summary in enumerate(summaries) if summary is None]
+    if missing:
+        generated = generate_summaries_uncached([texts[i] for i in missing], [adapters[i] for i in missing])
+        for i, summary in zip(missing, generated):
+            summaries[i] = summary
+            summary_cache.put(keys[i], summary)
+    return summaries
+
+
+def reduce_long_text(text, adapter):
+    """
+    Run the map stages of the long-document mode on a text longer than `LONG_DOC_POLICY.max_input_tokens`.
+    Returns:
+        str: The text to summarize in the final pass, the text itself if it is short enough.
+    """
+    # a text rarely has more tokens than characters, only the long ones need to be counted
+    if len(text) <= LONG_DOC_POLICY.max_input_tokens:
+        return text
+    summarize_fn = lambda chunks: generate_summaries_cached(chunks, [adapter] * len(chunks))
+    return reduce_long(text, summarize_fn, tokenizer, LONG_DOC_POLICY)
+
+
+def generate_summaries(texts, adapters=None):
+    """
+    Batched version of `generate_summary`.
+    The conversations are padded on the left, so that the generated tokens of all samples start at the same position.
+    Each sample can use a different adapter, they are applied per row in the same forward pass.
+    The long texts are summarized chunk by chunk first, then their final pass is batched with the other texts.
+    Args:
+        texts (list): The input texts to be summarized.
+        adapters (list): The adapter name of each text, None for the default adapter.
+    Returns:
+        list: The generated summaries, in the same order as the input texts.
+    """
+    adapters = resolve_adapters(adapters, len(texts))
+    texts = [reduce_long_text(text, adapter) for text, adapter in zip(texts, adapters)]
+    return generate_summaries_cached(texts, adapters)
+
+
+def generate_summary(text, adapter=None):
     """
     1. Preprocess the input text by adding system message and user prompt prefix.
     2. Tokenize the conversation using the tokenizer.
@@ -32,28 +432,39 @@ def generate_summary(text):
     4. Decode the generated text to get the final summary.
     Args:
         text (str): The input text to be summarized.
+        adapter (str): The name of the adapter to use, None for the default adapter.
     Returns:
         str: The generated summary.
     """
-    conversation = preprocess_prompt(text)
-    # Wrap with chat template and tokenize the conversation
-    inputs = tokenizer.apply_chat_template(conversation, return_tensors="pt", truncation=True, max_length=32768, add_generation_prompt=True).to(model.device)
-    attention_mask = torch.ones_like(inputs)
-    with torch.no_grad():
-        outputs = model.generate(
-            inputs,
-            attention_mask=attention_mask,
-            do_sample=True,
-            max_length=32768, #32k
-            temperature=0.7,
-            top_p=0.9,
-        )
-    # Extract the generated text from the model output
-    input_length = inputs.shape[1]
-    completion = outputs[0][input_length:]
-    # Decode the generated text
-    generated_text = tokenizer.decode(completion, skip_special_tokens=True)
-    return generated_text
+    return generate_summaries([text], [adapter])[0]
+
+
+def generate_summary_stream(text, adapter=None):
+    """
+    Streaming version of `generate_summary`, the summary is decoded while it is generated.
+    For a long text, only the final pass of the map-reduce summarization is streamed.
+    Args:
+        text (str): The input text to be summarized.
+        adapter (str): The name of the adapter to use, None for the default adapter.
+    Returns:
+        SummaryStream: Iterable over the pieces of the summary, with the time-to-first-token
+            and inter-token latencies in its `stats` after the iteration.
+    """
+    from inference.metrics import RequestTrace
+    from inference.streaming import SummaryStream
+
+    def generate(streamer):
+        # the tokens are decoded by the streamer during the decode stage
+        adapters = resolve_adapters([adapter], 1)
+        final_text = reduce_long_text(text, adapters[0])
+        trace = RequestTrace([final_text], adapters, mode="streaming")
+        inputs, generation_kwargs, budgets = prepare_generation([final_text], adapters, trace)
+        outputs = run_generate(inputs, generation_kwargs, streamer=streamer, trace=trace)
+        completions = outputs[:, inputs["input_ids"].shape[1]:]
+        record_budget(completions, budgets, generation_kwargs)
+        finish_trace(trace, completions)
+
+    return SummaryStream(tokenizer, generate)
 
 
 def sub_thread_chatbot(user_input):
@@ -65,8 +476,16 @@ def sub_thread_chatbot(user_input):
     """
     try:
         print("generating...\n")
-        summary = generate_summary(user_input)
-        print(f"Here is the summary:\n{summary}\n\n")
+        if STREAM_OUTPUT:
+            print("Here is the summary:")
+            stream = generate_summary_stream(user_input)
+            for piece in stream:
+                print(piece, end="", flush=True)
+            print(f"\n\n{stream.stats.as_dict()}\n\n")
+        else:
+            # the request is queued and may be batched with the other running requests
+            summary = batching_engine.submit(user_input).result()
+            print(f"Here is the summary:\n{summary}\n\n")
     except Exception as e:
         print(f"Error: {e}")
 
@@ -80,14 +499,21 @@ def naive_chat_bot():
         user_input = input("Please input the text you want to summerize (or type 'exit' to quit): \n")
         print("\n")
 
+        if user_input.lower() == "metrics":
+            print(export_metrics())
+            continue
+
         if user_input.lower() == "exit":
+            print(f"Summary cache: {summary_cache.stats()}")
             print("Bye!")
             break
 
-        # Create a new thread for get the summary
+        # Create a new thread for get the summary. Without streaming it is not waited for,
+        # so the next input can be batched with the running ones
         thread = threading.Thread(target=sub_thread_chatbot, args=(user_input,))
         thread.start()
-        thread.join()
+        if STREAM_OUTPUT:
+            thread.join()
 
 
 def example_usage():
@@ -100,16 +526,100 @@ def example_usage():
     print(f"Here is the summary:\n{summary}\n\n")
 
 
-if __name__ == "__main__":
-    # init model and tokenizer
-    tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL)
-    if tokenizer.pad_token is None:
-        tokenizer.pad_token = tokenizer.eos_token
-    model = AutoModelForCausalLM.from_pretrained(BASE_MODEL, torch_dtype=torch.bfloat16, low_cpu_mem_usage=True, device_map="auto")
-    model = PeftModel.from_pretrained(model, PEFT_MODEL_PATH, device_map="auto")
-    model.eval()
+def init_assistant(warmup=WARMUP, tokenizer_override=None, model_override=None):
+    """
+    Load the tokenizer, the model and the serving state of the assistant, and print the time of each startup phase.
+    The checkpoints are resolved (and downloaded if needed) in background threads while torch and transformers are imported.
+    Args:
+        warmup (bool): Run one tiny generation before serving the first request.
+        tokenizer_override (PreTrainedTokenizer): Serve this tokenizer instead of loading the one of BASE_MODEL.
+        model_override (PreTrainedModel): Serve this model instead of loading BASE_MODEL and ADAPTERS, e.g. in the benchmark.
+    """
+    global tokenizer, model, draft_model, prompt_template, prefix_cache, length_budget, summary_cache, batching_engine
+    global metrics_registry, trace_hooks, summary_cache_namespaces
+    timer = StartupTimer()
+    if model_override is not None:
+        tokenizer, model, draft_model = tokenizer_override, model_override, None
+    else:
+        model_paths = [BASE_MODEL, *ADAPTERS.values()]
+        if SPECULATIVE_MODE == "draft":
+            model_paths.append(DRAFT_MODEL)
+        prefetcher = CheckpointPrefetcher(model_paths)
+
+        with timer.phase("import torch/transformers"):
+            import torch  # noqa: F401
+            import transformers  # noqa: F401
+        with timer.phase("wait for checkpoints"):
+            paths = prefetcher.result()
+        timer.add("resolve checkpoints (background)", prefetcher.elapsed)
+
+        # init model and tokenizer
+        with timer.phase("load tokenizer"):
+            tokenizer = load_tokenizer(paths[BASE_MODEL])
+        with timer.phase("load model"):
+            model = load_model(paths)
+            draft_model = None
+            if SPECULATIVE_MODE == "draft":
+                if not adapters_merged():
+                    # the adapter arguments of the target model would be forwarded to the draft model
+                    raise ValueError("SPECULATIVE_MODE 'draft' needs the adapter to be merged, set MERGE_ADAPTER or CPU_INT8.")
+                from inference.speculative import load_draft_model
+                draft_model = load_draft_model(paths[DRAFT_MODEL], model.device, torch_dtype=model.dtype)
+    print(f"Successfully loaded Model and Adapters {list(ADAPTERS)} on device: {model.device}")
+
+    with timer.phase("prepare serving state"):
+        from inference.prefix_cache import PrefixCache, PromptTemplate
+        from inference.budget import LengthBudget
+        # tokenize the chat template once, the prefix KV cache is filled by the first request
+        prompt_template = PromptTemplate(tokenizer, preprocess_prompt(PromptTemplate.PLACEHOLDER))
+        prefix_cache = PrefixCache(prompt_template)
+        if model_override is None:
+            length_budget = LengthBudget.load_or_compute(tokenizer, XLSUM_DATASET_DIR, LENGTH_STATS_PATH)
+        else:
+            # the saved statistics were measured with the tokenizer of BASE_MODEL
+            length_budget = LengthBudget()
+        if model_override is None:
+            summary_cache = SummaryCache(max_entries=SUMMARY_CACHE_SIZE, cache_dir=SUMMARY_CACHE_DIR, max_disk_entries=SUMMARY_CACHE_DISK_ENTRIES)
+            summary_cache_namespaces = make_summary_cache_namespaces(paths)
+        else:
+            # the overriding model has no revision, its summaries are only kept in memory
+            summary_cache = SummaryCache(max_entries=SUMMARY_CACHE_SIZE)
+            summary_cache_namespaces = {name: {"adapter": name, "model_override": type(model).__name__} for name in ADAPTERS}
+        from inference.metrics import MetricsRegistry, log_trace
+        # more hooks can be appended, they are called with the `RequestTrace` of every generation call
+        metrics_registry = MetricsRegistry()
+        trace_hooks = [metrics_registry.record_trace]
+        if LOG_REQUEST_TRACES:
+            trace_hooks.append(log_trace)
 
-    print(f"Successfully loaded Model and Adapter on device: {model.device}")
+    if NUM_WORKERS > 0:
+        if model.device.type != "cpu":
+            raise ValueError("NUM_WORKERS needs a model on CPU, CUDA can not be used in forked processes.")
+        from inference.workers import PreforkWorkerPool
+        # the workers warm up on their own, running torch in this process before forking is not fork-safe
+        worker_init_fn = (lambda: generate_summaries_uncached([WARMUP_TEXT])) if warmup else None
+        with timer.phase("fork workers"):
+            batching_engine = PreforkWorkerPool(
+                generate_summaries,
+                num_workers=NUM_WORKERS,
+                max_batch_size=MAX_BATCH_SIZE,
+                max_wait_ms=MAX_WAIT_MS,
+                worker_init_fn=worker_init_fn,
+                validate_fn=validate_adapter,
+            )
+    else:
+        # group the concurrent requests into micro-batches
+        batching_engine = BatchingEngine(
+            generate_summaries, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, validate_fn=validate_adapter
+        )
+        if warmup:
+            with timer.phase("warm up"):
+                generate_summaries_uncached([WARMUP_TEXT])
+    timer.report()
+
+
+if __name__ == "__main__":
+    init_assistant()
 
     # Uncomment the following line to run the chatbot
     naive_chat_bot()
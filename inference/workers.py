@@ -0,0 +1,331 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, wait as wait_futures
+from multiprocessing.connection import wait
+
+
+def _worker_loop(worker_id, incarnation, batches, results, batch_fn, num_threads, worker_init_fn):
+    """
+    The main loop of a worker process: announce it is idle, run the micro-batch it is given
+    with `batch_fn` and send back the results.
+    """
+    import torch
+
+    torch.set_num_threads(num_threads)
+    if worker_init_fn is not None:
+        worker_init_fn()
+    while True:
+        results.put(("ready", worker_id, incarnation))
+        batch = batches.recv()
+        if batch is None:
+            break
+        _run_batch(batch, results, batch_fn)
+
+
+def _run_batch(batch, results, batch_fn):
+    """
+    Run a micro-batch and send back its results. When the batch fails, its requests are run again one by one,
+    so only the failing requests get the error.
+    """
+    try:
+        summaries = batch_fn([text for _, text, _ in batch], [adapter for _, _, adapter in batch])
+        if len(summaries) != len(batch):
+            raise RuntimeError(f"batch_fn returned {len(summaries)} results for {len(batch)} requests.")
+    except Exception as e:
+        if len(batch) > 1:
+            for request in batch:
+                _run_batch([request], results, batch_fn)
+        else:
+            # the exception may not be picklable
+            results.put(("error", batch[0][0], f"{type(e).__name__}: {e}"))
+        return
+    for (request_id, _, _), summary in zip(batch, summaries):
+        results.put(("done", request_id, summary))
+
+
+def _fork_server(num_workers, commands, results, worker_args, poll_interval=0.2):
+    """
+    The main loop of the fork server: a single-threaded process forked before the pool starts any thread.
+    It forks the workers, forwards them their micro-batches, and reports and replaces the workers exiting
+    unexpectedly. The workers forked from it share the model weights copy-on-write like the first ones.
+    """
+    incarnations = itertools.count()
+    workers = {}  # worker id -> (pid, incarnation, connection sending its batches)
+
+    def start_worker(worker_id):
+        incarnation = next(incarnations)
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        pid = os.fork()
+        if pid == 0:
+            writer.close()
+            # only the fork server keeps the pipes of the other workers, they see it exiting
+            for _, _, other_writer in workers.values():
+                other_writer.close()
+            code = 0
+            try:
+                _worker_loop(worker_id, incarnation, reader, results, *worker_args)
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                # never return into the loop of the fork server
+                os._exit(code)
+        reader.close()
+        workers[worker_id] = (pid, incarnation, writer)
+
+    for worker_id in range(num_workers):
+        start_worker(worker_id)
+    closing = False
+    while workers:
+        if not closing and wait([commands], timeout=poll_interval):
+            command = commands.recv()
+            if command is None:
+                # stop the workers once they are idle
+                closing = True
+                for _, _, writer in workers.values():
+                    try:
+                        writer.send(None)
+                    except OSError:
+                        pass
+            else:
+                worker_id, incarnation, batch = command
+                pid, current, writer = workers.get(worker_id, (None, None, None))
+                # a batch sent to a worker which was replaced in the meantime is dropped, its futures are failed
+                if current == incarnation:
+                    try:
+                        writer.send(batch)
+                    except OSError:
+                        pass
+        elif closing:
+            time.sleep(poll_interval)
+        while workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            worker_id = next((w for w, (p, _, _) in workers.items() if p == pid), None)
+            if worker_id is None:
+                continue
+            _, incarnation, writer = workers.pop(worker_id)
+            writer.close()
+            results.put(("exited", worker_id, (incarnation, os.waitstatus_to_exitcode(status))))
+            if not closing:
+                start_worker(worker_id)
+
+
+class PreforkWorkerPool:
+    """
+    Runs the summarization in several worker processes forked from the current one.
+    The model is loaded once before the pool is created, the workers share its weights read-only
+    through the copy-on-write pages of fork, so N workers take about the memory of one model.
+    The workers are forked by a fork server, itself forked before the pool starts its threads,
+    so the crashed workers are replaced without forking this multi-threaded process.
+    The requests go into a queue, each micro-batch is given to an idle worker, so the requests
+    of a crashed worker are always known and failed.
+    Forking a process using CUDA is not supported, so the model has to be on CPU.
+    Args:
+        batch_fn (callable): Function taking a list of texts and a list of adapter names, returning a list of summaries.
+        num_workers (int): The number of worker processes.
+        num_threads (int): The torch threads of each worker, None to split the physical cores between the workers.
+        max_batch_size (int): The maximum number of requests in one batch.
+        max_wait_ms (float): How long to wait for more requests before giving a partial batch to an idle worker.
+        worker_init_fn (callable): Function run once in every worker before the first request, e.g. a warm-up.
+        validate_fn (callable): Function taking the adapter name of a request and raising ValueError if it can not
+            be served, called at submission so an invalid request fails alone instead of failing its batch.
+    """
+
+    def __init__(self, batch_fn, num_workers=2, num_threads=None, max_batch_size=8, max_wait_ms=10, worker_init_fn=None, validate_fn=None):
+        if num_threads is None:
+            num_threads = max(1, (os.cpu_count() or 2) // 2 // num_workers)
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.validate_fn = validate_fn
+        self._ctx = multiprocessing.get_context("fork")
+        # the results are written synchronously, so the messages of a crashing worker are not lost in a feeder thread
+        self._results = self._ctx.SimpleQueue()
+        commands_reader, self._commands = self._ctx.Pipe(duplex=False)
+        self._requests = queue.Queue()
+        self._pending = deque()
+        self._idle = queue.Queue()
+        self._futures = {}
+        self._in_flight = {}
+        self._incarnations = {}
+        self._lock = threading.Lock()
+        self._request_ids = itertools.count()
+        self._closed = False
+        # fork the fork server before starting any thread in this process
+        self._server = self._ctx.Process(
+            target=_fork_server,
+            args=(num_workers, commands_reader, self._results, (batch_fn, num_threads, worker_init_fn)),
+            daemon=True,
+        )
+        self._server.start()
+        commands_reader.close()
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+        self._monitor = threading.Thread(target=self._monitor_server, daemon=True)
+        self._monitor.start()
+
+    def submit(self, text, adapter=None):
+        """
+        Put a text into the request queue.
+        Args:
+            text (str): The input text to be summarized.
+            adapter (str): The name of the adapter to use, None for the default adapter.
+        Returns:
+            Future: A future resolving to the generated summary, failed at once if `validate_fn` rejects the request.
+        """
+        if self._closed:
+            raise RuntimeError("PreforkWorkerPool is closed.")
+        future = Future()
+        future.set_running_or_notify_cancel()
+        if self.validate_fn is not None:
+            try:
+                self.validate_fn(adapter)
+            except ValueError as e:
+                future.set_exception(e)
+                return future
+        request_id = next(self._request_ids)
+        with self._lock:
+            self._futures[request_id] = future
+        self._requests.put((request_id, text, adapter))
+        return future
+
+    def _next_request(self, timeout=None):
+        if self._pending:
+            return self._pending.popleft()
+        return self._requests.get(timeout=timeout)
+
+    def _collect_batch(self):
+        """
+        Block until one request is available, then gather more requests until
+        the batch is full or the waiting time is over.
+        Returns:
+            list: (request id, text, adapter) tuples, or None if the pool is closed.
+        """
+        request = self._next_request()
+        if request is None:
+            return None
+        batch = [request]
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._next_request(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # put the sentinel back so the loop stops after this batch
+                self._requests.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _dispatch(self):
+        """
+        Give the queued requests to the idle workers, in micro-batches.
+        """
+        while True:
+            worker_id, incarnation = self._idle.get()
+            if worker_id is None:
+                break
+            with self._lock:
+                if self._incarnations.get(worker_id) != incarnation:
+                    # the worker exited after announcing it was idle
+                    continue
+            batch = self._collect_batch()
+            if batch is None:
+                break
+            with self._lock:
+                if self._incarnations.get(worker_id) != incarnation:
+                    # requeue the batch at the front, for the next idle worker
+                    self._pending.extendleft(reversed(batch))
+                    continue
+                # recorded before sending, so the batch is failed if the worker exits while running it
+                self._in_flight[worker_id] = [request_id for request_id, _, _ in batch]
+                self._commands.send((worker_id, incarnation, batch))
+
+    def _collect(self):
+        """
+        Resolve the futures with the results of the workers, and fail the requests of the crashed workers.
+        """
+        while True:
+            message = self._results.get()
+            if message is None:
+                break
+            kind, key, value = message
+            if kind == "ready":
+                with self._lock:
+                    self._in_flight.pop(key, None)
+                    self._incarnations[key] = value
+                self._idle.put((key, value))
+                continue
+            if kind == "exited":
+                self._worker_exited(key, *value)
+                continue
+            with self._lock:
+                future = self._futures.pop(key, None)
+            if future is None:
+                continue
+            if kind == "done":
+                future.set_result(value)
+            else:
+                future.set_exception(RuntimeError(value))
+
+    def _worker_exited(self, worker_id, incarnation, exitcode):
+        with self._lock:
+            if self._incarnations.get(worker_id) == incarnation:
+                del self._incarnations[worker_id]
+            request_ids = self._in_flight.pop(worker_id, [])
+            futures = [self._futures.pop(request_id, None) for request_id in request_ids]
+        if not self._closed:
+            print(f"Worker {worker_id} exited with code {exitcode}, restarting it.")
+        for future in futures:
+            if future is not None:
+                future.set_exception(RuntimeError(f"Worker {worker_id} crashed while running the request."))
+
+    def _monitor_server(self):
+        """
+        Fail every request if the fork server itself dies, no worker would run them.
+        """
+        while not self._closed:
+            self._server.join(timeout=1)
+            if self._server.exitcode is not None and not self._closed:
+                print(f"The fork server of the workers exited with code {self._server.exitcode}.")
+                self._closed = True
+                with self._lock:
+                    futures = list(self._futures.values())
+                    self._futures.clear()
+                for future in futures:
+                    future.set_exception(RuntimeError("The worker pool is down."))
+                self._idle.put((None, None))
+
+    def close(self):
+        """
+        Stop the workers after the queued requests are finished.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._requests.put(None)
+        self._dispatcher.join()
+        with self._lock:
+            futures = list(self._futures.values())
+        wait_futures(futures)
+        self._commands.send(None)
+        self._server.join()
+        self._results.put(None)
+        self._collector.join()
+        self._monitor.join()
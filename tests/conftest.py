@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+# the modules are imported from the repository root, like with `export PYTHONPATH=$SUM_ADPT_ROOT`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class WordTokenizer:
+    """A stand-in tokenizer with one token per whitespace-separated word."""
+
+    def __call__(self, texts, add_special_tokens=False):
+        if isinstance(texts, str):
+            return {"input_ids": list(range(len(texts.split())))}
+        return {"input_ids": [list(range(len(text.split()))) for text in texts]}
+
+    def decode(self, ids):
+        return " ".join("w" for _ in ids)
+
+
+@pytest.fixture
+def word_tokenizer():
+    return WordTokenizer()
@@ -0,0 +1,80 @@
+import threading
+
+import pytest
+
+from inference.batching import BatchingEngine
+
+
+def validate(adapter):
+    if adapter not in (None, "dpo"):
+        raise ValueError(f"Unknown adapter: {adapter}")
+
+
+def test_concurrent_requests_are_batched():
+    batches = []
+
+    def batch_fn(texts, adapters):
+        batches.append(list(texts))
+        return [text.upper() for text in texts]
+
+    engine = BatchingEngine(batch_fn, max_batch_size=4, max_wait_ms=200)
+    try:
+        futures = [engine.submit(text) for text in "abcdef"]
+        assert [f.result(timeout=10) for f in futures] == list("ABCDEF")
+    finally:
+        engine.close()
+    assert [len(batch) for batch in batches] == [4, 2]
+
+
+def test_cancelled_requests_are_skipped():
+    started, release = threading.Event(), threading.Event()
+    seen = []
+
+    def batch_fn(texts, adapters):
+        started.set()
+        release.wait(10)
+        seen.extend(texts)
+        return texts
+
+    engine = BatchingEngine(batch_fn, max_batch_size=1, max_wait_ms=0)
+    try:
+        first = engine.submit("first")
+        started.wait(10)
+        cancelled = engine.submit("cancelled")
+        assert cancelled.cancel()
+        last = engine.submit("last")
+        release.set()
+        assert first.result(timeout=10) == "first" and last.result(timeout=10) == "last"
+    finally:
+        engine.close()
+    assert seen == ["first", "last"]
+
+
+def test_invalid_request_fails_alone():
+    def batch_fn(texts, adapters):
+        if "bad" in texts:
+            raise RuntimeError("bad input")
+        return texts
+
+    engine = BatchingEngine(batch_fn, max_batch_size=8, max_wait_ms=200, validate_fn=validate)
+    try:
+        unknown = engine.submit("a", adapter="typo")
+        with pytest.raises(ValueError, match="Unknown adapter"):
+            unknown.result(timeout=0)
+        futures = [engine.submit(text) for text in ["a", "bad", "c"]]
+        assert futures[0].result(timeout=10) == "a" and futures[2].result(timeout=10) == "c"
+        with pytest.raises(RuntimeError, match="bad input"):
+            futures[1].result(timeout=10)
+    finally:
+        engine.close()
+
+
+def test_short_results_fail_the_requests():
+    engine = BatchingEngine(lambda texts, adapters: [], max_batch_size=2, max_wait_ms=200)
+    try:
+        futures = [engine.submit(text) for text in "ab"]
+        for future in futures:
+            with pytest.raises(RuntimeError, match="0 results for 1 requests"):
+                future.result(timeout=10)
+    finally:
+        engine.close()
@@ -0,0 +1,36 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from inference.budget import BudgetStoppingCriteria
+
+PROMPT = [11, 12, 13]
+EOS = 2
+
+
+def run_criteria(generated):
+    """Feed the generated tokens one by one, like `generate`, and return whether the sequence was stopped."""
+    criteria = BudgetStoppingCriteria(len(PROMPT), [256], [EOS])
+    for step in range(1, len(generated) + 1):
+        input_ids = torch.tensor([PROMPT + generated[:step]])
+        if criteria(input_ids, None).item():
+            return True, criteria.num_stopped_repetition
+    return False, criteria.num_stopped_repetition
+
+
+def test_digit_run_is_not_stopped():
+    # "raised 1000000000 dollars", the digits are one token each
+    generated = [20, 21, 1] + [0] * 9 + [22, 23]
+    assert run_criteria(generated) == (False, 0)
+
+
+def test_repeated_phrase_is_stopped():
+    phrase = [30, 31, 32, 33, 34, 35]
+    stopped, num_stopped = run_criteria([20, 21] + phrase * 5)
+    assert stopped and num_stopped == 1
+
+
+def test_long_single_token_run_is_stopped():
+    stopped, num_stopped = run_criteria([20] + [0] * 30)
+    assert stopped and num_stopped == 1
@@ -0,0 +1,66 @@
+import json
+
+import pytest
+
+from utils.judge_cache import JudgeCache, ProgressJournal, journal_path
+
+
+def record(i):
+    return {"text": f"article {i}", "reference": f"reference {i}", "candidate": f"candidate {i}"}
+
+
+def test_judge_cache_persists_responses(tmp_path):
+    path = str(tmp_path / "cache" / "judge.sqlite")
+    with JudgeCache(path) as cache:
+        assert cache.get("prompt", "judge") is None
+        cache.put("prompt", "judge", "[[4]] [[5]]")
+    with JudgeCache(path) as cache:
+        assert cache.get("prompt", "judge") == "[[4]] [[5]]"
+        assert cache.get("prompt", "other judge") is None
+        assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_journal_drops_the_cut_last_line(tmp_path):
+    path = str(tmp_path / "prompts.jsonl.judge_progress")
+    with ProgressJournal(path) as journal:
+        journal.append("a", [4, 5])
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"key": "b", "res')
+    with ProgressJournal(path) as journal:
+        assert "a" in journal and "b" not in journal
+        journal.append("b", [6, 7])
+    with ProgressJournal(path) as journal:
+        assert journal.get("a") == [4, 5] and journal.get("b") == [6, 7]
+    with open(path, encoding="utf-8") as f:
+        assert [json.loads(line)["key"] for line in f] == ["a", "b"]
+
+
+def test_resume_judges_only_the_changed_lines(tmp_path, monkeypatch):
+    pytest.importorskip("openai")
+    pytest.importorskip("httpx")
+    from utils import llm_judge_utils
+
+    judged = []
+
+    def fake_judge_prompts(prompts, on_result=None, **kwargs):
+        for index, prompt in enumerate(prompts):
+            judged.append(prompt)
+            scores = [5, int(prompt.split("candidate ")[-1].split()[0])]
+            on_result(index, scores)
+
+    monkeypatch.setattr(llm_judge_utils, "judge_prompts", fake_judge_prompts)
+    file_path = str(tmp_path / "prompts.jsonl")
+    cache_path = str(tmp_path / "judge.sqlite")
+
+    results = llm_judge_utils.judge_files({file_path: [record(1), record(2)]}, cache_path=cache_path, batch=False)
+    assert results[file_path] == [[5, 1], [5, 2]] and len(judged) == 2
+
+    # the file is regenerated: a line is replaced and another one is appended
+    judged.clear()
+    records = [record(1), record(3), record(2)]
+    results = llm_judge_utils.judge_files({file_path: records}, cache_path=cache_path, batch=False)
+    assert results[file_path] == [[5, 1], [5, 3], [5, 2]]
+    assert len(judged) == 1 and "candidate 3" in judged[0]
+
+    with open(journal_path(file_path), encoding="utf-8") as f:
+        assert len(f.readlines()) == 3
@@ -0,0 +1,18 @@
+from utils.judge_prompts import multi_candidate_batch, parse_labeled_scores, parse_scores
+
+
+def test_unlabeled_scores_are_taken_in_order():
+    assert parse_scores("[[4]] [[5]]") == [4, 5]
+    assert parse_labeled_scores("[[4]] [[15]] [[6]]") == {(None, 1): 4, (None, 3): 6}
+    batch = multi_candidate_batch("text", "reference", [(0, "candidate")])
+    assert batch.parse("[[4]] [[5]]") == [[4, 5]]
+
+
+def test_labeled_scores():
+    result = "article1: summary1: [[3]], summary2: [[4]]\narticle2: summary2: [[1]], summary1: [[7]]"
+    assert parse_labeled_scores(result) == {(1, 1): 3, (1, 2): 4, (2, 1): 7, (2, 2): 1}
+
+
+def test_example_scores_vary():
+    batch = multi_candidate_batch("text", "reference", [(i, f"candidate {i}") for i in range(3)])
+    assert "summary1: [[7]], summary2: [[3]], summary3: [[9]], summary4: [[5]]" in batch.prompt
@@ -0,0 +1,17 @@
+from inference.long_doc import ChunkingPolicy, chunk_text, split_sentences
+
+
+def test_split_keeps_decimals_and_abbreviations():
+    assert split_sentences("Sales rose 3.5% in the U.S. last year.") == ["Sales rose 3.5% in the U.S.", "last year."]
+
+
+def test_split_cjk_and_newlines():
+    assert split_sentences("這是第一句。這是第二句！\nNext line? Yes") == ["這是第一句。", "這是第二句！", "Next line?", "Yes"]
+
+
+def test_chunks_do_not_cut_numbers(word_tokenizer):
+    text = " ".join(f"Revenue grew {i}.5% to 1.2 billion." for i in range(20))
+    policy = ChunkingPolicy(max_input_tokens=10, max_chunk_tokens=12, overlap_sentences=0)
+    chunks = chunk_text(text, word_tokenizer, policy)
+    assert len(chunks) == 10
+    assert all(chunk.startswith("Revenue grew") and chunk.endswith("billion.") for chunk in chunks)
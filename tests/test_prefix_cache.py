@@ -0,0 +1,47 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("tokenizers")
+
+from inference import summerization_assistant as assistant
+from inference.benchmark import build_tiny_model, build_tiny_tokenizer
+from inference.prefix_cache import PrefixCache, PromptTemplate
+
+TEXTS = ["A short article.", "A somewhat longer article about the weather of the week.", "Rain."]
+
+
+def test_batched_prefix_cache_gives_the_logits_of_the_full_prefill():
+    tokenizer = build_tiny_tokenizer()
+    model = build_tiny_model(tokenizer)
+    template = PromptTemplate(tokenizer, assistant.preprocess_prompt(PromptTemplate.PLACEHOLDER))
+    input_ids = template.encode(TEXTS)
+    with torch.no_grad():
+        full = tokenizer.pad({"input_ids": input_ids}, return_tensors="pt")
+        expected = model(**full).logits[:, -1]
+
+        inputs = template.pad_after_prefix(input_ids, tokenizer.pad_token_id)
+        prefix_length = len(template.prefix_ids)
+        position_ids = (inputs["attention_mask"].cumsum(-1) - 1).clamp(min=0)
+        logits = model(
+            input_ids=inputs["input_ids"][:, prefix_length:],
+            attention_mask=inputs["attention_mask"],
+            position_ids=position_ids[:, prefix_length:],
+            past_key_values=PrefixCache(template).get(model, "base", batch_size=len(TEXTS)),
+        ).logits[:, -1]
+    torch.testing.assert_close(logits, expected, atol=1e-4, rtol=1e-4)
+
+
+def test_batched_generation_with_the_prefix_cache_matches_without(monkeypatch):
+    tokenizer = build_tiny_tokenizer()
+    monkeypatch.setattr(assistant, "GENERATION_PARAMS", {"do_sample": False})
+    monkeypatch.setattr(assistant, "LOG_REQUEST_TRACES", False)
+    assistant.init_assistant(warmup=False, tokenizer_override=tokenizer, model_override=build_tiny_model(tokenizer))
+    try:
+        monkeypatch.setattr(assistant, "USE_PREFIX_CACHE", False)
+        expected = assistant.generate_summaries_uncached(TEXTS)
+        monkeypatch.setattr(assistant, "USE_PREFIX_CACHE", True)
+        assert assistant.generate_summaries_uncached(TEXTS) == expected
+        assert assistant.prefix_cache._caches
+    finally:
+        assistant.batching_engine.close()
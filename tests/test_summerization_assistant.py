@@ -0,0 +1,44 @@
+from inference import summerization_assistant as assistant
+from inference.batching import BatchingEngine
+from inference.long_doc import ChunkingPolicy
+
+
+def test_batched_path_summarizes_long_texts_chunk_by_chunk(monkeypatch, word_tokenizer):
+    policy = ChunkingPolicy(max_input_tokens=20, max_chunk_tokens=10, overlap_sentences=0, batch_size=4)
+    generated = []
+
+    def fake_generate(texts, adapters=None):
+        generated.extend(texts)
+        return [f"summary of {len(text.split())} words." for text in texts]
+
+    monkeypatch.setattr(assistant, "LONG_DOC_POLICY", policy)
+    monkeypatch.setattr(assistant, "tokenizer", word_tokenizer, raising=False)
+    monkeypatch.setattr(assistant, "model", None, raising=False)
+    monkeypatch.setattr(assistant, "GENERATION_PARAMS", {"do_sample": True})
+    monkeypatch.setattr(assistant, "generate_summaries_uncached", fake_generate)
+
+    long_text = " ".join(f"This is sentence number {i} of the article." for i in range(30))
+    engine = BatchingEngine(assistant.generate_summaries, max_batch_size=8, max_wait_ms=50)
+    try:
+        long_future = engine.submit(long_text)
+        short_future = engine.submit("A short article.")
+        assert short_future.result(timeout=10) == "summary of 3 words."
+        assert long_future.result(timeout=10).startswith("summary of")
+    finally:
+        engine.close()
+
+    # no generation saw a text longer than the policy allows, the long text was never truncated
+    assert long_text not in generated
+    assert all(len(text.split()) <= policy.max_input_tokens for text in generated)
+    assert len(generated) > 2
+
+
+def test_unknown_adapter_fails_at_submission(monkeypatch):
+    monkeypatch.setattr(assistant, "model", None, raising=False)
+    engine = BatchingEngine(lambda texts, adapters: texts, max_batch_size=8, max_wait_ms=50, validate_fn=assistant.validate_adapter)
+    try:
+        typo = engine.submit("An article.", adapter="dop")
+        assert isinstance(typo.exception(timeout=0), ValueError)
+        assert engine.submit("An article.", adapter=assistant.DEFAULT_ADAPTER).result(timeout=10) == "An article."
+    finally:
+        engine.close()
@@ -0,0 +1,41 @@
+import functools
+import os
+import shutil
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("peft")
+pytest.importorskip("pyarrow")
+pytest.importorskip("tokenizers")
+
+from eval import sweep_checkpoints
+from inference.benchmark import build_tiny_tokenizer
+from utils.xlsum_store import store_path, write_records
+
+
+def make_sweep(tmp_path):
+    return sweep_checkpoints.CheckpointSweep(
+        str(tmp_path / "base"), ["en_xlsum"], str(tmp_path / "data"), cache_path=str(tmp_path / "cache.sqlite")
+    )
+
+
+def test_cache_keys_follow_the_prompt(tmp_path, monkeypatch):
+    build_tiny_tokenizer().save_pretrained(str(tmp_path / "base"))
+    data_file = store_path(str(tmp_path / "data"), "english", "test")
+    os.makedirs(os.path.dirname(data_file))
+    write_records([{"id": str(i), "article": f"Article {i}.", "summary": f"Summary {i}."} for i in range(3)], data_file)
+    tasks_dir = tmp_path / "tasks"
+    shutil.copytree(os.path.join(sweep_checkpoints.TASKS_DIR, "en_xlsum"), str(tasks_dir / "en_xlsum"))
+    monkeypatch.setattr(sweep_checkpoints, "load_task", functools.partial(sweep_checkpoints.load_task, tasks_dir=str(tasks_dir)))
+
+    sweep = make_sweep(tmp_path)
+    keys = sweep.doc_keys("adapter", sweep.tasks[0])
+    assert make_sweep(tmp_path).doc_keys("adapter", sweep.tasks[0]) == keys
+
+    # editing the prompt of the task yaml changes every key
+    yaml_path = tasks_dir / "en_xlsum" / "en_xlsum.yaml"
+    yaml_path.write_text(yaml_path.read_text(encoding="utf-8").replace("Summarize the following text", "Summarize this text"), encoding="utf-8")
+    edited = make_sweep(tmp_path)
+    assert not set(edited.doc_keys("adapter", edited.tasks[0])) & set(keys)
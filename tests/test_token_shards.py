@@ -0,0 +1,37 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("pyarrow")
+pytest.importorskip("tokenizers")
+pytest.importorskip("accelerate")
+
+from transformers import TrainingArguments
+
+from inference.benchmark import build_tiny_model, build_tiny_tokenizer
+from utils.token_shards import IGNORE_INDEX, TokenShardDataset, build_token_shard, pretokenized_trainer
+from utils.xlsum_store import write_records
+
+
+def test_pretokenized_trainer_collates_a_batch(tmp_path):
+    data_file = str(tmp_path / "train.parquet")
+    write_records(
+        [{"id": str(i), "article": f"Article number {i} about the weather.", "summary": f"Summary {i}."} for i in range(6)],
+        data_file,
+    )
+    tokenizer = build_tiny_tokenizer()
+    shard_dir = build_token_shard(data_file, tokenizer, 256, str(tmp_path / "shards"))
+    dataset = TokenShardDataset([shard_dir], packed=True)
+
+    # the default of TrainingArguments, as with the SFTConfig of the training script
+    args = TrainingArguments(output_dir=str(tmp_path / "out"), per_device_train_batch_size=2, report_to=[], use_cpu=True)
+    assert args.remove_unused_columns
+    model = build_tiny_model(tokenizer)
+    trainer = pretokenized_trainer(model, args, dataset)
+
+    batch = next(iter(trainer.get_train_dataloader()))
+    assert set(batch) == {"input_ids", "labels", "position_ids"}
+    assert batch["input_ids"].shape == batch["labels"].shape == batch["position_ids"].shape
+    assert (batch["labels"] != IGNORE_INDEX).any()
+    loss = trainer.compute_loss(model, batch)
+    assert torch.isfinite(loss)
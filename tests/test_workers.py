@@ -0,0 +1,26 @@
+import os
+import signal
+
+import pytest
+
+pytest.importorskip("torch")
+
+from inference.workers import PreforkWorkerPool
+
+
+def batch_fn(texts, adapters):
+    if "crash" in texts:
+        os.kill(os.getpid(), signal.SIGKILL)
+    return [f"{os.getpid()}:{text}" for text in texts]
+
+
+def test_crashed_worker_fails_its_requests_and_is_replaced():
+    pool = PreforkWorkerPool(batch_fn, num_workers=1, num_threads=1, max_batch_size=4, max_wait_ms=10)
+    try:
+        first_pid = pool.submit("a").result(timeout=60).split(":")[0]
+        with pytest.raises(RuntimeError, match="crashed"):
+            pool.submit("crash").result(timeout=60)
+        pid, text = pool.submit("b").result(timeout=60).split(":")
+        assert text == "b" and pid != first_pid
+    finally:
+        pool.close()
@@ -7,9 +7,12 @@ from transformers import (
     AutoTokenizer,
     set_seed,
 )
+from accelerate import PartialState
 from peft import LoraConfig, TaskType, get_peft_model
 from omegaconf import DictConfig, OmegaConf
 from hydra.utils import get_original_cwd
+from utils.xlsum_store import to_messages
+from utils.token_shards import TokenShardDataset, build_token_shard, pretokenized_trainer
 
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s",
@@ -72,17 +75,32 @@ def main(cfg: DictConfig):
     training_cfg["eos_token"] = tokenizer.eos_token
     training_args = SFTConfig(**training_cfg)
 
-    # Setup the dataset
-    train_dataset = load_dataset("json", data_files=train_files)["train"]
-    val_dataset = load_dataset("json", data_files=val_files)["train"]
+    if cfg.data.pretokenize:
+        # the conversations are tokenized and packed once into memory-mapped shards,
+        # built by the first rank of each node and read by all of them
+        cache_dir = current_path + cfg.data.token_cache_dir
+        with PartialState().local_main_process_first():
+            train_shards = [build_token_shard(f, tokenizer, training_cfg["max_length"], cache_dir) for f in train_files]
+            val_shards = [build_token_shard(f, tokenizer, training_cfg["max_length"], cache_dir) for f in val_files]
+        train_dataset = TokenShardDataset(train_shards, packed=training_cfg["packing"])
+        val_dataset = TokenShardDataset(val_shards, packed=training_cfg["eval_packing"])
 
-    # Set up the SFT trainer
-    trainer = SFTTrainer(
-        model,
-        train_dataset=train_dataset,
-        eval_dataset=val_dataset,
-        args=training_args,
-    )
+        # the shards already hold the loss masks, the sequences of a batch are flattened for flash attention
+        trainer = pretokenized_trainer(model, training_args, train_dataset, val_dataset)
+    else:
+        # Setup the dataset, the store only keeps id/article/summary, the conversations are built here
+        train_dataset = load_dataset("parquet", data_files=train_files)["train"]
+        train_dataset = train_dataset.map(to_messages, remove_columns=train_dataset.column_names)
+        val_dataset = load_dataset("parquet", data_files=val_files)["train"]
+        val_dataset = val_dataset.map(to_messages, remove_columns=val_dataset.column_names)
+
+        # Set up the SFT trainer
+        trainer = SFTTrainer(
+            model,
+            train_dataset=train_dataset,
+            eval_dataset=val_dataset,
+            args=training_args,
+        )
     trainer.train()
 
 
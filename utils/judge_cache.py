@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+JOURNAL_SUFFIX = ".judge_progress"
+
+
+def journal_path(file_path):
+    """
+    Returns:
+        str: The path of the progress journal of an input file.
+    """
+    return file_path + JOURNAL_SUFFIX
+
+
+class JudgeCache:
+    """
+    Persistent cache of the LLM judge responses, in a SQLite database shared by the preference dataset
+    and win rate scripts. The key is the hash of the prompt and the judge model, so a prompt judged once
+    is never sent again to the same model, across reruns and scripts.
+    Args:
+        path (str): The path of the database file, created with its parent directory if missing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        # WAL lets several jobs read the cache while one of them writes
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT NOT NULL, response TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def make_key(prompt, model):
+        """
+        Returns:
+            str: The hex digest identifying the prompt and the judge model.
+        """
+        content = json.dumps({"prompt": prompt, "model": model}, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, prompt, model):
+        """
+        Returns:
+            str: The cached response of the judge, None if the prompt was not judged by this model.
+        """
+        row = self.conn.execute(
+            "SELECT response FROM responses WHERE key = ?", (self.make_key(prompt, model),)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, prompt, model, response):
+        # committed at once, so the responses received before a crash are kept
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, model, response, created) VALUES (?, ?, ?, ?)",
+            (self.make_key(prompt, model), model, response, time.time()),
+        )
+        self.conn.commit()
+
+
+class ProgressJournal:
+    """
+    Append-only JSONL journal of the lines of an input file already processed by a job.
+    Each entry is written and flushed as soon as its result is known, so an interrupted job
+    reloads the journal and only processes the remaining lines.
+    The entries are keyed by the hash of the content of their line, not by its index, so the results
+    stay with their lines when the input file is regenerated, edited or appended to, and the lines
+    changed since are processed again.
+    Args:
+        path (str): The path of the journal.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            self._truncate_partial_line()
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        print(f"Skipping broken journal line in {path}: {line.strip()}")
+                        continue
+                    if "key" not in entry:
+                        # an entry of the older journals, keyed by the line index only
+                        continue
+                    self.entries[entry["key"]] = entry["result"]
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def _truncate_partial_line(self):
+        # the last line may be cut by a crash: it is dropped, and processed again,
+        # so the next entry is not appended onto it
+        with open(self.path, 'rb+') as f:
+            content = f.read()
+            if content and not content.endswith(b"\n"):
+                print(f"Dropping the cut last line of {self.path}")
+                f.truncate(content.rfind(b"\n") + 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    @staticmethod
+    def make_key(content):
+        """
+        Returns:
+            str: The hex digest identifying the content of an input line.
+        """
+        content = json.dumps(content, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """
+        Returns:
+            The result of the line with the key, None if it was not processed.
+        """
+        return self.entries.get(key)
+
+    def append(self, key, result):
+        """
+        Record the result of the input line with the key `make_key(content)`.
+        """
+        self.entries[key] = result
+        self._file.write(json.dumps({"key": key, "result": result}, ensure_ascii=False) + "\n")
+        self._file.flush()
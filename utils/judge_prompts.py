@@ -0,0 +1,252 @@
+import re
+from collections import defaultdict
+
+LLM_JUDGE_PROMPT_TEMPLATE = """You are an expert in summarization. I will give you the original text and two candidate summaries. Please help me score these summaries.
+The scoring criteria are:
+1. Whether the summarization concisely and accurately expresses the meaning of the original text
+2. Whether the language of the summarization is consistent with the original text.
+3. The score needs to be between 0-10
+
+Output format:
+1. summary1: [[4]], summary2: [[5]]
+2. do not output any explanation and other text
+
+original text:
+{original_text}
+
+candidate summaries:
+1. {summary}
+2. {response0}
+"""
+
+# one article and several candidate summaries, the article is sent once for all of them
+MULTI_CANDIDATE_PROMPT_TEMPLATE = """You are an expert in summarization. I will give you the original text and {num_summaries} candidate summaries. Please help me score each of these summaries independently.
+The scoring criteria are:
+1. Whether the summarization concisely and accurately expresses the meaning of the original text
+2. Whether the language of the summarization is consistent with the original text.
+3. The score needs to be between 0-10
+
+Output format:
+1. {output_format}
+2. do not output any explanation and other text
+
+original text:
+{original_text}
+
+candidate summaries:
+{summaries}
+"""
+
+# several short articles, each with its two candidate summaries
+MULTI_ARTICLE_PROMPT_TEMPLATE = """You are an expert in summarization. I will give you {num_articles} original texts, each with two candidate summaries. Please help me score the summaries of each text.
+The scoring criteria are:
+1. Whether the summarization concisely and accurately expresses the meaning of its original text
+2. Whether the language of the summarization is consistent with its original text.
+3. The score needs to be between 0-10
+
+Output format:
+1. one line per text, e.g. article1: summary1: [[7]], summary2: [[3]]
+2. do not output any explanation and other text
+
+{articles}"""
+
+ARTICLE_SECTION_TEMPLATE = """article{index}:
+original text:
+{original_text}
+
+candidate summaries:
+1. {summary}
+2. {response0}
+
+"""
+
+# matches the article labels, e.g. "article3:", and the scores, e.g. "summary2: [[5]]"
+SCORE_PATTERN = re.compile(
+    r"article\s*(\d+)|summary\s*(\d+)\s*[:：]\s*\[\[\s*(\d+)\s*\]\]",
+    re.IGNORECASE,
+)
+# the unlabeled scores in order, e.g. "[[4]] [[5]]", accepted when the response has no label at all
+UNLABELED_SCORE_PATTERN = re.compile(r"\[\s*(\d+)\s*\]")
+MAX_SCORE = 10
+# the example scores of the output format, varied so the judge is not anchored to a fixed pair
+EXAMPLE_SCORES = [7, 3, 9, 5, 2, 8]
+
+# the limits of the batched judge prompts
+MAX_CANDIDATES_PER_PROMPT = 4
+MAX_ARTICLES_PER_PROMPT = 4
+SHORT_ARTICLE_CHARS = 1500
+
+
+def get_texts(data):
+    """
+    Get the original text, the reference summary and the generated one of a judge prompt line.
+    The lines written by `resp_gen.py` store them as fields, they are parsed from the prompt in the older files.
+    Returns:
+        tuple: The original text, the reference summary and the generated summary.
+    """
+    if "text" in data:
+        return data["text"], data["reference"], data["candidate"]
+    prompt = data.get('prompt')
+    original_text = prompt.split("original text:\n")[-1].split("\ncandidate summaries:")[0].strip()
+    summary = prompt.split("candidate summaries:\n1. ")[-1].split("\n")[0].strip()
+    response0 = prompt.split("\n2. ")[-1].split("\n")[0].strip()
+    return original_text, summary, response0
+
+
+def single_prompt(data):
+    """
+    Returns:
+        str: The prompt judging the two summaries of a judge prompt line alone.
+    """
+    if data.get("prompt"):
+        return data["prompt"]
+    original_text, summary, response0 = get_texts(data)
+    return LLM_JUDGE_PROMPT_TEMPLATE.format(original_text=original_text, summary=summary, response0=response0)
+
+
+def parse_labeled_scores(result):
+    """
+    Extract the labeled scores of the judge response, the scores outside 0-10 are ignored.
+    Args:
+        result (str): The response from the LLM judge.
+    Returns:
+        dict: The score of every (article, summary) label, the article is None when the response does not give it.
+            A response without any label gives its scores to summary1, summary2, ... in order.
+    """
+    matches = SCORE_PATTERN.findall(result or "")
+    if not matches:
+        return {
+            (None, i + 1): int(score)
+            for i, score in enumerate(UNLABELED_SCORE_PATTERN.findall(result or ""))
+            if int(score) <= MAX_SCORE
+        }
+    scores, article = {}, None
+    # an article label applies to the scores following it, up to the next label
+    for label, summary, score in matches:
+        if label:
+            article = int(label)
+        elif int(score) <= MAX_SCORE:
+            scores.setdefault((article, int(summary)), int(score))
+    return scores
+
+
+def parse_scores(result):
+    """
+    Extract the scores of the summaries from the judge response of a single article.
+    Args:
+        result (str): The response from the LLM judge.
+    Returns:
+        list: The scores of summary1, summary2, ..., up to the first missing one; empty if none can be parsed.
+    """
+    by_summary = {summary: score for (article, summary), score in parse_labeled_scores(result).items() if article in (None, 1)}
+    scores = []
+    while len(scores) + 1 in by_summary:
+        scores.append(by_summary[len(scores) + 1])
+    return scores
+
+
+class JudgeBatch:
+    """
+    One judge prompt scoring several items, each being the two summaries (reference and candidate) of an article.
+    Args:
+        prompt (str): The judge prompt.
+        items (list): The indices of the judged items.
+        labels (list): The (article, summary) labels of the reference and candidate scores of each item.
+        multi_article (bool): Whether the prompt holds several articles, else the labels have no article.
+    """
+
+    def __init__(self, prompt, items, labels, multi_article):
+        self.prompt = prompt
+        self.items = items
+        self.labels = labels
+        self.multi_article = multi_article
+
+    def parse(self, result):
+        """
+        Map the scores of the judge response back to the items.
+        Returns:
+            list: The [reference, candidate] scores of each item, None for the items missing in the response.
+            None: If no item can be parsed.
+        """
+        labeled = parse_labeled_scores(result)
+        if not self.multi_article:
+            labeled = {(None, summary): score for (article, summary), score in labeled.items() if article in (None, 1)}
+        item_scores = [
+            [labeled[label] for label in labels] if all(label in labeled for label in labels) else None
+            for labels in self.labels
+        ]
+        return item_scores if any(scores is not None for scores in item_scores) else None
+
+
+def multi_candidate_batch(original_text, summary, candidates):
+    """
+    Args:
+        original_text (str): The article.
+        summary (str): The reference summary, scored once for all the candidates.
+        candidates (list): The (item index, generated summary) pairs.
+    """
+    num_summaries = len(candidates) + 1
+    summaries = "\n".join(f"{i + 1}. {s}" for i, s in enumerate([summary] + [c for _, c in candidates]))
+    output_format = ", ".join(
+        f"summary{i + 1}: [[{EXAMPLE_SCORES[i % len(EXAMPLE_SCORES)]}]]" for i in range(num_summaries)
+    )
+    prompt = MULTI_CANDIDATE_PROMPT_TEMPLATE.format(
+        num_summaries=num_summaries,
+        output_format=output_format,
+        original_text=original_text,
+        summaries=summaries,
+    )
+    labels = [[(None, 1), (None, i + 2)] for i in range(len(candidates))]
+    return JudgeBatch(prompt, [item for item, _ in candidates], labels, multi_article=False)
+
+
+def multi_article_batch(articles):
+    """
+    Args:
+        articles (list): The (item index, original text, reference summary, generated summary) of each article.
+    """
+    sections = "".join(
+        ARTICLE_SECTION_TEMPLATE.format(index=a + 1, original_text=original_text, summary=summary, response0=response0)
+        for a, (_, original_text, summary, response0) in enumerate(articles)
+    )
+    prompt = MULTI_ARTICLE_PROMPT_TEMPLATE.format(num_articles=len(articles), articles=sections)
+    labels = [[(a + 1, 1), (a + 1, 2)] for a in range(len(articles))]
+    return JudgeBatch(prompt, [item for item, *_ in articles], labels, multi_article=True)
+
+
+def plan_batches(
+    texts,
+    max_candidates=MAX_CANDIDATES_PER_PROMPT,
+    max_articles=MAX_ARTICLES_PER_PROMPT,
+    short_article_chars=SHORT_ARTICLE_CHARS,
+):
+    """
+    Group the items sharing an article and reference into multi-candidate prompts, then pack the remaining
+    short articles into multi-article prompts. The other items are left to be judged alone.
+    Args:
+        texts (list): The (original text, reference summary, generated summary) of every item.
+        max_candidates (int): The maximum number of generated summaries per multi-candidate prompt.
+        max_articles (int): The maximum number of articles per multi-article prompt.
+        short_article_chars (int): The articles up to this length can be packed with others.
+    Returns:
+        list: The `JudgeBatch` of the grouped items, each scoring at least two of them.
+    """
+    groups = defaultdict(list)
+    for item, (original_text, summary, response0) in enumerate(texts):
+        groups[(original_text, summary)].append((item, response0))
+
+    batches, leftovers = [], []
+    for (original_text, summary), candidates in groups.items():
+        for start in range(0, len(candidates), max_candidates):
+            chunk = candidates[start:start + max_candidates]
+            if len(chunk) > 1:
+                batches.append(multi_candidate_batch(original_text, summary, chunk))
+            else:
+                leftovers.append(chunk[0][0])
+
+    short = [item for item in leftovers if len(texts[item][0]) <= short_article_chars]
+    for start in range(0, len(short), max_articles):
+        chunk = short[start:start + max_articles]
+        if len(chunk) > 1:
+            batches.append(multi_article_batch([(item, *texts[item]) for item in chunk]))
+    return batches
@@ -0,0 +1,88 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubJudgeHandler(BaseHTTPRequestHandler):
+    """
+    Answers the chat completions requests like an LLM judge, with deterministic scores derived from the prompt.
+    A fraction of the requests is rejected with 429 to exercise the retries of the client.
+    """
+
+    latency = 0.05
+    error_rate = 0.0
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self.send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}})
+            return
+        prompt = request["messages"][-1]["content"]
+        self.send_json(200, {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "stub"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": stub_judgement(prompt)}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(prompt), "completion_tokens": 16, "total_tokens": len(prompt) + 16},
+        })
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def score_candidates(section):
+    candidates = re.findall(r"^\d+\. (.*)$", section.split("candidate summaries:")[-1], flags=re.MULTILINE)
+    return [int(hashlib.sha256(c.encode()).hexdigest(), 16) % 11 for c in candidates]
+
+
+def stub_judgement(prompt):
+    """
+    Score every numbered candidate summary of the prompt with a score derived from its text.
+    The prompts with several articles are answered with one line per article.
+    """
+    sections = re.split(r"^article(\d+):$", prompt, flags=re.MULTILINE)
+    if len(sections) > 1:
+        return "\n".join(
+            f"article{index}: " + ", ".join(f"summary{i + 1}: [[{score}]]" for i, score in enumerate(score_candidates(section)))
+            for index, section in zip(sections[1::2], sections[2::2])
+        )
+    return ", ".join(f"summary{i + 1}: [[{score}]]" for i, score in enumerate(score_candidates(prompt)))
+
+
+def serve(host="127.0.0.1", port=8000, latency=0.05, error_rate=0.0):
+    """
+    Run an OpenAI-compatible stub judge, e.g. to test the judge client with `openai.base_url = "http://127.0.0.1:8000/v1/"`.
+    """
+    StubJudgeHandler.latency = latency
+    StubJudgeHandler.error_rate = error_rate
+    server = ThreadingHTTPServer((host, port), StubJudgeHandler)
+    print(f"Stub judge listening on http://{host}:{port}/v1/")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI-compatible stub LLM judge for local tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds to wait before answering.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests rejected with 429.")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.latency, args.error_rate)
@@ -1,14 +1,31 @@
+import asyncio
 import json
 import os
-import re
+import random
 import time
+import httpx
 import openai
 from tqdm import tqdm
+from utils.judge_cache import JudgeCache, ProgressJournal, journal_path
+from utils.judge_prompts import get_texts, parse_scores, plan_batches, single_prompt
 
 openai.base_url = "" # Your LLM judge API url
 openai.api_key = ""  # Your API key
 JUDGE_MODEL = "" # the model name of your LLM judge
 
+# the limits of the async judge client, set them to the quota of your API
+MAX_IN_FLIGHT = 32  # concurrent requests
+REQUESTS_PER_SEC = 8.0  # sustained request rate
+BURST = 16  # requests allowed at once above the rate
+MAX_RETRIES = 6  # retries of rate limited, failed or timed out requests
+BACKOFF_BASE = 1.0  # seconds, doubled at every retry
+BACKOFF_MAX = 60.0
+REQUEST_TIMEOUT = 120.0
+# score several comparisons per judge prompt, see `utils/judge_prompts.py`
+BATCH_JUDGING = True
+# the judge responses are cached here, shared by make_pref_dataset.py and check_win_rate.py
+JUDGE_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "summary_adapter", "judge_cache.sqlite")
+
 
 def get_llm_judge(content):
     """
@@ -30,7 +47,7 @@ def get_llm_judge(content):
 def get_llm_judge_with_retry(prompt, max_retries=3):
     """
     Call the LLM judge to get scores for the summaries.
-    If the result is not a valid Python list, retry.
+    If no score can be parsed from the result, retry.
     Args:
         prompt (str): The prompt to send to the LLM judge.
         max_retries (int): The maximum number of retries if the result is invalid.
@@ -40,20 +57,268 @@ def get_llm_judge_with_retry(prompt, max_retries=3):
     """
     for i in range(max_retries):
         result = get_llm_judge(prompt)
-        try:
-            scores = []
-            matches = re.findall(r'\[(\d+)\]', result)  # find all numbers in square brackets
-            for match in matches:
-                try:
-                    score = int(match)  # convert the matched string to an integer
-                    scores.append(score)
-                except ValueError:
-                    print(f"WARN: Can't chagne '{match}' into int.")
-                    pass
+        scores = parse_scores(result)
+        if scores:
             return scores
-        except ValueError:
-            print(f"Try {i+1}: ValueError: {result}")
-            time.sleep(1)
-            continue
+        print(f"Try {i+1}: can't parse the scores of: {result}")
+        time.sleep(1)
     print(f"All {max_retries} retries failed.")
     return None
+
+
+class TokenBucket:
+    """
+    Rate limiter for asyncio: `rate` requests per second on average, up to `capacity` at once.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_time = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+                self.last_time = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncJudgeClient:
+    """
+    Asyncio client of the LLM judge, any OpenAI-compatible chat completions API.
+    The connections are pooled and reused, at most `max_in_flight` requests run at once,
+    a token bucket keeps the request rate under `requests_per_sec`, and the rate limited,
+    failed or timed out requests are retried with exponential backoff and full jitter.
+    Args:
+        base_url (str): The API url, `openai.base_url` by default.
+        api_key (str): The API key, `openai.api_key` by default.
+        model (str): The judge model, `JUDGE_MODEL` by default.
+        max_in_flight (int): The maximum number of concurrent requests.
+        requests_per_sec (float): The sustained request rate.
+        burst (int): The number of requests allowed at once above the rate.
+        max_retries (int): The number of retries of a request.
+        backoff_base (float): The backoff of the first retry in seconds, doubled at every retry.
+        backoff_max (float): The maximum backoff in seconds.
+        timeout (float): The timeout of a request in seconds.
+    """
+
+    RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+    def __init__(
+        self,
+        base_url=None,
+        api_key=None,
+        model=None,
+        max_in_flight=MAX_IN_FLIGHT,
+        requests_per_sec=REQUESTS_PER_SEC,
+        burst=BURST,
+        max_retries=MAX_RETRIES,
+        backoff_base=BACKOFF_BASE,
+        backoff_max=BACKOFF_MAX,
+        timeout=REQUEST_TIMEOUT,
+    ):
+        self.model = model or JUDGE_MODEL
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        limits = httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight)
+        # the retries are done here, with the rate limit and the jitter
+        self.client = openai.AsyncOpenAI(
+            base_url=base_url or str(openai.base_url),
+            api_key=api_key or openai.api_key,
+            max_retries=0,
+            timeout=timeout,
+            http_client=openai.DefaultAsyncHttpxClient(limits=limits, timeout=timeout),
+        )
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.bucket = TokenBucket(requests_per_sec, burst)
+        self.num_requests = 0
+        self.num_retries = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self.client.close()
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def judge(self, prompt):
+        """
+        Send a prompt to the LLM judge.
+        Args:
+            prompt (str): The prompt to send to the LLM judge.
+        Returns:
+            str: The response from the LLM judge.
+        Raises:
+            openai.OpenAIError: If the request still fails after `max_retries` retries, or can not be retried.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.semaphore:
+                    await self.bucket.acquire()
+                    self.num_requests += 1
+                    completion = await self.client.chat.completions.create(
+                        model=self.model,
+                        messages=[{"role": "user", "content": prompt}],
+                    )
+                return completion.choices[0].message.content
+            except self.RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                self.num_retries += 1
+                delay = self.backoff(attempt)
+                print(f"Try {attempt + 1}: {type(e).__name__}, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def judge_scores(self, prompt):
+        """
+        Async version of `get_llm_judge_with_retry`.
+        Returns:
+            list: A list of scores for the summaries.
+            None: If the request failed.
+        """
+        try:
+            return parse_scores(await self.judge(prompt))
+        except openai.OpenAIError as e:
+            print(f"Judge request failed: {type(e).__name__}: {e}")
+            return None
+
+
+def judge_prompts(prompts, desc="Judging", cache=None, on_result=None, parsers=None, **client_kwargs):
+    """
+    Judge all the prompts concurrently with an `AsyncJudgeClient`.
+    Args:
+        prompts (list): The prompts to send to the LLM judge.
+        desc (str): The description of the progress bar.
+        cache (JudgeCache): The cache of the judge responses, the cached prompts are not sent again.
+            Only the responses with scores are cached, so the failed prompts are judged again on the next run.
+        on_result (callable): Called with the index of the prompt and its scores as soon as they are known,
+            e.g. to journal the progress of the job.
+        parsers (list): The function extracting the scores from the response of each prompt, `parse_scores` by default.
+        client_kwargs: The arguments of `AsyncJudgeClient`.
+    Returns:
+        list: The scores of every prompt (None for the failed ones), in the order of the prompts.
+    """
+    async def run():
+        async with AsyncJudgeClient(**client_kwargs) as client:
+            with tqdm(total=len(prompts), desc=desc, unit="prompt") as pbar:
+                async def judge_one(index, prompt):
+                    parser = parsers[index] if parsers is not None else parse_scores
+                    response = cache.get(prompt, client.model) if cache is not None else None
+                    if response is not None:
+                        scores = parser(response)
+                    else:
+                        try:
+                            response = await client.judge(prompt)
+                        except openai.OpenAIError as e:
+                            print(f"Judge request failed: {type(e).__name__}: {e}")
+                            scores = None
+                        else:
+                            scores = parser(response)
+                            if cache is not None and scores:
+                                cache.put(prompt, client.model, response)
+                    if on_result is not None:
+                        on_result(index, scores)
+                    pbar.update(1)
+                    return scores
+
+                results = await asyncio.gather(*(judge_one(i, prompt) for i, prompt in enumerate(prompts)))
+            cached = f", {cache.hits} cached responses" if cache is not None else ""
+            print(f"{client.num_requests} judge requests, {client.num_retries} retries{cached}")
+            return results
+
+    return asyncio.run(run())
+
+
+def judge_files(records_by_file, desc="Overall Progress", cache_path=None, batch=BATCH_JUDGING, lines_by_file=None, **client_kwargs):
+    """
+    Judge the lines of several input files together, resuming the interrupted jobs.
+    With `batch`, the lines sharing an article, or with short articles, are first scored several at once
+    by batched prompts, and the lines missing from their responses are then judged alone.
+    The scores of every line are appended to the progress journal of its file as soon as they are known,
+    keyed by the texts of the line, and the lines already in the journals are not judged again. The responses are also kept in the
+    judge cache, so the same prompts are never sent twice to the judge model.
+    Args:
+        records_by_file (dict): The parsed judge prompt lines of each input file.
+        desc (str): The description of the progress bar.
+        cache_path (str): The path of the judge cache, `JUDGE_CACHE_PATH` by default.
+        batch (bool): Whether to score several lines per judge prompt.
+        lines_by_file (dict): The indices of the lines to judge in each file, all the lines by default.
+        client_kwargs: The arguments of `AsyncJudgeClient`.
+    Returns:
+        dict: The scores of every line of each file, None for the lines still failing or not selected.
+            The journal of a file can be removed once its output is written and all its lines are judged.
+    """
+    journals = {file_path: ProgressJournal(journal_path(file_path)) for file_path in records_by_file}
+    # the scores of a line depend only on its texts, a regenerated or edited file keeps the results of its unchanged lines
+    keys = {
+        file_path: [ProgressJournal.make_key(get_texts(record)) for record in records]
+        for file_path, records in records_by_file.items()
+    }
+    if lines_by_file is None:
+        lines_by_file = {file_path: range(len(records)) for file_path, records in records_by_file.items()}
+    pending = [
+        (file_path, i)
+        for file_path, lines in lines_by_file.items()
+        for i in lines
+        if keys[file_path][i] not in journals[file_path]
+    ]
+    total = sum(len(lines) for lines in lines_by_file.values())
+    print(f"{len(pending)} lines to judge, {total - len(pending)} resumed from the progress journals")
+
+    def journal(line, scores):
+        # the failed lines are not journaled, so they are judged again
+        if scores and len(scores) == 2:
+            file_path, i = line
+            journals[file_path].append(keys[file_path][i], scores)
+
+    try:
+        with JudgeCache(cache_path or JUDGE_CACHE_PATH) as cache:
+            if batch:
+                batches = plan_batches([get_texts(records_by_file[file_path][i]) for file_path, i in pending])
+
+                def on_batch_result(index, item_scores):
+                    for item, scores in zip(batches[index].items, item_scores or []):
+                        journal(pending[item], scores)
+
+                judge_prompts(
+                    [judge_batch.prompt for judge_batch in batches],
+                    desc=f"{desc} (batched)",
+                    cache=cache,
+                    on_result=on_batch_result,
+                    parsers=[judge_batch.parse for judge_batch in batches],
+                    **client_kwargs,
+                )
+                num_batched = sum(len(judge_batch.items) for judge_batch in batches)
+                remaining = [(file_path, i) for file_path, i in pending if keys[file_path][i] not in journals[file_path]]
+                print(f"{len(batches)} batched prompts for {num_batched} lines, {len(remaining)} lines left to judge alone")
+            else:
+                remaining = pending
+
+            judge_prompts(
+                [single_prompt(records_by_file[file_path][i]) for file_path, i in remaining],
+                desc=desc,
+                cache=cache,
+                on_result=lambda index, scores: journal(remaining[index], scores),
+                **client_kwargs,
+            )
+    finally:
+        for journal_file in journals.values():
+            journal_file.close()
+
+    return {
+        file_path: [journals[file_path].get(key) for key in keys[file_path]]
+        for file_path, records in records_by_file.items()
+    }
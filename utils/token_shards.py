@@ -0,0 +1,316 @@
+import bisect
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from utils.prompts import SYSTEM_MSG, USER_PROMPT_PREFIX
+from utils.xlsum_store import read_records, to_messages
+
+# bump when the layout of the shards or the tokenization changes
+SHARD_FORMAT_VERSION = 1
+TOKENIZE_BATCH_SIZE = 1024
+IGNORE_INDEX = -100
+
+
+def _batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def tokenizer_fingerprint(tokenizer):
+    """
+    Returns:
+        str: A hash of the vocabulary, merges and special tokens of a tokenizer.
+    """
+    digest = hashlib.sha256()
+    if getattr(tokenizer, "is_fast", False):
+        digest.update(tokenizer.backend_tokenizer.to_str().encode())
+    else:
+        digest.update(json.dumps(tokenizer.get_vocab(), sort_keys=True).encode())
+    digest.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def shard_key(data_file, tokenizer, max_length):
+    """
+    The cache key of the shard of a data file: the file revision, the tokenizer, the chat template,
+    the prompts and `max_length`. Changing any of them builds a new shard.
+    Returns:
+        str: The key.
+    """
+    stat = os.stat(data_file)
+    digest = hashlib.sha256()
+    for part in [
+        SHARD_FORMAT_VERSION,
+        os.path.abspath(data_file),
+        stat.st_size,
+        stat.st_mtime_ns,
+        tokenizer_fingerprint(tokenizer),
+        tokenizer.chat_template or "",
+        SYSTEM_MSG,
+        USER_PROMPT_PREFIX,
+        max_length,
+    ]:
+        digest.update(str(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+def tokenize_conversations(tokenizer, conversations, max_length):
+    """
+    Tokenize conversations ending with the assistant answer, marking the tokens of the answer.
+    The prompt and the answer are rendered with the chat template and tokenized separately,
+    so the boundary of the loss mask is exact. Too long conversations lose the end of the article,
+    the end of the prompt and the answer are kept.
+    Args:
+        tokenizer (PreTrainedTokenizer): The tokenizer.
+        conversations (list): The `messages` of every sample.
+        max_length (int): The sequences are truncated to this length.
+    Returns:
+        list: The (token ids, completion mask) of every conversation.
+    """
+    prompts = tokenizer.apply_chat_template([c[:-1] for c in conversations], tokenize=False, add_generation_prompt=True)
+    fulls = tokenizer.apply_chat_template(conversations, tokenize=False)
+    completions = []
+    for prompt, full in zip(prompts, fulls):
+        if not full.startswith(prompt):
+            raise ValueError("The chat template does not render the prompt as a prefix of the conversation.")
+        completions.append(full[len(prompt):])
+    prompt_ids = tokenizer(prompts, add_special_tokens=False)["input_ids"]
+    completion_ids = tokenizer(completions, add_special_tokens=False)["input_ids"]
+    tail_length = _prompt_tail_length(tokenizer)
+    sequences = []
+    for p_ids, c_ids in zip(prompt_ids, completion_ids):
+        if len(p_ids) + len(c_ids) > max_length:
+            prompt_length = max(tail_length, max_length - len(c_ids))
+            p_ids = p_ids[:prompt_length - tail_length] + p_ids[len(p_ids) - tail_length:]
+            c_ids = c_ids[:max_length - len(p_ids)]
+        sequences.append((p_ids + c_ids, [0] * len(p_ids) + [1] * len(c_ids)))
+    return sequences
+
+
+def _prompt_tail_length(tokenizer):
+    """
+    Returns:
+        int: The number of prompt tokens after the article, i.e. the end of the user turn and the generation prompt.
+    """
+    placeholder = "<|article|>"
+    conversation = to_messages({"article": placeholder, "summary": ""})["messages"][:-1]
+    rendered = tokenizer.apply_chat_template(conversation, tokenize=False, add_generation_prompt=True)
+    return len(tokenizer(rendered.split(placeholder)[1], add_special_tokens=False)["input_ids"])
+
+
+def pack_sequences(lengths, max_length):
+    """
+    Group the sequences into packs of at most `max_length` tokens, with best-fit decreasing.
+    Args:
+        lengths (np.ndarray): The length of every sequence.
+        max_length (int): The capacity of a pack.
+    Returns:
+        list: The sequence indices of every pack.
+    """
+    packs = []
+    # the remaining capacities of the open packs, sorted, and the pack of each of them
+    capacities, pack_ids = [], []
+    for seq_id in np.argsort(-lengths, kind="stable"):
+        length = int(lengths[seq_id])
+        i = bisect.bisect_left(capacities, length)
+        if i == len(capacities):
+            pack_id, remaining = len(packs), max_length - length
+            packs.append([])
+        else:
+            pack_id, remaining = pack_ids.pop(i), capacities.pop(i) - length
+        packs[pack_id].append(int(seq_id))
+        j = bisect.bisect_left(capacities, remaining)
+        capacities.insert(j, remaining)
+        pack_ids.insert(j, pack_id)
+    return packs
+
+
+def build_token_shard(data_file, tokenizer, max_length, cache_dir):
+    """
+    Tokenize and pack the samples of a data file of the store once, and save them as memory-mappable arrays:
+    - `tokens.bin` (uint32) and `completion_mask.bin` (uint8): the tokens of all sequences, pack after pack.
+    - `seq_offsets.npy`: the start of every sequence in the tokens, and the end of the last one.
+    - `pack_offsets.npy`: the first sequence of every pack, and the number of sequences.
+    The shard is reused as long as its key (see `shard_key`) does not change.
+    Args:
+        data_file (str): A Parquet file of the store.
+        tokenizer (PreTrainedTokenizer): The tokenizer, with its chat template.
+        max_length (int): The maximum length of a sequence and of a pack.
+        cache_dir (str): The directory of the shards.
+    Returns:
+        str: The directory of the shard.
+    """
+    shard_dir = os.path.join(cache_dir, shard_key(data_file, tokenizer, max_length))
+    if os.path.exists(os.path.join(shard_dir, "meta.json")):
+        return shard_dir
+    print(f"Tokenizing {data_file} -> {shard_dir}")
+    tmp_dir = f"{shard_dir}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    # first pass: tokenize in batches, appending the sequences in file order to unordered files
+    lengths, num_completion_tokens = [], 0
+    with open(os.path.join(tmp_dir, "unordered_tokens.bin"), "wb") as token_file, \
+            open(os.path.join(tmp_dir, "unordered_mask.bin"), "wb") as mask_file:
+        conversations = (to_messages(record)["messages"] for record in read_records(data_file, columns=["article", "summary"]))
+        for batch in _batched(conversations, TOKENIZE_BATCH_SIZE):
+            for ids, mask in tokenize_conversations(tokenizer, batch, max_length):
+                token_file.write(np.asarray(ids, dtype=np.uint32).tobytes())
+                mask_file.write(np.asarray(mask, dtype=np.uint8).tobytes())
+                lengths.append(len(ids))
+                num_completion_tokens += sum(mask)
+    if not lengths:
+        shutil.rmtree(tmp_dir)
+        raise ValueError(f"No samples in {data_file}")
+    lengths = np.asarray(lengths, dtype=np.int64)
+    unordered_offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+    # second pass: write the sequences pack after pack, so every pack is one contiguous slice
+    packs = pack_sequences(lengths, max_length)
+    order = np.asarray([seq_id for pack in packs for seq_id in pack], dtype=np.int64)
+    unordered_tokens = np.memmap(os.path.join(tmp_dir, "unordered_tokens.bin"), dtype=np.uint32, mode="r")
+    unordered_mask = np.memmap(os.path.join(tmp_dir, "unordered_mask.bin"), dtype=np.uint8, mode="r")
+    num_tokens = int(lengths.sum())
+    tokens = np.memmap(os.path.join(tmp_dir, "tokens.bin"), dtype=np.uint32, mode="w+", shape=(num_tokens,))
+    mask = np.memmap(os.path.join(tmp_dir, "completion_mask.bin"), dtype=np.uint8, mode="w+", shape=(num_tokens,))
+    position = 0
+    for seq_id in order:
+        start, end = unordered_offsets[seq_id], unordered_offsets[seq_id + 1]
+        tokens[position:position + end - start] = unordered_tokens[start:end]
+        mask[position:position + end - start] = unordered_mask[start:end]
+        position += end - start
+    tokens.flush()
+    mask.flush()
+    del tokens, mask, unordered_tokens, unordered_mask
+    os.remove(os.path.join(tmp_dir, "unordered_tokens.bin"))
+    os.remove(os.path.join(tmp_dir, "unordered_mask.bin"))
+
+    np.save(os.path.join(tmp_dir, "seq_offsets.npy"), np.concatenate([[0], np.cumsum(lengths[order])]))
+    np.save(os.path.join(tmp_dir, "pack_offsets.npy"), np.concatenate([[0], np.cumsum([len(pack) for pack in packs])]))
+    meta = {
+        "data_file": data_file,
+        "max_length": max_length,
+        "num_sequences": len(lengths),
+        "num_packs": len(packs),
+        "num_tokens": num_tokens,
+        "num_completion_tokens": num_completion_tokens,
+    }
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    # another rank may have finished the same shard in the meantime
+    if os.path.exists(shard_dir):
+        shutil.rmtree(tmp_dir)
+    else:
+        os.replace(tmp_dir, shard_dir)
+    print(f"{data_file}: {meta['num_sequences']} sequences, {meta['num_tokens']} tokens in {meta['num_packs']} packs")
+    return shard_dir
+
+
+class TokenShardDataset(Dataset):
+    """
+    Reads the packs (or the single sequences) of token shards straight from their memory-mapped files.
+    The pages are shared by all the ranks of a node through the page cache, so no rank loads the whole shard;
+    the tokens of a batch are still copied once, when the collator concatenates its items.
+    Args:
+        shard_dirs (list): The directories returned by `build_token_shard`.
+        packed (bool): Return packs of sequences, otherwise one sequence per item.
+    """
+
+    def __init__(self, shard_dirs, packed=True):
+        self.shard_dirs = list(shard_dirs)
+        self.packed = packed
+        self._arrays = None
+        sizes = []
+        for shard_dir in self.shard_dirs:
+            with open(os.path.join(shard_dir, "meta.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            sizes.append(meta["num_packs"] if packed else meta["num_sequences"])
+        self._starts = np.concatenate([[0], np.cumsum(sizes)])
+
+    def _open(self):
+        # opened lazily, so the dataset can be sent to the dataloader workers without copying the arrays
+        self._arrays = [
+            {
+                "tokens": np.memmap(os.path.join(shard_dir, "tokens.bin"), dtype=np.uint32, mode="r"),
+                "completion_mask": np.memmap(os.path.join(shard_dir, "completion_mask.bin"), dtype=np.uint8, mode="r"),
+                "seq_offsets": np.load(os.path.join(shard_dir, "seq_offsets.npy"), mmap_mode="r"),
+                "pack_offsets": np.load(os.path.join(shard_dir, "pack_offsets.npy"), mmap_mode="r"),
+            }
+            for shard_dir in self.shard_dirs
+        ]
+
+    def __len__(self):
+        return int(self._starts[-1])
+
+    def __getitem__(self, index):
+        if self._arrays is None:
+            self._open()
+        shard_id = int(np.searchsorted(self._starts, index, side="right")) - 1
+        arrays = self._arrays[shard_id]
+        index -= int(self._starts[shard_id])
+        if self.packed:
+            first, last = arrays["pack_offsets"][index], arrays["pack_offsets"][index + 1]
+        else:
+            first, last = index, index + 1
+        offsets = arrays["seq_offsets"][first:last + 1]
+        start, end = int(offsets[0]), int(offsets[-1])
+        return {
+            "input_ids": arrays["tokens"][start:end],
+            "completion_mask": arrays["completion_mask"][start:end],
+            "seq_lengths": np.diff(offsets),
+        }
+
+
+class FlatteningCollator:
+    """
+    Concatenate all the sequences of a batch into a single row without padding.
+    The position ids restart at every sequence, so flash attention keeps the sequences apart,
+    and only the completion tokens are used as labels.
+    """
+
+    def __call__(self, features):
+        input_ids = np.concatenate([f["input_ids"] for f in features]).astype(np.int64)
+        completion_mask = np.concatenate([f["completion_mask"] for f in features]).astype(bool)
+        position_ids = np.concatenate([np.arange(length) for f in features for length in f["seq_lengths"]])
+        labels = np.where(completion_mask, input_ids, IGNORE_INDEX)
+        return {
+            "input_ids": torch.from_numpy(input_ids)[None],
+            "labels": torch.from_numpy(labels)[None],
+            "position_ids": torch.from_numpy(position_ids)[None],
+        }
+
+
+def pretokenized_trainer(model, args, train_dataset, eval_dataset=None):
+    """
+    Build a plain `Trainer` feeding the token shards to the model through `FlatteningCollator`.
+    Args:
+        model (PreTrainedModel): The model to train.
+        args (TrainingArguments): The training arguments, e.g. an `SFTConfig`.
+        train_dataset (TokenShardDataset): The training shards.
+        eval_dataset (TokenShardDataset): The evaluation shards.
+    Returns:
+        Trainer: The trainer.
+    """
+    from transformers import Trainer
+
+    # the items are not a `datasets.Dataset`, so Trainer would otherwise drop the fields missing from the
+    # forward signature of the model (completion_mask, seq_lengths) before they reach the collator
+    args.remove_unused_columns = False
+    return Trainer(
+        model,
+        args=args,
+        train_dataset=train_dataset,
+        eval_dataset=eval_dataset,
+        data_collator=FlatteningCollator(),
+    )
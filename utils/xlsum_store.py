@@ -0,0 +1,74 @@
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+from utils.prompts import SYSTEM_MSG, USER_PROMPT_PREFIX
+
+LANGS = ["chinese_traditional", "english", "japanese", "korean"]
+SPLITS = ["train", "validation", "test"]
+# only the fields used by the training and eval pipelines are stored, the chat messages are built at load time
+SCHEMA = pa.schema([("id", pa.string()), ("article", pa.string()), ("summary", pa.string())])
+ROW_GROUP_SIZE = 8192
+
+
+def store_path(dataset_dir, lang, split):
+    """
+    Returns:
+        str: The path of the Parquet file of a language and split, `<dataset_dir>/<lang>/<split>.parquet`.
+    """
+    return os.path.join(dataset_dir, lang, f"{split}.parquet")
+
+
+def open_writer(file_path):
+    """
+    Returns:
+        pq.ParquetWriter: A writer of a zstd compressed Parquet file of the store, to be closed by the caller.
+    """
+    return pq.ParquetWriter(file_path, SCHEMA, compression="zstd")
+
+
+def write_records(records, file_path):
+    """
+    Write the id/article/summary records to a zstd compressed Parquet file.
+    Args:
+        records (list): Dicts with the id, article and summary of each sample.
+        file_path (str): The output path.
+    """
+    table = pa.Table.from_pylist(records, schema=SCHEMA)
+    pq.write_table(table, file_path, compression="zstd", row_group_size=ROW_GROUP_SIZE)
+
+
+def read_records(file_path, columns=None, max_rows=None):
+    """
+    Stream the records of a Parquet file, one row group at a time.
+    Args:
+        file_path (str): The Parquet file.
+        columns (list): The columns to read, None to read all of them.
+        max_rows (int): The number of records to read, None to read all of them.
+    Yields:
+        dict: One record.
+    """
+    parquet_file = pq.ParquetFile(file_path)
+    num_rows = 0
+    for batch in parquet_file.iter_batches(columns=columns):
+        for record in batch.to_pylist():
+            if max_rows is not None and num_rows >= max_rows:
+                return
+            num_rows += 1
+            yield record
+
+
+def to_messages(example):
+    """
+    Build the chat conversation of a sample for SFT training, to be used with `Dataset.map`.
+    Args:
+        example (dict): A record of the store.
+    Returns:
+        dict: The `messages` of the conversation.
+    """
+    return {
+        "messages": [
+            {"role": "system", "content": SYSTEM_MSG},
+            {"role": "user", "content": USER_PROMPT_PREFIX + example["article"]},
+            {"role": "assistant", "content": example["summary"]},
+        ]
+    }